@@ -0,0 +1,61 @@
+"""Saktësia dhe kostoja për thirrje e detekto_intent mbi korpusin e etiketuar.
+
+    python bench/bench_intent.py [--perseritje N]
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server import detekto_intent  # noqa: E402
+
+KORPUSI = os.path.join(os.path.dirname(os.path.abspath(__file__)), "intent_korpus.tsv")
+
+def lexo_korpusin(shteg: str = KORPUSI):
+    rreshtat = []
+    with open(shteg, encoding="utf-8") as f:
+        for rreshti in f:
+            rreshti = rreshti.rstrip("\n")
+            if not rreshti or rreshti.startswith("#"):
+                continue
+            kolonat = rreshti.split("\t")
+            slotet = {}
+            if len(kolonat) > 2 and kolonat[2]:
+                for cift in kolonat[2].split(";"):
+                    k, v = cift.split("=", 1)
+                    slotet[k] = v
+            rreshtat.append((kolonat[0], kolonat[1], slotet))
+    return rreshtat
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--perseritje", type=int, default=200)
+    args = ap.parse_args()
+
+    korpusi = lexo_korpusin()
+    gabime = []
+    for teksti, pritur, slotet in korpusi:
+        intent = detekto_intent(teksti)
+        slotet_gabim = {k: v for k, v in slotet.items() if str(intent.get(k)) != v}
+        if intent["lloj"] != pritur or slotet_gabim:
+            gabime.append((teksti, pritur, intent))
+
+    tekstet = [t for t, _, _ in korpusi]
+    fillimi = time.perf_counter()
+    for _ in range(args.perseritje):
+        for teksti in tekstet:
+            detekto_intent(teksti)
+    kohezgjatja = time.perf_counter() - fillimi
+    thirrje = args.perseritje * len(tekstet)
+
+    print(f"Korpusi: {len(korpusi)} shprehje")
+    print(f"Saktësia: {len(korpusi) - len(gabime)}/{len(korpusi)} "
+          f"({100 * (len(korpusi) - len(gabime)) / len(korpusi):.1f}%)")
+    print(f"Kosto: {1e6 * kohezgjatja / thirrje:.2f} µs/thirrje ({thirrje} thirrje)")
+    for teksti, pritur, intent in gabime:
+        print(f"  GABIM: {teksti!r} - pritej {pritur}, u gjet {intent}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,423 @@
+"""Test ngarkese offline: ngre stand-in-et e shërbimeve dhe serverin, pastaj mat latencën nën ngarkesë.
+
+    python bench/load_test.py [--paralel 16] [--kohezgjatja 30] [--rps 20]
+                              [--vonesa groq=0.6] [--gabime groq=0.05]
+                              [--json rezultati.json] [--max-p95-ms 2500]
+
+Pa --server, skripti nis bench/mock_upstreams.py dhe `uvicorn server:app` me URL-të
+e shërbimeve të drejtuara te stand-in-i, kështu që nuk duhen çelësa API as rrjet.
+Me --server http://host:port godet një server që është nisur tashmë.
+
+Përzierja e kërkesave: /ask me tekste nga intent_korpus.tsv sipas peshave të intenteve,
+pasuar nga /get_audio dhe /done si pajisja e vërtetë; /ask/stream, /transcribe, /voice
+dhe /regjistro me peshat e --perzierja. Me --rps ngarkesa është me ritëm fiks (latenca
+matet nga momenti i planifikuar, pa "coordinated omission"); pa të, --paralel punëtorë
+dërgojnë kërkesën tjetër sapo mbaron e mëparshmja.
+
+Raporti: p50/p95/p99/max për çdo operacion, kërkesa/sekondë, gabimet, dhe rritja e
+RSS-it të serverit (vetëm kur serveri niset nga skripti, lexohet nga /proc).
+"""
+import argparse
+import asyncio
+import io
+import json
+import math
+import os
+import random
+import socket
+import struct
+import subprocess
+import sys
+import time
+import wave
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+
+DOSJA = os.path.dirname(os.path.abspath(__file__))
+RRENJA = os.path.dirname(DOSJA)
+KORPUSI = os.path.join(DOSJA, "intent_korpus.tsv")
+
+sys.path.insert(0, DOSJA)
+
+from mock_upstreams import mjedisi_per_serverin  # noqa: E402
+
+# Sa shpesh vjen secili intent nga pajisjet (jo sa shpesh shfaqet në korpus)
+PESHAT_INTENT = {"ai": 35, "mot": 20, "rruge": 10, "ora": 8, "alarm": 8, "timer": 8,
+                 "data": 6, "ndihme_mendore": 5}
+PERZIERJA = "ask=70,ask_stream=8,transcribe=8,voice=6,regjistro=8"
+
+EMRAT = ["Ana", "Blerim", "Drita", "Ermal", "Fatjona", "Gent", "Iris", "Kledi"]
+QYTETET = ["Tirana", "Durrës", "Vlorë", "Shkodër", "Korçë", "Elbasan"]
+
+def lexo_korpusin(shteg: str = KORPUSI) -> Dict[str, List[str]]:
+    tekstet: Dict[str, List[str]] = {}
+    with open(shteg, encoding="utf-8") as f:
+        for rreshti in f:
+            rreshti = rreshti.rstrip("\n")
+            if not rreshti or rreshti.startswith("#"):
+                continue
+            kolonat = rreshti.split("\t")
+            tekstet.setdefault(kolonat[1], []).append(kolonat[0])
+    return tekstet
+
+def wav_prove(sekonda: float = 2.0, shpejtesia: int = 16000) -> bytes:
+    """Zë i rremë (ton me amplitudë që ndryshon) me heshtje në fillim dhe në fund"""
+    korniza = bytearray()
+    n = int(sekonda * shpejtesia)
+    for i in range(n):
+        t = i / shpejtesia
+        amplituda = 0 if t < 0.4 or t > sekonda - 0.4 else 6000 * (0.6 + 0.4 * math.sin(2 * math.pi * 3 * t))
+        korniza += struct.pack("<h", int(amplituda * math.sin(2 * math.pi * 220 * t)))
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(shpejtesia)
+        w.writeframes(bytes(korniza))
+    return buf.getvalue()
+
+def _port_i_lire() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _rss_kb(pid: int) -> Optional[int]:
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for rreshti in f:
+                if rreshti.startswith("VmRSS:"):
+                    return int(rreshti.split()[1])
+    except OSError:
+        pass
+    return None
+
+def _peshat(teksti: str) -> Dict[str, float]:
+    peshat = {}
+    for cift in teksti.split(","):
+        emri, _, pesha = cift.partition("=")
+        peshat[emri.strip()] = float(pesha)
+    return peshat
+
+def _zgjidh(peshat: Dict[str, float]) -> str:
+    return random.choices(list(peshat), weights=list(peshat.values()))[0]
+
+def perqindja(vlerat: List[float], q: float) -> float:
+    if not vlerat:
+        return 0.0
+    return vlerat[min(len(vlerat) - 1, int(round(q * (len(vlerat) - 1))))]
+
+class Matjet:
+    def __init__(self):
+        self.kohet: Dict[str, List[float]] = {}
+        self.gabimet: Dict[str, Dict[str, int]] = {}
+        self.fillimi = 0.0     # time.monotonic(); kërkesat që mbarojnë gjatë ngrohjes nuk numërohen
+
+    def shto(self, operacioni: str, ms: float, gabimi: Optional[str] = None):
+        if time.monotonic() < self.fillimi:
+            return
+        if gabimi is None:
+            self.kohet.setdefault(operacioni, []).append(ms)
+        else:
+            g = self.gabimet.setdefault(operacioni, {})
+            g[gabimi] = g.get(gabimi, 0) + 1
+
+    def raporti(self, kohezgjatja_s: float) -> Dict[str, dict]:
+        r = {}
+        for op in sorted(set(self.kohet) | set(self.gabimet)):
+            v = sorted(self.kohet.get(op, []))
+            gabime = sum(self.gabimet.get(op, {}).values())
+            r[op] = {
+                "n": len(v) + gabime,
+                "gabime": gabime,
+                "gabimet": self.gabimet.get(op, {}),
+                "rps": round((len(v) + gabime) / kohezgjatja_s, 2),
+                "p50_ms": round(perqindja(v, 0.50), 1),
+                "p95_ms": round(perqindja(v, 0.95), 1),
+                "p99_ms": round(perqindja(v, 0.99), 1),
+                "max_ms": round(v[-1], 1) if v else 0.0,
+            }
+        return r
+
+class Ngarkesa:
+    def __init__(self, klienti: httpx.AsyncClient, matjet: Matjet, korpusi: Dict[str, List[str]],
+                 pajisjet: int, wav: bytes, peshat_intent: Dict[str, float]):
+        self.klienti = klienti
+        self.matjet = matjet
+        self.korpusi = korpusi
+        self.pajisjet = [f"bench_{i:04d}" for i in range(pajisjet)]
+        self.wav = wav
+        self.peshat_intent = {k: v for k, v in peshat_intent.items() if k in korpusi}
+
+    async def _mat(self, operacioni: str, fillimi: float, thirrja) -> Optional[httpx.Response]:
+        try:
+            r = await thirrja()
+        except httpx.HTTPError as e:
+            self.matjet.shto(operacioni, 0, type(e).__name__)
+            return None
+        ms = 1000 * (time.perf_counter() - fillimi)
+        if r.status_code >= 400:
+            self.matjet.shto(operacioni, ms, str(r.status_code))
+            return None
+        self.matjet.shto(operacioni, ms)
+        return r
+
+    async def _audio(self, device_id: str, request_id: Optional[str]):
+        """Si pajisja: shkarko zërin (rrjedh ndërsa sintetizohet), pastaj liro regjistrimin"""
+        if not request_id:
+            return
+        params = {"device_id": device_id, "request_id": request_id}
+        fillimi = time.perf_counter()
+
+        async def merr():
+            async with self.klienti.stream("GET", "/get_audio", params=params) as r:
+                async for _ in r.aiter_bytes():
+                    pass
+                return r
+        await self._mat("get_audio", fillimi, merr)
+        await self._mat("done", time.perf_counter(), lambda: self.klienti.post("/done", params=params))
+
+    async def ask(self, device_id: str, fillimi: float):
+        intenti = _zgjidh(self.peshat_intent)
+        teksti = random.choice(self.korpusi[intenti])
+        r = await self._mat(f"ask:{intenti}", fillimi,
+                            lambda: self.klienti.post("/ask", json={"text": teksti, "device_id": device_id}))
+        if r is not None:
+            await self._audio(device_id, r.json().get("request_id"))
+
+    async def ask_stream(self, device_id: str, fillimi: float):
+        teksti = random.choice(self.korpusi.get("ai") or sum(self.korpusi.values(), []))
+        e_para: List[float] = []
+
+        async def rrjedha():
+            async with self.klienti.stream("POST", "/ask/stream", json={"text": teksti, "device_id": device_id}) as r:
+                async for _ in r.aiter_bytes():
+                    if not e_para:
+                        e_para.append(time.perf_counter())
+                return r
+        r = await self._mat("ask_stream", fillimi, rrjedha)
+        if r is not None and e_para:
+            self.matjet.shto("ask_stream:byte_i_pare", 1000 * (e_para[0] - fillimi))
+
+    async def transcribe(self, device_id: str, fillimi: float):
+        await self._mat("transcribe", fillimi, lambda: self.klienti.post(
+            "/transcribe", content=self.wav, headers={"Content-Type": "audio/wav"}))
+
+    async def voice(self, device_id: str, fillimi: float):
+        async def zeri():
+            async with self.klienti.stream("POST", "/voice", params={"device_id": device_id},
+                                           content=self.wav, headers={"Content-Type": "audio/wav"}) as r:
+                async for _ in r.aiter_bytes():
+                    pass
+                return r
+        await self._mat("voice", fillimi, zeri)
+
+    async def regjistro(self, device_id: str, fillimi: float):
+        r = await self._mat("regjistro", fillimi, lambda: self.klienti.post("/regjistro", json={
+            "device_id": device_id, "emri": random.choice(EMRAT), "qyteti": random.choice(QYTETET)}))
+        if r is not None:
+            await self._audio(device_id, r.json().get("request_id"))
+
+    async def nje(self, operacioni: str, fillimi: float):
+        await getattr(self, operacioni)(random.choice(self.pajisjet), fillimi)
+
+async def _prit_gati(url: str, proceset: List[subprocess.Popen], afati_s: float = 30):
+    fundi = time.monotonic() + afati_s
+    async with httpx.AsyncClient() as k:
+        while time.monotonic() < fundi:
+            for p in proceset:
+                if p.poll() is not None:
+                    raise SystemExit(f"Procesi {p.args} doli me kodin {p.returncode}")
+            try:
+                if (await k.get(url, timeout=1)).status_code < 500:
+                    return
+            except httpx.HTTPError:
+                pass
+            await asyncio.sleep(0.2)
+    raise SystemExit(f"{url} nuk u përgjigj brenda {afati_s:.0f}s")
+
+def nis_proceset(args) -> Tuple[str, List[subprocess.Popen], Optional[int]]:
+    porti_mock, porti_serverit = _port_i_lire(), _port_i_lire()
+    baza_mock = f"http://127.0.0.1:{porti_mock}"
+    komanda_mock = [sys.executable, os.path.join(DOSJA, "mock_upstreams.py"), "--port", str(porti_mock)]
+    for emri in ("vonesa", "gabime", "kodi", "bishti"):
+        for v in getattr(args, emri) or []:
+            komanda_mock += [f"--{emri}", v]
+    if args.pa_info is not None:
+        komanda_mock += ["--pa-info", str(args.pa_info)]
+
+    mjedisi = {**os.environ, **mjedisi_per_serverin(baza_mock),
+               "LUNA_TTS_PREWARM": "0", "PYTHONUNBUFFERED": "1"}
+    mock = subprocess.Popen(komanda_mock, cwd=RRENJA, env=mjedisi)
+    serveri = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1",
+         "--port", str(porti_serverit), "--log-level", "warning", "--no-access-log"],
+        cwd=RRENJA, env=mjedisi,
+    )
+    return f"http://127.0.0.1:{porti_serverit}", [mock, serveri], serveri.pid
+
+async def ekzekuto(args) -> dict:
+    proceset: List[subprocess.Popen] = []
+    pid = None
+    url = args.server
+    if url is None:
+        url, proceset, pid = nis_proceset(args)
+    try:
+        await _prit_gati(url + "/health", proceset)
+        korpusi = lexo_korpusin()
+        perzierja = _peshat(args.perzierja)
+        matjet = Matjet()
+        limitet = httpx.Limits(max_connections=args.paralel * 2, max_keepalive_connections=args.paralel * 2)
+        headers = {"X-Luna-Deadline-Ms": str(args.afati_ms)} if args.afati_ms else {}
+        async with httpx.AsyncClient(base_url=url, timeout=args.timeout, limits=limitet, headers=headers) as klienti:
+            ngarkesa = Ngarkesa(klienti, matjet, korpusi, args.pajisje, wav_prove(), PESHAT_INTENT)
+
+            rss: List[Tuple[float, int]] = []
+            fillimi = time.monotonic()
+            fillimi_matjes = fillimi + args.ngrohje
+            fundi = fillimi_matjes + args.kohezgjatja
+            matjet.fillimi = fillimi_matjes
+
+            async def mostro_rss():
+                while pid is not None and time.monotonic() < fundi:
+                    if time.monotonic() >= fillimi_matjes:
+                        kb = _rss_kb(pid)
+                        if kb is not None:
+                            rss.append((time.monotonic() - fillimi_matjes, kb))
+                    await asyncio.sleep(1)
+
+            async def punetori():
+                while time.monotonic() < fundi:
+                    await ngarkesa.nje(_zgjidh(perzierja), time.perf_counter())
+
+            async def me_ritem():
+                # Ritëm fiks: kërkesa nisen në kohën e planifikuar, kufizuar nga --paralel
+                kufiri = asyncio.Semaphore(args.paralel)
+                detyrat = set()
+                intervali = 1.0 / args.rps
+                planifikuar = time.perf_counter()
+                while time.monotonic() < fundi:
+                    koha = planifikuar
+
+                    async def nje(koha=koha):
+                        async with kufiri:
+                            await ngarkesa.nje(_zgjidh(perzierja), koha)
+                    d = asyncio.create_task(nje())
+                    detyrat.add(d)
+                    d.add_done_callback(detyrat.discard)
+                    planifikuar += intervali
+                    await asyncio.sleep(max(0.0, planifikuar - time.perf_counter()))
+                if detyrat:
+                    await asyncio.wait(detyrat, timeout=args.timeout)
+
+            monitori = asyncio.create_task(mostro_rss())
+            if args.rps:
+                await me_ritem()
+            else:
+                await asyncio.gather(*(punetori() for _ in range(args.paralel)))
+            monitori.cancel()
+            kohezgjatja = max(0.001, time.monotonic() - fillimi_matjes)
+
+            try:
+                shendeti = (await klienti.get("/health")).json()
+            except (httpx.HTTPError, ValueError):
+                shendeti = {}
+
+        operacionet = matjet.raporti(kohezgjatja)
+        gjithsej = sum(o["n"] for n, o in operacionet.items() if ":byte_i_pare" not in n)
+        memoria = None
+        if rss:
+            memoria = {
+                "rss_fillim_mb": round(rss[0][1] / 1024, 1),
+                "rss_fund_mb": round(rss[-1][1] / 1024, 1),
+                "rss_max_mb": round(max(kb for _, kb in rss) / 1024, 1),
+                "rritja_mb": round((rss[-1][1] - rss[0][1]) / 1024, 1),
+                "rritja_mb_per_min": round(60 * (rss[-1][1] - rss[0][1]) / 1024 / max(1.0, rss[-1][0] - rss[0][0]), 2),
+            }
+        return {
+            "konfigurimi": {"paralel": args.paralel, "rps": args.rps, "kohezgjatja_s": args.kohezgjatja,
+                            "pajisje": args.pajisje, "perzierja": perzierja, "server": url},
+            "kohezgjatja_s": round(kohezgjatja, 2),
+            "rps": round(gjithsej / kohezgjatja, 2),
+            "operacionet": operacionet,
+            "memoria": memoria,
+            "radhet": shendeti.get("radhet"),
+            "cache_pergjigjeve": shendeti.get("cache_pergjigjeve"),
+            "modelet": shendeti.get("modelet"),
+            "parashikimi_kerkimit": shendeti.get("parashikimi_kerkimit"),
+        }
+    finally:
+        for p in reversed(proceset):
+            p.terminate()
+        for p in proceset:
+            try:
+                p.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                p.kill()
+
+def shtyp(r: dict):
+    print(f"\n{r['kohezgjatja_s']:.0f}s, {r['rps']:.1f} kërkesa/s "
+          f"(paralel={r['konfigurimi']['paralel']}, rps={r['konfigurimi']['rps'] or '-'})\n")
+    print(f"{'operacioni':<26}{'n':>7}{'gabime':>8}{'rps':>8}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}  (ms)")
+    for emri, o in r["operacionet"].items():
+        print(f"{emri:<26}{o['n']:>7}{o['gabime']:>8}{o['rps']:>8.1f}"
+              f"{o['p50_ms']:>9.0f}{o['p95_ms']:>9.0f}{o['p99_ms']:>9.0f}{o['max_ms']:>9.0f}"
+              + (f"  {o['gabimet']}" if o["gabimet"] else ""))
+    c = r.get("cache_pergjigjeve")
+    if c:
+        print(f"\nCache i përgjigjeve: {c['hit']} hit / {c['miss']} miss (hit rate {c['hit_rate']:.0%}), "
+              f"{c['jashte']} pyetje jashtë cache-it, {c.get('me_kontekst', 0)} me kontekst bisede")
+    p = r.get("parashikimi_kerkimit")
+    if p and p["pyetje"]:
+        print(f"Parashikimi i kërkimit: saktësia {p['saktesia']}, precision {p['precision']}, recall {p['recall']} "
+              f"(vp {p['vp']} fp {p['fp']} vn {p['vn']} fn {p['fn']}); {p['paralel']} paralel ({p.get('anuluar', 0)} anuluar), "
+              f"{p['injektuar']} injektuar, {p['kampion']} kampion pa web, "
+              f"{p['thirrje_llm_kursyer']} thirrje LLM të kursyera (të matura), "
+              f"{p['kohe_kursyer_ms'] / 1000:.1f}s kërkim i mbuluar")
+    for emri, mod in (r.get("modelet") or {}).items():
+        print(f"Modeli {emri}: {mod['thirrje']} thirrje, {mod['gabime']} gabime, "
+              f"{mod['fitore_si_rezerve']} fitore si rezervë, p50 {mod['p50_ms']} ms, siguresa {mod['siguresa']}")
+    m = r["memoria"]
+    if m:
+        print(f"\nRSS: {m['rss_fillim_mb']} -> {m['rss_fund_mb']} MB (max {m['rss_max_mb']}), "
+              f"rritja {m['rritja_mb']:+} MB ({m['rritja_mb_per_min']:+} MB/min)")
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--server", help="URL i një serveri të nisur; pa të niset serveri me stand-in-et")
+    ap.add_argument("--paralel", type=int, default=16, help="kërkesa njëkohësisht (ose kufiri me --rps)")
+    ap.add_argument("--rps", type=float, default=0, help="ritëm fiks kërkesash/s (0 = punëtorë të mbyllur)")
+    ap.add_argument("--kohezgjatja", type=float, default=30, help="sekonda matjeje")
+    ap.add_argument("--ngrohje", type=float, default=3, help="sekonda në fillim që nuk maten")
+    ap.add_argument("--pajisje", type=int, default=200)
+    ap.add_argument("--perzierja", default=PERZIERJA)
+    ap.add_argument("--timeout", type=float, default=60)
+    ap.add_argument("--afati-ms", type=int, help="dërgohet si X-Luna-Deadline-Ms në çdo kërkesë")
+    ap.add_argument("--vonesa", action="append", metavar="SHERBIMI=S", help="kalon te mock_upstreams.py")
+    ap.add_argument("--gabime", action="append", metavar="SHERBIMI=P", help="kalon te mock_upstreams.py")
+    ap.add_argument("--kodi", action="append", metavar="SHERBIMI=KODI", help="kalon te mock_upstreams.py")
+    ap.add_argument("--bishti", action="append", metavar="SHERBIMI=P", help="kalon te mock_upstreams.py")
+    ap.add_argument("--pa-info", type=float, default=None, help="sa shpesh LLM-ja e rreme nuk di (kërkim web)")
+    ap.add_argument("--json", help="ruaj rezultatin edhe si JSON")
+    ap.add_argument("--max-p95-ms", type=float, help="kod dalje 1 nëse ndonjë operacion e kalon")
+    ap.add_argument("--max-gabime", type=float, help="kod dalje 1 nëse pjesa e gabimeve e kalon (0-1)")
+    args = ap.parse_args()
+
+    r = asyncio.run(ekzekuto(args))
+    shtyp(r)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(r, f, ensure_ascii=False, indent=2)
+
+    deshtime = []
+    for emri, o in r["operacionet"].items():
+        if args.max_p95_ms is not None and o["p95_ms"] > args.max_p95_ms:
+            deshtime.append(f"{emri}: p95 {o['p95_ms']:.0f} ms > {args.max_p95_ms:.0f} ms")
+        if args.max_gabime is not None and o["n"] and o["gabime"] / o["n"] > args.max_gabime:
+            deshtime.append(f"{emri}: gabime {o['gabime']}/{o['n']}")
+    for d in deshtime:
+        print(f"KALON KUFIRIN: {d}")
+    sys.exit(1 if deshtime else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,286 @@
+"""Stand-in lokal për shërbimet e jashtme, për prova pa çelësa API dhe pa rrjet.
+
+    python bench/mock_upstreams.py [--port 8900] [--teksti "sa është ora"]
+                                   [--vonesa groq=0.4] [--gabime groq=0.05] [--pa-info 0.2]
+
+Pastaj nis serverin me URL-të që kthen `mjedisi_per_serverin()`, p.sh.:
+
+    LUNA_URL_GROQ=http://127.0.0.1:8900/openai/v1 LUNA_TTS_BACKEND=http uvicorn server:app
+
+Çdo shërbim (groq, groq_vogel për modelet e vogla, whisper, weather, nominatim, osrm,
+ddg, wiki, tts) ka vonesën, luhatjen, bishtin e ngadaltë dhe shkallën e gabimeve të veta; ndryshohen edhe gjatë punës me
+POST /konfigurimi {"groq": {"vonesa_s": 1.0, "gabime": 0.1}}.
+
+Whisper-i i rremë kthen `--teksti` dhe mban shënim sa bytes/sekonda audio ka
+marrë, që të shihet efekti i kompaktimit te GET /statistika.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import sys
+import time
+import wave
+from typing import AsyncIterator, Dict, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.requests import ClientDisconnect
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+app = FastAPI()
+
+KONFIGURIMI = {
+    "teksti": "Sa është ora?",
+    "vonesa_baze_s": 0.15,           # kohë fikse për çdo transkriptim
+    "vonesa_per_mb_s": 0.4,          # ngarkimi dhe dekodimi rriten me madhësinë
+    "pa_info": 0.15,                 # sa shpesh LLM-ja "nuk di" dhe serveri shkon te kërkimi web
+    # Pyetjet me këto fjalë refuzohen gjithmonë pa informacion web - si një model me njohuri të vjetra
+    "fjale_pa_info": ("president", "kryeministr", "kushton", "fitoi", "sot", "lajm", "banorë"),
+    "token_s": 0.01,                 # ritmi i tokenave në stream
+    "tts_bytes_per_shkronje": 180,   # ~ MP3 24 kHz mono
+    "tts_copa_s": 0.02,              # pauza mes copave të MP3
+}
+
+# vonesa_s = koha deri te përgjigja (ose te byte-i i parë për stream-et), luhatja_s = ±,
+# gabime = probabiliteti që kërkesa të kthejë `kodi` (429 vjen me Retry-After),
+# bishti = probabiliteti që kërkesa të vonohet edhe bishti_s sekonda (për hedging)
+_PA_BISHT = {"bishti": 0.0, "bishti_s": 3.0}
+PROFILET: Dict[str, Dict[str, float]] = {
+    "groq":        {"vonesa_s": 0.35, "luhatja_s": 0.15, "gabime": 0.0, "kodi": 429, **_PA_BISHT},
+    "groq_vogel":  {"vonesa_s": 0.12, "luhatja_s": 0.05, "gabime": 0.0, "kodi": 429, **_PA_BISHT},
+    "whisper":     {"vonesa_s": 0.0,  "luhatja_s": 0.05, "gabime": 0.0, "kodi": 429, **_PA_BISHT},
+    "weather":     {"vonesa_s": 0.08, "luhatja_s": 0.04, "gabime": 0.0, "kodi": 500, **_PA_BISHT},
+    "nominatim":   {"vonesa_s": 0.12, "luhatja_s": 0.05, "gabime": 0.0, "kodi": 500, **_PA_BISHT},
+    "osrm":        {"vonesa_s": 0.06, "luhatja_s": 0.03, "gabime": 0.0, "kodi": 500, **_PA_BISHT},
+    "ddg":         {"vonesa_s": 0.25, "luhatja_s": 0.10, "gabime": 0.0, "kodi": 500, **_PA_BISHT},
+    "wiki":        {"vonesa_s": 0.15, "luhatja_s": 0.05, "gabime": 0.0, "kodi": 500, **_PA_BISHT},
+    "tts":         {"vonesa_s": 0.15, "luhatja_s": 0.05, "gabime": 0.0, "kodi": 500, **_PA_BISHT},
+}
+
+STATISTIKA = {"transkriptime": 0, "bytes": 0, "sekonda_audio": 0.0, "formatet": {},
+              "kerkesa": {}, "gabime": {}}
+
+def mjedisi_per_serverin(baza: str) -> Dict[str, str]:
+    """Env-i që e drejton server.py te ky stand-in (baza p.sh. http://127.0.0.1:8900)"""
+    return {
+        "LUNA_URL_GROQ": f"{baza}/openai/v1",
+        "LUNA_URL_WEATHER": f"{baza}/weather/data/2.5",
+        "LUNA_URL_NOMINATIM": f"{baza}/nominatim",
+        "LUNA_URL_OSRM": f"{baza}/osrm",
+        "LUNA_URL_DDG": f"{baza}/ddg",
+        "LUNA_URL_WIKI_SQ": f"{baza}/wiki_sq/api/rest_v1",
+        "LUNA_URL_WIKI_EN": f"{baza}/wiki_en/api/rest_v1",
+        "LUNA_URL_TTS": baza,
+        "LUNA_TTS_BACKEND": "http",
+        "LUNA_AI": "bench",
+        "Luna_weather": "bench",
+        "LUNA_NOMINATIM_RITMI": "1000",
+    }
+
+async def _vonesa(emri: str, shtese_s: float = 0.0) -> Optional[Response]:
+    """Pret sipas profilit; kthen përgjigjen e gabimit nëse kjo kërkesë duhet të dështojë"""
+    p = PROFILET[emri]
+    STATISTIKA["kerkesa"][emri] = STATISTIKA["kerkesa"].get(emri, 0) + 1
+    kohe = max(0.0, p["vonesa_s"] + shtese_s + random.uniform(-p["luhatja_s"], p["luhatja_s"]))
+    if p["bishti"] and random.random() < p["bishti"]:
+        kohe += p["bishti_s"]
+    if p["gabime"] and random.random() < p["gabime"]:
+        STATISTIKA["gabime"][emri] = STATISTIKA["gabime"].get(emri, 0) + 1
+        # Gabimet zakonisht kthehen më shpejt se përgjigjet e mira
+        await asyncio.sleep(kohe / 4)
+        kodi = int(p["kodi"])
+        headers = {"Retry-After": "1"} if kodi == 429 else {}
+        return JSONResponse({"error": {"message": f"gabim i injektuar ({emri})"}},
+                            status_code=kodi, headers=headers)
+    await asyncio.sleep(kohe)
+    return None
+
+def _sekondat_wav(audio: bytes) -> float:
+    try:
+        with wave.open(io.BytesIO(audio)) as w:
+            return w.getnframes() / float(w.getframerate())
+    except (wave.Error, EOFError):
+        return 0.0
+
+@app.post("/openai/v1/audio/transcriptions")
+async def transkriptimet(request: Request):
+    try:
+        forma = await request.form()
+    except ClientDisconnect:
+        # Serveri e ndërpret ngarkimin kur audio kalon kufirin
+        return Response(status_code=499)
+    skedari = forma.get("file")
+    if skedari is None or not forma.get("model"):
+        return JSONResponse({"error": {"message": "file dhe model janë të detyrueshme"}}, status_code=400)
+    audio = await skedari.read()
+    # Importohet këtu që load_test.py të mund të marrë mjedisi_per_serverin() pa ngarkuar serverin
+    from server import njih_formatin
+    formati = njih_formatin(audio[:64])
+    if formati is None:
+        return JSONResponse({"error": {"message": "format i panjohur"}}, status_code=400)
+
+    gabimi = await _vonesa("whisper", KONFIGURIMI["vonesa_baze_s"] + KONFIGURIMI["vonesa_per_mb_s"] * len(audio) / 1e6)
+    if gabimi is not None:
+        return gabimi
+    STATISTIKA["transkriptime"] += 1
+    STATISTIKA["bytes"] += len(audio)
+    STATISTIKA["formatet"][formati[0]] = STATISTIKA["formatet"].get(formati[0], 0) + 1
+    if formati[0] == "audio/wav":
+        STATISTIKA["sekonda_audio"] += _sekondat_wav(audio)
+    return {"text": KONFIGURIMI["teksti"]}
+
+def _modeli_i_vogel(modeli: str) -> bool:
+    return "8b" in modeli or "instant" in modeli
+
+def _pergjigja_llm(mesazhet: list) -> str:
+    if mesazhet and "Përmbledh bisedën" in str(mesazhet[0].get("content", "")):
+        return "Përdoruesi pyeti për disa gjëra të përditshme dhe Luna u përgjigj shkurt."
+    me_web = any("nga interneti" in str(m.get("content", "")) for m in mesazhet)
+    pyetja = next((m["content"] for m in reversed(mesazhet) if m.get("role") == "user"), "")
+    i_fresket = any(f in str(pyetja).lower() for f in KONFIGURIMI["fjale_pa_info"])
+    if not me_web and (i_fresket or random.random() < KONFIGURIMI["pa_info"]):
+        return "Nuk kam informacion të freskët për këtë."
+    return (f"Për pyetjen \"{str(pyetja)[:60]}\", ja çfarë di. "
+            "Kjo është një përgjigje provë me dy fjali. Shpresoj të të ndihmojë!")
+
+async def _sse_chat(teksti: str) -> AsyncIterator[bytes]:
+    for fjala in teksti.split(" "):
+        copa = {"choices": [{"index": 0, "delta": {"content": fjala + " "}}]}
+        yield f"data: {json.dumps(copa, ensure_ascii=False)}\n\n".encode()
+        await asyncio.sleep(KONFIGURIMI["token_s"])
+    yield b"data: [DONE]\n\n"
+
+@app.post("/openai/v1/chat/completions")
+async def chat(request: Request):
+    trupi = await request.json()
+    gabimi = await _vonesa("groq_vogel" if _modeli_i_vogel(trupi.get("model", "")) else "groq")
+    if gabimi is not None:
+        return gabimi
+    mesazhet = trupi.get("messages", [])
+    teksti = _pergjigja_llm(mesazhet)
+    if trupi.get("stream"):
+        return StreamingResponse(_sse_chat(teksti), media_type="text/event-stream")
+    prompt = sum(len(str(m.get("content", ""))) for m in mesazhet) // 3
+    return {
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": teksti}}],
+        "usage": {"prompt_tokens": prompt, "completion_tokens": len(teksti) // 3,
+                  "prompt_tokens_details": {"cached_tokens": prompt // 2}},
+    }
+
+@app.get("/weather/data/2.5/weather")
+async def weather(q: str = ""):
+    gabimi = await _vonesa("weather")
+    if gabimi is not None:
+        return gabimi
+    return {
+        "cod": 200,
+        "main": {"temp": 18.4, "feels_like": 17.9, "temp_min": 15.0, "temp_max": 21.2, "humidity": 62},
+        "weather": [{"description": "qiell i kthjellët"}],
+        "wind": {"speed": 3.1},
+        "name": q.split(",")[0],
+    }
+
+@app.get("/nominatim/search")
+async def nominatim(q: str = ""):
+    gabimi = await _vonesa("nominatim")
+    if gabimi is not None:
+        return gabimi
+    # Koordinata të qëndrueshme për çdo emër, brenda Shqipërisë
+    h = abs(hash(q))
+    return [{"lat": str(40.0 + (h % 2000) / 1000), "lon": str(19.5 + (h // 2000 % 1500) / 1000)}]
+
+@app.get("/osrm/route/v1/driving/{koordinatat}")
+async def osrm(koordinatat: str):
+    gabimi = await _vonesa("osrm")
+    if gabimi is not None:
+        return gabimi
+    return {"code": "Ok", "routes": [{"distance": 98000.0 + len(koordinatat) * 100, "duration": 5400.0}]}
+
+@app.get("/ddg/")
+async def ddg(q: str = ""):
+    gabimi = await _vonesa("ddg")
+    if gabimi is not None:
+        return gabimi
+    return {"AbstractText": f"{q} është një temë e njohur; ky është një rezultat provë.",
+            "Answer": "", "RelatedTopics": [{"Text": f"Më shumë për {q}."}]}
+
+@app.get("/wiki_sq/api/rest_v1/page/summary/{titulli}")
+@app.get("/wiki_en/api/rest_v1/page/summary/{titulli}")
+async def wiki(titulli: str):
+    gabimi = await _vonesa("wiki")
+    if gabimi is not None:
+        return gabimi
+    return {"extract": f"{titulli} - përmbledhje provë nga Wikipedia."}
+
+async def _mp3_rreme(gjatesia: int) -> AsyncIterator[bytes]:
+    copa = 4096
+    dergoi = 0
+    while dergoi < gjatesia:
+        n = min(copa, gjatesia - dergoi)
+        yield b"\xff\xf3" + os.urandom(n - 2) if n > 2 else b"\xff" * n
+        dergoi += n
+        await asyncio.sleep(KONFIGURIMI["tts_copa_s"])
+
+@app.post("/tts")
+async def tts(request: Request):
+    trupi = await request.json()
+    gabimi = await _vonesa("tts")
+    if gabimi is not None:
+        return gabimi
+    gjatesia = max(1024, len(trupi.get("text", "")) * int(KONFIGURIMI["tts_bytes_per_shkronje"]))
+    return StreamingResponse(_mp3_rreme(gjatesia), media_type="audio/mpeg")
+
+@app.post("/konfigurimi")
+async def konfiguro(request: Request):
+    """Ndryshon profilet gjatë punës: {"groq": {"vonesa_s": 1.0}, "pa_info": 0.3}"""
+    ndryshimet = await request.json()
+    for celesi, vlera in ndryshimet.items():
+        if celesi in PROFILET and isinstance(vlera, dict):
+            PROFILET[celesi].update({k: float(v) for k, v in vlera.items() if k in PROFILET[celesi]})
+        elif celesi in KONFIGURIMI:
+            KONFIGURIMI[celesi] = type(KONFIGURIMI[celesi])(vlera)
+    return {"profilet": PROFILET, "konfigurimi": KONFIGURIMI}
+
+@app.get("/statistika")
+async def statistika():
+    return {**STATISTIKA, "koha": time.time()}
+
+def _cifte(vlerat, fusha: str):
+    """'groq=0.4' -> PROFILET['groq'][fusha] = 0.4; 'all=…' vlen për të gjitha"""
+    for v in vlerat or []:
+        emri, _, numri = v.partition("=")
+        emrat = list(PROFILET) if emri == "all" else [emri]
+        for e in emrat:
+            if e not in PROFILET:
+                raise SystemExit(f"Shërbim i panjohur: {e} (njihen: {', '.join(PROFILET)})")
+            PROFILET[e][fusha] = float(numri)
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8900)
+    ap.add_argument("--teksti", default=KONFIGURIMI["teksti"])
+    ap.add_argument("--vonesa", action="append", metavar="SHERBIMI=S", help="p.sh. groq=0.6 ose all=0")
+    ap.add_argument("--luhatja", action="append", metavar="SHERBIMI=S")
+    ap.add_argument("--gabime", action="append", metavar="SHERBIMI=P", help="p.sh. groq=0.05")
+    ap.add_argument("--kodi", action="append", metavar="SHERBIMI=KODI", help="p.sh. groq=503")
+    ap.add_argument("--bishti", action="append", metavar="SHERBIMI=P", help="p.sh. groq=0.05 (+bishti_s sekonda)")
+    ap.add_argument("--pa-info", type=float, default=KONFIGURIMI["pa_info"])
+    args = ap.parse_args()
+    KONFIGURIMI["teksti"] = args.teksti
+    KONFIGURIMI["pa_info"] = args.pa_info
+    _cifte(args.vonesa, "vonesa_s")
+    _cifte(args.luhatja, "luhatja_s")
+    _cifte(args.gabime, "gabime")
+    _cifte(args.kodi, "kodi")
+    _cifte(args.bishti, "bishti")
+
+    import uvicorn
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
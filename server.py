@@ -1,17 +1,35 @@
 import os
 import re
+import time
+import uuid
+import hashlib
+import json
+import base64
+import sqlite3
+import heapq
+import random
+import bisect
+import io
+import wave
+import warnings
+import unicodedata
 import asyncio
+import threading
+import concurrent.futures
 import httpx
-from fastapi import FastAPI, UploadFile, File, Response
+from fastapi import FastAPI, Request, Response, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, JSONResponse
 from pydantic import BaseModel
-from typing import Optional, Dict, List
+from typing import Optional, Dict, List, Tuple, AsyncIterator, Awaitable, Callable
+from email.utils import parsedate_to_datetime
+from collections import OrderedDict, deque
 from datetime import datetime, timedelta
 import pytz
 from urllib.parse import quote
-
-app = FastAPI()
-app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from functools import lru_cache
 
 # ─── API KEYS ────────────────────────────────────────────────
 GROQ_API_KEY    = os.getenv("LUNA_AI", "").strip()
@@ -19,12 +37,81 @@ WEATHER_API_KEY = os.getenv("Luna_weather", "").strip()
 TZ              = pytz.timezone("Europe/Tirane")
 
 # ─── STATE ───────────────────────────────────────────────────
-current_audio_data: bytes = b""
-audio_ready: bool = False
-bisedat: Dict[str, List[Dict]] = {}
-alarmet: List[Dict] = []
-timerat: List[Dict] = []
-perdoruesit: Dict[str, Dict] = {}
+# "memory" - gjithçka në procesin aktual (një worker)
+# "sqlite" - gjendje e përbashkët në një skedar SQLite (WAL) për `uvicorn --workers N`
+GJENDJA    = os.getenv("LUNA_STATE", "memory").strip().lower()
+GJENDJA_DB = os.getenv("LUNA_STATE_DB", "luna_state.db").strip()
+# Puna me SQLite bëhet në një thread të vetëm për proces; event loop-i nuk pret kurrë për bllokimin e skedarit
+SQLITE_BUSY_MS    = int(os.getenv("LUNA_SQLITE_BUSY_MS", "500"))       # pritja kur një worker tjetër po shkruan
+SQLITE_PASTRIMI_S = float(os.getenv("LUNA_SQLITE_PASTRIMI_S", "5"))    # pastrimi dhe statistikat, jo në çdo kërkesë
+
+# ─── KLIENTËT HTTP ───────────────────────────────────────────
+# Një klient i përhershëm (me pool lidhjesh dhe keep-alive) për çdo shërbim
+# të jashtëm, që thirrjet të ripërdorin lidhjet e ngrohta pa TLS handshake të ri.
+HTTP_MAX_CONN      = int(os.getenv("LUNA_HTTP_MAX_CONN", "50"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("LUNA_HTTP_MAX_KEEPALIVE", "20"))
+HTTP_KEEPALIVE_S   = float(os.getenv("LUNA_HTTP_KEEPALIVE_S", "60"))
+HTTP2_AKTIV        = os.getenv("LUNA_HTTP2", "1") != "0"
+
+UPSTREAMS: Dict[str, Dict] = {
+    "groq":      {"base_url": "https://api.groq.com/openai/v1",           "timeout": 30, "http2": True},
+    "weather":   {"base_url": "https://api.openweathermap.org/data/2.5",  "timeout": 8,  "http2": False},
+    "nominatim": {"base_url": "https://nominatim.openstreetmap.org",      "timeout": 15, "http2": True},
+    "osrm":      {"base_url": "https://router.project-osrm.org",          "timeout": 15, "http2": False},
+    "ddg":       {"base_url": "https://api.duckduckgo.com",               "timeout": 10, "http2": True},
+    "wiki_sq":   {"base_url": "https://sq.wikipedia.org/api/rest_v1",     "timeout": 10, "http2": True},
+    "wiki_en":   {"base_url": "https://en.wikipedia.org/api/rest_v1",     "timeout": 10, "http2": True},
+    # Përdoret vetëm me LUNA_TTS_BACKEND=http (p.sh. stand-in-i te bench/mock_upstreams.py)
+    "tts":       {"base_url": "http://127.0.0.1:8900",                     "timeout": 30, "http2": False},
+}
+
+KLIENTET: Dict[str, httpx.AsyncClient] = {}
+
+# ─── METRIKAT ────────────────────────────────────────────────
+KERKESE_NGADALE_MS = float(os.getenv("LUNA_KERKESE_NGADALE_MS", "0"))   # 0 = pa log për kërkesat e ngadalta
+
+# ─── RADHËT ──────────────────────────────────────────────────
+# Sa thirrje njëkohësisht lejohen drejt çdo shërbimi dhe sa kërkesa mund të presin
+# në radhë; kur radha mbushet, kërkesa refuzohet menjëherë me 503 + Retry-After.
+RADHET: Dict[str, Dict] = {
+    "llm":     {"paralel": 8,  "thellesi": 32},
+    "tts":     {"paralel": 12, "thellesi": 64},
+    "whisper": {"paralel": 4,  "thellesi": 16},
+    "web":     {"paralel": 16, "thellesi": 64},   # kërkimi në web, moti, gjeokodimi, OSRM
+}
+RADHE_PRITJE_MAX_S = float(os.getenv("LUNA_RADHE_PRITJE_MAX_S", "10"))
+RIPROVIME_MAX      = int(os.getenv("LUNA_RIPROVIME_MAX", "2"))      # pas 429/503 nga shërbimi
+RIPROVIM_BAZA_S    = float(os.getenv("LUNA_RIPROVIM_BAZA_S", "0.5"))
+RIPROVIM_MAX_S     = float(os.getenv("LUNA_RIPROVIM_MAX_S", "8"))   # Retry-After më i gjatë = heqim dorë
+
+# ─── LLM ─────────────────────────────────────────────────────
+# Kthesat e shkurtra dhe të thjeshta shkojnë te modeli i shpejtë, të tjerat dhe ato me
+# kërkim web te i madhi; secili është rezervë për tjetrin, pastaj LUNA_MODELET_REZERVE
+MODELI_I_MADH     = os.getenv("LUNA_MODELI_I_MADH", "llama-3.3-70b-versatile").strip()
+MODELI_I_SHPEJTE  = os.getenv("LUNA_MODELI_I_SHPEJTE", "llama-3.1-8b-instant").strip()
+MODELET_REZERVE   = [m.strip() for m in os.getenv("LUNA_MODELET_REZERVE", "").split(",") if m.strip()]
+ROUTER_AKTIV      = os.getenv("LUNA_ROUTER", "1") != "0"          # 0 = gjithmonë modeli i madh
+KTHESE_E_SHKURTER_FJALE = int(os.getenv("LUNA_KTHESE_E_SHKURTER_FJALE", "8"))
+HEDGE_PERQINDJA   = float(os.getenv("LUNA_HEDGE_PERQINDJA", "0.95"))  # 0 = pa hedging
+HEDGE_MIN_S       = float(os.getenv("LUNA_HEDGE_MIN_S", "0.8"))
+HEDGE_FILLESTAR_S = float(os.getenv("LUNA_HEDGE_FILLESTAR_S", "4"))   # derisa të ketë mjaft matje
+SIGURESA_GABIME   = int(os.getenv("LUNA_SIGURESA_GABIME", "5"))       # gabime radhazi para se modeli të pushohet
+SIGURESA_PAUZE_S  = float(os.getenv("LUNA_SIGURESA_PAUZE_S", "30"))
+
+# ─── AUDIO ───────────────────────────────────────────────────
+AUDIO_MAX_BYTES = int(os.getenv("LUNA_AUDIO_MAX_BYTES", str(32 * 1024 * 1024)))
+AUDIO_TTL_S     = float(os.getenv("LUNA_AUDIO_TTL_S", "300"))
+
+# ─── TTS ─────────────────────────────────────────────────────
+TTS_ZERI        = "sq-AL-AlbaNeural"
+TTS_SHPEJTESIA  = "+5%"
+TTS_VOLUMI      = "+10%"
+TTS_CACHE_MAX_BYTES      = int(os.getenv("LUNA_TTS_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+TTS_CACHE_DIR            = os.getenv("LUNA_TTS_CACHE_DIR", "").strip()
+TTS_CACHE_DISK_MAX_BYTES = int(os.getenv("LUNA_TTS_CACHE_DISK_MAX_BYTES", str(512 * 1024 * 1024)))
+TTS_PREWARM              = os.getenv("LUNA_TTS_PREWARM", "1") != "0"   # vetëm me LUNA_TTS_CACHE_DIR
+TTS_PREWARM_PARALEL      = int(os.getenv("LUNA_TTS_PREWARM_PARALEL", "4"))
+TTS_BACKEND              = os.getenv("LUNA_TTS_BACKEND", "edge").strip().lower()   # "edge" ose "http"
 
 # ─── MODELET ─────────────────────────────────────────────────
 class AskBody(BaseModel):
@@ -52,6 +139,114 @@ QYTETET_MAP = {
     "gjirokaster": "Gjirokastër",
 }
 
+# Koordinatat (lat, lon) e qyteteve të njohura - rrugët mes tyre s'kanë nevojë për gjeokodim
+KOORDINATAT = {
+    "Tirana":      (41.3275, 19.8187),
+    "Shkodër":     (42.0683, 19.5126),
+    "Durrës":      (41.3231, 19.4414),
+    "Vlorë":       (40.4661, 19.4914),
+    "Korçë":       (40.6186, 20.7808),
+    "Elbasan":     (41.1125, 20.0822),
+    "Fier":        (40.7239, 19.5561),
+    "Berat":       (40.7058, 19.9522),
+    "Lushnjë":     (40.9419, 19.7050),
+    "Kavajë":      (41.1856, 19.5569),
+    "Pogradec":    (40.9025, 20.6525),
+    "Lezhë":       (41.7836, 19.6436),
+    "Kukës":       (42.0769, 20.4219),
+    "Sarandë":     (39.8756, 20.0053),
+    "Gjirokastër": (40.0758, 20.1389),
+}
+
+# ─── MOTI ────────────────────────────────────────────────────
+MOT_TTL_S     = float(os.getenv("LUNA_MOT_TTL_S", "600"))
+MOT_REFRESH_S = float(os.getenv("LUNA_MOT_REFRESH_S", "0"))   # 0 = pa rifreskim në sfond
+
+# ─── RRUGËT ──────────────────────────────────────────────────
+RRUGET_SKEDAR       = os.getenv("LUNA_RRUGET_SKEDAR", "").strip()   # bosh = vetëm në memorie
+RRUGET_CACHE_MAX    = int(os.getenv("LUNA_RRUGET_CACHE_MAX", "1024"))
+NOMINATIM_RITMI     = float(os.getenv("LUNA_NOMINATIM_RITMI", "1"))  # kërkesa/sekondë
+
+# ─── KËRKIMI NË WEB ──────────────────────────────────────────
+WEB_GRACE_S       = float(os.getenv("LUNA_WEB_GRACE_S", "0.3"))
+WEB_TTL_S         = float(os.getenv("LUNA_WEB_TTL_S", "3600"))
+WEB_TTL_BOSH_S    = float(os.getenv("LUNA_WEB_TTL_BOSH_S", "300"))
+WEB_CACHE_MAX     = int(os.getenv("LUNA_WEB_CACHE_MAX", "512"))
+
+# ─── PARASHIKIMI I KËRKIMIT ──────────────────────────────────
+# Pyetjet që me gjasë duan informacion të freskët nuk presin refuzimin e AI-së për të kërkuar
+PARASHIKIM_AKTIV          = os.getenv("LUNA_PARASHIKIM", "1") != "0"
+PARASHIKIM_PRAGU          = float(os.getenv("LUNA_PARASHIKIM_PRAGU", "0.5"))            # kërkimi nis paralel me AI-në
+PARASHIKIM_PRAGU_INJEKTIM = float(os.getenv("LUNA_PARASHIKIM_PRAGU_INJEKTIM", "0.8"))   # një thirrje e vetme me rezultatin
+PARASHIKIM_HISTORIA_MAX   = int(os.getenv("LUNA_PARASHIKIM_HISTORIA_MAX", "4096"))
+PARASHIKIM_KAMPION        = float(os.getenv("LUNA_PARASHIKIM_KAMPION", "0.1"))   # pjesa e injektimeve që matet pa web
+
+# ─── CACHE I PËRGJIGJEVE ─────────────────────────────────────
+# Vetëm pyetje faktike të përgjithshme ("sa banorë ka Shqipëria"), jo personale apo që varen nga biseda
+PERGJIGJE_CACHE       = os.getenv("LUNA_PERGJIGJE_CACHE", "1") != "0"
+PERGJIGJE_CACHE_TTL_S = float(os.getenv("LUNA_PERGJIGJE_CACHE_TTL_S", str(6 * 3600)))
+PERGJIGJE_CACHE_MAX   = int(os.getenv("LUNA_PERGJIGJE_CACHE_MAX", "2048"))
+PERGJIGJE_CACHE_MIN_FJALE = int(os.getenv("LUNA_PERGJIGJE_CACHE_MIN_FJALE", "1"))   # fjalë me përmbajtje, pa ato pyetëse
+
+# ─── BISEDAT ─────────────────────────────────────────────────
+BISEDA_MAX_PAJISJE  = int(os.getenv("LUNA_BISEDA_MAX_PAJISJE", "5000"))
+BISEDA_MAX_BYTES    = int(os.getenv("LUNA_BISEDA_MAX_BYTES", str(64 * 1024 * 1024)))
+BISEDA_MAX_MESAZHE  = int(os.getenv("LUNA_BISEDA_MAX_MESAZHE", "20"))
+BISEDA_BUXHETI_TOKENA = int(os.getenv("LUNA_BISEDA_BUXHETI_TOKENA", "1200"))   # historia që i dërgohet modelit
+# Kthesat që dalin nga buxheti përmblidhen në sfond me një model të vogël, në vend që të humbasin
+BISEDA_PERMBLEDHJE  = os.getenv("LUNA_BISEDA_PERMBLEDHJE", "1") != "0"
+PERMBLEDHJE_MODELI  = os.getenv("LUNA_PERMBLEDHJE_MODELI", "llama-3.1-8b-instant")
+PERMBLEDHJE_MIN_KTHESA = 4
+PERMBLEDHJE_MAX_KTHESA = 40     # nëse përmbledhja dështon vazhdimisht, më të vjetrat hidhen
+BISEDA_TTL_S        = float(os.getenv("LUNA_BISEDA_TTL_S", str(6 * 3600)))
+BISEDA_SQLITE       = os.getenv("LUNA_BISEDA_SQLITE", "").strip()   # bosh = pa nivel në disk
+BISEDA_SQLITE_TTL_S = float(os.getenv("LUNA_BISEDA_SQLITE_TTL_S", str(7 * 86400)))
+PERDORUES_MAX       = int(os.getenv("LUNA_PERDORUES_MAX", "200000"))  # pa LUNA_BISEDA_SQLITE të dëbuarit humbasin
+
+# ─── ALARMET ─────────────────────────────────────────────────
+ALARM_MBAJ_S = float(os.getenv("LUNA_ALARM_MBAJ_S", "3600"))   # sa mbahet një alarm pasi ka rënë
+
+# ─── KANALI PUSH ─────────────────────────────────────────────
+PUSH_MAX_NGJARJE = int(os.getenv("LUNA_PUSH_MAX_NGJARJE", "50"))   # për pajisje
+PUSH_MAX_PAJISJE = int(os.getenv("LUNA_PUSH_MAX_PAJISJE", "5000"))
+PUSH_TTL_S       = float(os.getenv("LUNA_PUSH_TTL_S", "300"))
+PUSH_PRITJE_MAX_S = float(os.getenv("LUNA_PUSH_PRITJE_MAX_S", "30"))
+
+# ─── TRANSKRIPTIMI ───────────────────────────────────────────
+WHISPER_MODELI           = "whisper-large-v3"
+TRANSKRIPTIM_MAX_BYTES   = int(os.getenv("LUNA_TRANSKRIPTIM_MAX_BYTES", str(10 * 1024 * 1024)))
+TRANSKRIPTIM_MAX_S       = float(os.getenv("LUNA_TRANSKRIPTIM_MAX_S", "60"))   # kontrollohet kur formati e tregon (WAV)
+TRANSKRIPTIM_KOMPAKTO    = os.getenv("LUNA_TRANSKRIPTIM_KOMPAKTO", "1") != "0"
+TRANSKRIPTIM_HESHTJA_RMS = int(os.getenv("LUNA_TRANSKRIPTIM_HESHTJA_RMS", "300"))
+TRANSKRIPTIM_MBUSHJE_MS  = 200      # heshtje që lihet para dhe pas zërit
+TRANSKRIPTIM_SHPEJTESIA  = 16000    # Whisper punon në 16 kHz mono
+
+# ─── STREAMING ───────────────────────────────────────────────
+FJALI_MIN_GJATESI = int(os.getenv("LUNA_FJALI_MIN_GJATESI", "12"))
+# /voice: teksti në headers (percent-encoded) shkurtohet që të mos kalojë kufijtë e proxy-ve dhe ESP32
+VOICE_HEADER_MAX  = int(os.getenv("LUNA_VOICE_HEADER_MAX", "1024"))
+
+# ─── AFATET ──────────────────────────────────────────────────
+# Një buxhet kohe për gjithë kërkesën (deri te teksti i përgjigjes), jo timeout-e që mblidhen
+AFATI_S            = float(os.getenv("LUNA_AFATI_S", "12"))
+AFATI_MIN_S        = 0.5
+AFATI_MAX_S        = float(os.getenv("LUNA_AFATI_MAX_S", "30"))        # kufiri për header-in X-Luna-Deadline-Ms
+AFATI_MIN_WEB_S    = float(os.getenv("LUNA_AFATI_MIN_WEB_S", "3"))     # më pak kohë e mbetur = pa kërkim web
+AFATI_REZERVE_AI_S = float(os.getenv("LUNA_AFATI_REZERVE_AI_S", "1.5"))  # lihet për thirrjen pas kërkimit web
+AFATI_TTS_S        = float(os.getenv("LUNA_AFATI_TTS_S", "20"))        # për çdo sintezë, pavarësisht tekstit
+
+# ─── FRAZAT FIKSE ────────────────────────────────────────────
+FRAZA_NDIHME_MENDORE = (
+    "Kuptoj që po kalon momente shumë të vështira dhe jam këtu me ty. "
+    "Çfarë po ndjen tani? Dëshiroj të dëgjoj. "
+    "Nëse ke nevojë urgjente për ndihmë, linja e krizës në Shqipëri është 0800 1212 - falas, 24 orë."
+)
+FRAZA_ALARM_SHEMBULL = "Më thuaj orën e saktë, për shembull: vendos alarm në 07:30."
+FRAZA_TIMER_PYETJE   = "Sa minuta të vendos timerin?"
+FRAZA_GABIM_AI       = "Pata një problem të vogël teknik. Provo përsëri!"
+FRAZA_GABIM_RRUGE    = "Nuk mund të gjej rrugën tani."
+FRAZA_VONESE         = "Më vjen keq, po më merr shumë kohë. Provo përsëri pas pak!"
+
 # ════════════════════════════════════════════════════════════
 #  KOHA DHE DATA
 # ════════════════════════════════════════════════════════════
@@ -72,70 +267,626 @@ def koha_e_dites() -> str:
     if 17 <= ora < 21: return "mirëmbrëma"
     return "natën e mirë"
 
+# ════════════════════════════════════════════════════════════
+#  METRIKAT
+# ════════════════════════════════════════════════════════════
+KUFIJTE_SEKONDA = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+METRIKAT: List["Metrika"] = []
+
+def _vlera_etikete(v) -> str:
+    return str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", " ")
+
+def _etiketat(emrat: Tuple[str, ...], vlerat: Tuple[str, ...], shtese: str = "") -> str:
+    cifte = [f'{e}="{_vlera_etikete(v)}"' for e, v in zip(emrat, vlerat)]
+    if shtese:
+        cifte.append(shtese)
+    return "{" + ",".join(cifte) + "}" if cifte else ""
+
+def _vlera_metrike(vlera: float) -> str:
+    """Vlerat e plota shkruhen pa humbur shifra (`:g` i rrumbullakos te 6 shifra)."""
+    if isinstance(vlera, int) or (isinstance(vlera, float) and vlera.is_integer()):
+        return str(int(vlera))
+    return repr(float(vlera))
+
+class Metrika:
+    """Metrikë në formatin tekst të Prometheus - counter, gauge ose histogram, me etiketa.
+
+    Me `lexo`, vlerat merren nga statistikat ekzistuese në momentin e scrape-it."""
+
+    def __init__(self, emri: str, ndihma: str, lloji: str = "counter", etiketat: Tuple[str, ...] = (),
+                 kufijte: Tuple[float, ...] = KUFIJTE_SEKONDA,
+                 lexo: Optional[Callable[[], Dict[Tuple[str, ...], float]]] = None):
+        self.emri = emri
+        self.ndihma = ndihma
+        self.lloji = lloji
+        self.etiketat = etiketat
+        self.kufijte = kufijte
+        self.lexo = lexo
+        self._vlerat: Dict[Tuple[str, ...], float] = {}
+        # Për histogram: [numri për çdo kufi..., +Inf, shuma]
+        self._kovat: Dict[Tuple[str, ...], List[float]] = {}
+        METRIKAT.append(self)
+
+    def shto(self, vlera: float = 1.0, *etiketat: str):
+        self._vlerat[etiketat] = self._vlerat.get(etiketat, 0.0) + vlera
+
+    def vezhgo(self, vlera: float, *etiketat: str):
+        kovat = self._kovat.get(etiketat)
+        if kovat is None:
+            kovat = self._kovat[etiketat] = [0.0] * (len(self.kufijte) + 2)
+        kovat[bisect.bisect_left(self.kufijte, vlera)] += 1
+        kovat[-1] += vlera
+
+    def rreshtat(self) -> List[str]:
+        rreshtat = [f"# HELP {self.emri} {self.ndihma}", f"# TYPE {self.emri} {self.lloji}"]
+        if self.lloji == "histogram":
+            for etiketat, kovat in self._kovat.items():
+                kumulative = 0.0
+                for kufiri, numri in zip(self.kufijte + (float("inf"),), kovat):
+                    kumulative += numri
+                    le = 'le="+Inf"' if kufiri == float("inf") else f'le="{kufiri}"'
+                    rreshtat.append(f"{self.emri}_bucket{_etiketat(self.etiketat, etiketat, le)} {_vlera_metrike(kumulative)}")
+                rreshtat.append(f"{self.emri}_sum{_etiketat(self.etiketat, etiketat)} {kovat[-1]:.6f}")
+                rreshtat.append(f"{self.emri}_count{_etiketat(self.etiketat, etiketat)} {_vlera_metrike(kumulative)}")
+            return rreshtat
+        vlerat = self.lexo() if self.lexo else self._vlerat
+        for etiketat, vlera in vlerat.items():
+            rreshtat.append(f"{self.emri}{_etiketat(self.etiketat, etiketat)} {_vlera_metrike(vlera)}")
+        return rreshtat
+
+def eksporto_metrikat() -> str:
+    rreshtat: List[str] = []
+    for metrika in METRIKAT:
+        try:
+            rreshtat += metrika.rreshtat()
+        except Exception as e:
+            print(f"Gabim metrika {metrika.emri}: {e}")
+    return "\n".join(rreshtat) + "\n"
+
+m_http_sekonda     = Metrika("luna_http_kerkesa_sekonda", "Kohëzgjatja e kërkesave HTTP deri te headers",
+                             "histogram", ("metoda", "rruga", "statusi"))
+m_faza_sekonda     = Metrika("luna_faza_sekonda", "Kohëzgjatja e çdo faze të përpunimit", "histogram", ("faza",))
+m_upstream_sekonda = Metrika("luna_upstream_sekonda", "Kohëzgjatja e thirrjeve drejt shërbimeve të jashtme",
+                             "histogram", ("upstream",))
+m_upstream_gabime  = Metrika("luna_upstream_gabime_total", "Gabimet e shërbimeve të jashtme sipas llojit",
+                             "counter", ("upstream", "lloji"))
+m_upstream_fluturim = Metrika("luna_upstream_ne_fluturim", "Thirrjet e hapura drejt çdo shërbimi",
+                              "gauge", ("upstream",))
+m_cache            = Metrika("luna_cache_kerkesa_total", "Kërkesat në cache sipas rezultatit",
+                             "counter", ("cache", "rezultati"))
+
+# Gjurma e fazave të kërkesës aktuale - e lexon middleware-i për Server-Timing
+_gjurma: ContextVar[Optional[List[Tuple[str, float]]]] = ContextVar("gjurma", default=None)
+
+@contextmanager
+def mat(faza: str):
+    """Mat një fazë: histogram global dhe gjurma e kërkesës aktuale"""
+    fillimi = time.perf_counter()
+    try:
+        yield
+    finally:
+        kohezgjatja = time.perf_counter() - fillimi
+        m_faza_sekonda.vezhgo(kohezgjatja, faza)
+        gjurma = _gjurma.get()
+        if gjurma is not None:
+            gjurma.append((faza, kohezgjatja))
+
+def server_timing(gjurma: List[Tuple[str, float]], total: float) -> str:
+    fazat: Dict[str, float] = {}
+    for faza, kohezgjatja in gjurma:
+        fazat[faza] = fazat.get(faza, 0.0) + kohezgjatja
+    fazat["total"] = total
+    return ", ".join(f"{faza};dur={1000 * k:.1f}" for faza, k in fazat.items())
+
+# ════════════════════════════════════════════════════════════
+#  AFATET
+# ════════════════════════════════════════════════════════════
+# Afati i kërkesës aktuale (time.monotonic()) - e trashëgojnë edhe detyrat që nisen brenda saj
+_afati: ContextVar[Optional[float]] = ContextVar("afati", default=None)
+
+m_afati_kaloi = Metrika("luna_afati_kaloi_total", "Fazat e ndërprera sepse mbaroi afati i kërkesës",
+                        "counter", ("faza",))
+
+def koha_e_mbetur() -> Optional[float]:
+    """Sekondat deri në afatin e kërkesës aktuale - None kur s'ka afat"""
+    afati = _afati.get()
+    return None if afati is None else afati - time.monotonic()
+
+@contextmanager
+def me_afat(sekonda: Optional[float], zevendeso: bool = False):
+    """Vendos afatin për gjithçka brenda; pa `zevendeso`, një afat i jashtëm më i shkurtër mbetet"""
+    afati = None if sekonda is None else time.monotonic() + sekonda
+    i_jashtem = _afati.get()
+    if not zevendeso and i_jashtem is not None and (afati is None or i_jashtem < afati):
+        afati = i_jashtem
+    shenja = _afati.set(afati)
+    try:
+        yield
+    finally:
+        _afati.reset(shenja)
+
+async def brenda_afatit(aw: Awaitable, rezerve_s: float = 0.0):
+    """Pret `aw` vetëm sa lejon afati (minus rezervën); TimeoutError dhe anulim kur mbaron"""
+    mbetur = koha_e_mbetur()
+    if mbetur is None:
+        return await aw
+    mbetur -= rezerve_s
+    if mbetur <= 0:
+        if asyncio.iscoroutine(aw):
+            aw.close()
+        raise asyncio.TimeoutError()
+    return await asyncio.wait_for(aw, mbetur)
+
+def afati_i_kerkeses(request: Request) -> float:
+    """Buxheti në sekonda - nga X-Luna-Deadline-Ms i pajisjes (brenda kufijve) ose AFATI_S"""
+    vlera = request.headers.get("x-luna-deadline-ms")
+    if vlera:
+        try:
+            return min(AFATI_MAX_S, max(AFATI_MIN_S, float(vlera) / 1000))
+        except ValueError:
+            pass
+    return AFATI_S
+
+class TransportMates(httpx.AsyncBaseTransport):
+    """Mbështjell transportin e një klienti: kohëzgjatja, thirrjet në fluturim dhe gabimet për shërbim"""
+
+    def __init__(self, emri: str, brendshem: httpx.AsyncBaseTransport):
+        self.emri = emri
+        self._brendshem = brendshem
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        m_upstream_fluturim.shto(1, self.emri)
+        fillimi = time.perf_counter()
+        try:
+            pergjigja = await self._brendshem.handle_async_request(request)
+        except httpx.TimeoutException:
+            m_upstream_gabime.shto(1, self.emri, "timeout")
+            raise
+        except httpx.TransportError:
+            m_upstream_gabime.shto(1, self.emri, "lidhje")
+            raise
+        finally:
+            m_upstream_fluturim.shto(-1, self.emri)
+            m_upstream_sekonda.vezhgo(time.perf_counter() - fillimi, self.emri)
+        if pergjigja.status_code == 429 or pergjigja.status_code >= 500:
+            m_upstream_gabime.shto(1, self.emri, str(pergjigja.status_code))
+        return pergjigja
+
+    async def aclose(self):
+        await self._brendshem.aclose()
+
+# ════════════════════════════════════════════════════════════
+#  KLIENTËT HTTP
+# ════════════════════════════════════════════════════════════
+def _ka_http2() -> bool:
+    try:
+        import h2  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+def _krijo_klientin(emri: str) -> httpx.AsyncClient:
+    cfg     = UPSTREAMS[emri]
+    timeout = float(os.getenv(f"LUNA_TIMEOUT_{emri.upper()}", cfg["timeout"]))
+    # LUNA_URL_<EMRI> drejton shërbimin te një stand-in lokal (p.sh. bench/mock_upstreams.py)
+    base_url = os.getenv(f"LUNA_URL_{emri.upper()}", cfg["base_url"])
+    headers = {"User-Agent": "LunaAI/4.0"}
+    if emri == "groq":
+        headers["Authorization"] = f"Bearer {GROQ_API_KEY}"
+    transporti = httpx.AsyncHTTPTransport(
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONN,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+            keepalive_expiry=HTTP_KEEPALIVE_S,
+        ),
+        http2=cfg["http2"] and HTTP2_AKTIV and _ka_http2(),
+    )
+    return httpx.AsyncClient(
+        base_url=base_url,
+        headers=headers,
+        timeout=httpx.Timeout(timeout, connect=min(5.0, timeout)),
+        transport=TransportMates(emri, transporti),
+    )
+
+def klienti(emri: str) -> httpx.AsyncClient:
+    """Kthen klientin e përbashkët për një shërbim - e krijon nëse mungon"""
+    k = KLIENTET.get(emri)
+    if k is None or k.is_closed:
+        k = KLIENTET[emri] = _krijo_klientin(emri)
+    return k
+
+async def hap_klientet():
+    for emri in UPSTREAMS:
+        klienti(emri)
+
+async def mbyll_klientet():
+    klientet = list(KLIENTET.values())
+    KLIENTET.clear()
+    await asyncio.gather(*(k.aclose() for k in klientet), return_exceptions=True)
+
+# ════════════════════════════════════════════════════════════
+#  RADHËT DHE BACKPRESSURE
+# ════════════════════════════════════════════════════════════
+class RadhaEPlote(Exception):
+    """Radha e një shërbimi është plot (ose pritja zgjati shumë) - kërkesa refuzohet"""
+
+    def __init__(self, radha: "Radha"):
+        super().__init__(f"radha '{radha.emri}' është plot")
+        self.radha = radha
+
+class Radha:
+    """Kufizon thirrjet e njëkohshme drejt një shërbimi, me radhë pritjeje të kufizuar"""
+
+    def __init__(self, emri: str, paralel: int, thellesi: int, pritje_max_s: float):
+        self.emri = emri
+        self.paralel = paralel
+        self.thellesi = thellesi
+        self.pritje_max_s = pritje_max_s
+        self._semafori = asyncio.Semaphore(paralel)
+        self.aktive = 0
+        self.ne_pritje = 0
+        self.pranuar = 0
+        self.refuzuar = 0
+        self.riprovime = 0
+        self.pritja_totale_s = 0.0
+        self.pritja_max_s = 0.0
+
+    def e_plote(self) -> bool:
+        return self.ne_pritje >= self.thellesi
+
+    def retry_after(self) -> int:
+        """Sa sekonda t'i thuhet klientit të presë - sipas pritjes mesatare deri tani"""
+        mesatarja = self.pritja_totale_s / self.pranuar if self.pranuar else 0.0
+        return max(1, min(30, round(mesatarja * 2)))
+
+    @asynccontextmanager
+    async def vend(self):
+        if self.e_plote():
+            self.refuzuar += 1
+            raise RadhaEPlote(self)
+        fillimi = time.monotonic()
+        if self._semafori.locked():
+            self.ne_pritje += 1
+            try:
+                await asyncio.wait_for(self._semafori.acquire(), timeout=self.pritje_max_s)
+            except asyncio.TimeoutError:
+                self.refuzuar += 1
+                raise RadhaEPlote(self)
+            finally:
+                self.ne_pritje -= 1
+        else:
+            await self._semafori.acquire()
+        pritja = time.monotonic() - fillimi
+        m_radha_pritja.vezhgo(pritja, self.emri)
+        self.pranuar += 1
+        self.pritja_totale_s += pritja
+        self.pritja_max_s = max(self.pritja_max_s, pritja)
+        self.aktive += 1
+        try:
+            yield
+        finally:
+            self.aktive -= 1
+            self._semafori.release()
+
+    def statistika(self) -> dict:
+        return {
+            "paralel": self.paralel,
+            "thellesi": self.thellesi,
+            "aktive": self.aktive,
+            "ne_pritje": self.ne_pritje,
+            "pranuar": self.pranuar,
+            "refuzuar": self.refuzuar,
+            "riprovime": self.riprovime,
+            "pritja_mes_ms": round(1000 * self.pritja_totale_s / self.pranuar, 1) if self.pranuar else 0.0,
+            "pritja_max_ms": round(1000 * self.pritja_max_s, 1),
+        }
+
+m_radha_pritja = Metrika("luna_radha_pritja_sekonda", "Sa pret një thirrje për vend në radhë",
+                         "histogram", ("radha",))
+
+radhet: Dict[str, Radha] = {
+    emri: Radha(
+        emri,
+        int(os.getenv(f"LUNA_RADHE_{emri.upper()}_PARALEL", cfg["paralel"])),
+        int(os.getenv(f"LUNA_RADHE_{emri.upper()}_THELLESI", cfg["thellesi"])),
+        RADHE_PRITJE_MAX_S,
+    )
+    for emri, cfg in RADHET.items()
+}
+
+def _nga_radhet(fusha: str) -> Callable[[], Dict[Tuple[str, ...], float]]:
+    return lambda: {(emri,): getattr(r, fusha) for emri, r in radhet.items()}
+
+Metrika("luna_radha_aktive", "Thirrjet që po ekzekutohen në çdo radhë", "gauge", ("radha",), lexo=_nga_radhet("aktive"))
+Metrika("luna_radha_ne_pritje", "Thirrjet që presin në çdo radhë", "gauge", ("radha",), lexo=_nga_radhet("ne_pritje"))
+Metrika("luna_radha_refuzuar_total", "Kërkesat e refuzuara sepse radha ishte plot", "counter", ("radha",),
+        lexo=_nga_radhet("refuzuar"))
+Metrika("luna_radha_riprovime_total", "Riprovimet pas 429/503 nga shërbimi", "counter", ("radha",),
+        lexo=_nga_radhet("riprovime"))
+
+def vonesa_riprovimit(r: httpx.Response, prova: int) -> Optional[float]:
+    """Sa të presim para provës tjetër pas 429/503 - None kur nuk ia vlen të riprovojmë"""
+    if r.status_code not in (429, 503) or prova >= RIPROVIME_MAX:
+        return None
+    retry_after = r.headers.get("retry-after")
+    if retry_after is None:
+        # Backoff eksponencial me "full jitter"
+        return random.uniform(0, min(RIPROVIM_MAX_S, RIPROVIM_BAZA_S * 2 ** prova))
+    try:
+        sekonda = float(retry_after)
+    except ValueError:
+        try:
+            sekonda = (parsedate_to_datetime(retry_after) - datetime.now(pytz.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return None
+    if sekonda > RIPROVIM_MAX_S:
+        return None
+    # Të gjithë klientët nuk duhet të rikthehen në të njëjtin milisekond
+    return max(0.0, sekonda) + random.uniform(0, RIPROVIM_BAZA_S)
+
+def vlen_riprovimi(vonesa: Optional[float]) -> bool:
+    """Riprovimi që do të niste pas afatit të kërkesës vetëm e shtyn gabimin"""
+    mbetur = koha_e_mbetur()
+    return vonesa is not None and (mbetur is None or vonesa < mbetur)
+
+async def me_riprovim(radha: Radha, thirrja: Callable[[], Awaitable[httpx.Response]]) -> httpx.Response:
+    """Riprovon thirrjen pas 429/503 - vendi në radhë mbahet gjatë pritjes"""
+    prova = 0
+    while True:
+        pergjigja = await thirrja()
+        vonesa = vonesa_riprovimit(pergjigja, prova)
+        if not vlen_riprovimi(vonesa):
+            return pergjigja
+        radha.riprovime += 1
+        prova += 1
+        await pergjigja.aclose()
+        await asyncio.sleep(vonesa)
+
+async def thirr(radha: str, thirrja: Callable[[], Awaitable[httpx.Response]]) -> httpx.Response:
+    """Bën thirrjen brenda radhës së shërbimit dhe e riprovon pas 429/503"""
+    async with radhet[radha].vend():
+        return await me_riprovim(radhet[radha], thirrja)
+
+# ════════════════════════════════════════════════════════════
+#  CACHE DHE KUFIZUES
+# ════════════════════════════════════════════════════════════
+class KovaTokenash:
+    """Kufizues ritmi token-bucket i përbashkët për gjithë procesin"""
+
+    def __init__(self, ritmi: float, kapaciteti: float = 1):
+        self.ritmi = ritmi
+        self.kapaciteti = kapaciteti
+        self._tokenat = kapaciteti
+        self._koha = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def merr(self):
+        # Presin vetëm thirrjet që kalojnë nga ky kufizues, jo kërkesat e tjera
+        async with self._lock:
+            while True:
+                tani = time.monotonic()
+                self._tokenat = min(self.kapaciteti, self._tokenat + (tani - self._koha) * self.ritmi)
+                self._koha = tani
+                if self._tokenat >= 1:
+                    self._tokenat -= 1
+                    return
+                await asyncio.sleep((1 - self._tokenat) / self.ritmi)
+
+class CacheLRU:
+    """Fjalor me kufi hyrjesh - hiq më të vjetrën kur mbushet"""
+
+    def __init__(self, max_hyrje: int):
+        self.max_hyrje = max_hyrje
+        self._te_dhenat: OrderedDict = OrderedDict()
+
+    def __contains__(self, celesi) -> bool:
+        return celesi in self._te_dhenat
+
+    def __len__(self) -> int:
+        return len(self._te_dhenat)
+
+    def get(self, celesi, default=None):
+        if celesi not in self._te_dhenat:
+            return default
+        self._te_dhenat.move_to_end(celesi)
+        return self._te_dhenat[celesi]
+
+    def vendos(self, celesi, vlera):
+        self._te_dhenat[celesi] = vlera
+        self._te_dhenat.move_to_end(celesi)
+        while len(self._te_dhenat) > self.max_hyrje:
+            self._te_dhenat.popitem(last=False)
+
+_lidhjet_sqlite = threading.local()
+
+def lidhja_sqlite(shteg: str) -> sqlite3.Connection:
+    """Një lidhje SQLite (WAL) për skedar dhe për thread - në praktikë vetëm thread-i i bazës"""
+    lidhjet = getattr(_lidhjet_sqlite, "lidhjet", None)
+    if lidhjet is None:
+        lidhjet = _lidhjet_sqlite.lidhjet = {}
+    lidhja = lidhjet.get(shteg)
+    if lidhja is None:
+        lidhja = sqlite3.connect(shteg, isolation_level=None)
+        lidhja.execute("PRAGMA journal_mode=WAL")
+        lidhja.execute("PRAGMA synchronous=NORMAL")
+        lidhja.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_MS}")
+        lidhjet[shteg] = lidhja
+    return lidhja
+
+# Një thread i vetëm: punët ekzekutohen me radhë, pra një lexim sheh gjithmonë shkrimet e nisura para tij.
+# Krijohet sipas nevojës, që pas mbylljes në lifespan një nisje e re (reload, teste) të ketë thread-in e vet.
+_thread_db: Optional[concurrent.futures.ThreadPoolExecutor] = None
+
+def _dergo_ne_db(fn: Callable, *args) -> concurrent.futures.Future:
+    global _thread_db
+    if _thread_db is None:
+        _thread_db = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="luna-sqlite")
+    return _thread_db.submit(fn, *args)
+
+async def mbyll_thread_db():
+    """Pret shkrimet që janë ende në radhë dhe mbyll thread-in e bazës"""
+    global _thread_db
+    thread_db, _thread_db = _thread_db, None
+    if thread_db is not None:
+        await asyncio.to_thread(thread_db.shutdown)
+
+async def ne_db(fn: Callable, *args):
+    """Ekzekuton `fn` në thread-in e bazës dhe pret rezultatin pa bllokuar event loop-in"""
+    return await asyncio.wrap_future(_dergo_ne_db(fn, *args))
+
+def _raporto_gabimin_db(f: concurrent.futures.Future):
+    if not f.cancelled() and f.exception() is not None:
+        print(f"Gabim SQLite: {f.exception()}")
+
+def ne_db_sfond(fn: Callable, *args) -> concurrent.futures.Future:
+    """Si ne_db, për shkrimet që s'kanë nevojë të priten - radha me punët e tjera ruhet"""
+    f = _dergo_ne_db(fn, *args)
+    f.add_done_callback(_raporto_gabimin_db)
+    return f
+
+def ne_db_tani(fn: Callable, *args):
+    """Si ne_db, por pret në mënyrë sinkrone - vetëm gjatë nisjes (krijimi i tabelave)"""
+    return _dergo_ne_db(fn, *args).result()
+
+class StatistikaSQLite:
+    """Statistikat e një depoje SQLite: llogariten në thread-in e bazës, jo më shpesh se
+    SQLITE_PASTRIMI_S, dhe lexohen nga /health e /metrics pa prekur skedarin"""
+
+    def __init__(self, llogarit: Callable[[], dict], fillestare: dict):
+        self._llogarit = llogarit
+        self._vlerat = fillestare
+        self._koha = 0.0
+        self._ne_rruge = False
+
+    def _rifresko(self):
+        try:
+            self._vlerat = self._llogarit()
+        finally:
+            self._koha = time.monotonic()
+            self._ne_rruge = False
+
+    def merr(self) -> dict:
+        if not self._ne_rruge and time.monotonic() - self._koha >= SQLITE_PASTRIMI_S:
+            self._ne_rruge = True
+            ne_db_sfond(self._rifresko)
+        return self._vlerat
+
 # ════════════════════════════════════════════════════════════
 #  WEB SEARCH - KËRKIM NË KOHË REALE
 # ════════════════════════════════════════════════════════════
-async def kerko_web(pyetja: str) -> str:
-    """Kërkon informacion në DuckDuckGo Instant Answer API - falas"""
-    try:
-        async with httpx.AsyncClient(timeout=10) as client:
-            # DuckDuckGo Instant Answer
-            r = await client.get(
-                "https://api.duckduckgo.com/",
-                params={
-                    "q": pyetja,
-                    "format": "json",
-                    "no_html": "1",
-                    "skip_disambig": "1",
-                    "no_redirect": "1"
-                },
-                headers={"User-Agent": "LunaAI/4.0"}
-            )
-            data = r.json()
+async def _kerko_ddg(pyetja: str) -> str:
+    """DuckDuckGo Instant Answer API - falas"""
+    r = await thirr("web", lambda: klienti("ddg").get(
+        "/",
+        params={
+            "q": pyetja,
+            "format": "json",
+            "no_html": "1",
+            "skip_disambig": "1",
+            "no_redirect": "1"
+        }
+    ))
+    data = r.json()
 
-            rezultate = []
+    rezultate = []
 
-            # Abstract (përmbledhja kryesore)
-            if data.get("AbstractText"):
-                rezultate.append(data["AbstractText"][:500])
+    # Abstract (përmbledhja kryesore)
+    if data.get("AbstractText"):
+        rezultate.append(data["AbstractText"][:500])
 
-            # Answer direkt
-            if data.get("Answer"):
-                rezultate.append(str(data["Answer"]))
+    # Answer direkt
+    if data.get("Answer"):
+        rezultate.append(str(data["Answer"]))
 
-            # Related topics
-            if data.get("RelatedTopics"):
-                for topic in data["RelatedTopics"][:3]:
-                    if isinstance(topic, dict) and topic.get("Text"):
-                        rezultate.append(topic["Text"][:200])
+    # Related topics
+    if data.get("RelatedTopics"):
+        for topic in data["RelatedTopics"][:3]:
+            if isinstance(topic, dict) and topic.get("Text"):
+                rezultate.append(topic["Text"][:200])
 
-            if rezultate:
-                return " | ".join(rezultate[:3])
+    return " | ".join(rezultate[:3])
 
-            # Nëse DuckDuckGo nuk jep rezultat, provo Wikipedia
-            r2 = await client.get(
-                "https://sq.wikipedia.org/api/rest_v1/page/summary/" + quote(pyetja),
-                headers={"User-Agent": "LunaAI/4.0"}
-            )
-            if r2.status_code == 200:
-                wiki = r2.json()
-                if wiki.get("extract"):
-                    return wiki["extract"][:600]
-
-            # Provo Wikipedia anglisht
-            r3 = await client.get(
-                "https://en.wikipedia.org/api/rest_v1/page/summary/" + quote(pyetja),
-                headers={"User-Agent": "LunaAI/4.0"}
-            )
-            if r3.status_code == 200:
-                wiki3 = r3.json()
-                if wiki3.get("extract"):
-                    return f"[EN] {wiki3['extract'][:600]}"
+async def _kerko_wiki_sq(pyetja: str) -> str:
+    r = await thirr("web", lambda: klienti("wiki_sq").get("/page/summary/" + quote(pyetja)))
+    if r.status_code == 200:
+        wiki = r.json()
+        if wiki.get("extract"):
+            return wiki["extract"][:600]
+    return ""
 
-            return ""
+async def _kerko_wiki_en(pyetja: str) -> str:
+    r = await thirr("web", lambda: klienti("wiki_en").get("/page/summary/" + quote(pyetja)))
+    if r.status_code == 200:
+        wiki = r.json()
+        if wiki.get("extract"):
+            return f"[EN] {wiki['extract'][:600]}"
+    return ""
+
+# Renditja sipas përparësisë: DuckDuckGo, pastaj Wikipedia shqip, pastaj anglisht
+BURIMET_WEB = [_kerko_ddg, _kerko_wiki_sq, _kerko_wiki_en]
+
+_cache_web = CacheLRU(WEB_CACHE_MAX)
+
+def normalo_pyetjen(pyetja: str) -> str:
+    """Shkronja të vogla, pa diakritikë (ë -> e, ç -> c), pa pikësim dhe hapësira të tepërta"""
+    t = unicodedata.normalize("NFKD", pyetja.lower())
+    t = "".join(c for c in t if not unicodedata.combining(c))
+    t = re.sub(r"[^\w\s]", " ", t)
+    return " ".join(t.split())
+
+async def _kerko_paralel(pyetja: str) -> str:
+    """Pyet të gjitha burimet njëkohësisht; fiton rezultati i mirë me përparësinë më të lartë"""
+    loop = asyncio.get_running_loop()
+    detyrat = {asyncio.ensure_future(burimi(pyetja)): i for i, burimi in enumerate(BURIMET_WEB)}
+    rezultatet: List[Optional[str]] = [None] * len(BURIMET_WEB)
+    ne_pritje = set(detyrat)
+    afati = None
+    try:
+        while ne_pritje:
+            timeout = None if afati is None else max(0.0, afati - loop.time())
+            kryer, ne_pritje = await asyncio.wait(ne_pritje, timeout=timeout,
+                                                  return_when=asyncio.FIRST_COMPLETED)
+            for detyre in kryer:
+                i = detyrat[detyre]
+                try:
+                    rezultatet[i] = detyre.result()
+                except Exception as e:
+                    print(f"Gabim web search ({BURIMET_WEB[i].__name__}): {e}")
+                    rezultatet[i] = ""
+            me_i_miri = next((i for i, r in enumerate(rezultatet) if r), None)
+            if me_i_miri is None:
+                continue
+            # Burimet me përparësi më të lartë kanë mbaruar - s'ka pse të presim
+            if all(rezultatet[i] is not None for i in range(me_i_miri)):
+                break
+            if afati is None:
+                afati = loop.time() + WEB_GRACE_S
+            elif not kryer or loop.time() >= afati:
+                break
+        return next((r for r in rezultatet if r), "")
+    finally:
+        for detyre in ne_pritje:
+            detyre.cancel()
+        await asyncio.gather(*ne_pritje, return_exceptions=True)
+
+async def kerko_web(pyetja: str) -> str:
+    """Kërkon informacion në DuckDuckGo dhe Wikipedia - me cache edhe për rezultatet bosh"""
+    celesi = normalo_pyetjen(pyetja)
+    hyrja = _cache_web.get(celesi)
+    if hyrja is not None:
+        koha, rezultati = hyrja
+        if time.monotonic() - koha < (WEB_TTL_S if rezultati else WEB_TTL_BOSH_S):
+            m_cache.shto(1, "web", "hit")
+            return rezultati
+    m_cache.shto(1, "web", "miss")
+    try:
+        rezultati = await _kerko_paralel(pyetja)
     except Exception as e:
         print(f"Gabim web search: {e}")
         return ""
+    _cache_web.vendos(celesi, (time.monotonic(), rezultati))
+    return rezultati
 
 async def duhet_kerkuar(text: str, pergjigja_e_pare: str) -> bool:
     """Kontrollon nëse AI ka nevojë për informacion nga interneti"""
@@ -151,407 +902,3398 @@ async def duhet_kerkuar(text: str, pergjigja_e_pare: str) -> bool:
 # ════════════════════════════════════════════════════════════
 #  MOT
 # ════════════════════════════════════════════════════════════
+_cache_motit: Dict[str, Tuple[float, str]] = {}
+_motin_ne_rruge: Dict[str, asyncio.Future] = {}
+_forma_motit: Dict[str, str] = {}
+
+async def _merr_motin_nga_api(qyteti: str) -> str:
+    client = klienti("weather")
+    # Provo fillimisht formën e pyetjes që ka funksionuar më parë për këtë qytet
+    format_q = [f"{qyteti},AL", qyteti]
+    if _forma_motit.get(qyteti) == qyteti:
+        format_q.reverse()
+    d: dict = {}
+    for q in format_q:
+        r = await thirr("web", lambda: client.get(
+            "/weather",
+            params={"q": q, "appid": WEATHER_API_KEY,
+                    "units": "metric", "lang": "sq"}
+        ))
+        d = r.json()
+        if d.get("cod") == 200:
+            _forma_motit[qyteti] = q
+            break
+    temp      = round(d["main"]["temp"])
+    ndjesia   = round(d["main"]["feels_like"])
+    pershkrim = d["weather"][0]["description"]
+    lageshti  = d["main"]["humidity"]
+    era       = d["wind"]["speed"]
+    min_t     = round(d["main"]["temp_min"])
+    max_t     = round(d["main"]["temp_max"])
+    teksti = (
+        f"Moti në {qyteti}: {temp}°C, ndihet si {ndjesia}°C. "
+        f"{pershkrim.capitalize()}. "
+        f"Min {min_t}°C, max {max_t}°C, lagështi {lageshti}%, erë {era:.1f} m/s."
+    )
+    _cache_motit[qyteti] = (time.monotonic(), teksti)
+    return teksti
+
+def _fresko_motin(qyteti: str) -> asyncio.Future:
+    """Një kërkesë e vetme në fluturim për qytet - thirrjet e njëkohshme e ndajnë"""
+    detyre = _motin_ne_rruge.get(qyteti)
+    if detyre is None:
+        detyre = asyncio.ensure_future(_merr_motin_nga_api(qyteti))
+        _motin_ne_rruge[qyteti] = detyre
+
+        def _u_krye(t: asyncio.Future):
+            _motin_ne_rruge.pop(qyteti, None)
+            if not t.cancelled():
+                t.exception()
+        detyre.add_done_callback(_u_krye)
+    return detyre
+
 async def merre_motin(qyteti: str = "Tirana") -> str:
+    hyrja = _cache_motit.get(qyteti)
+    if hyrja and time.monotonic() - hyrja[0] < MOT_TTL_S:
+        m_cache.shto(1, "moti", "hit")
+        return hyrja[1]
+    m_cache.shto(1, "moti", "miss")
     try:
-        async with httpx.AsyncClient(timeout=8) as client:
-            r = await client.get(
-                "https://api.openweathermap.org/data/2.5/weather",
-                params={"q": f"{qyteti},AL", "appid": WEATHER_API_KEY,
-                        "units": "metric", "lang": "sq"}
-            )
-            d = r.json()
-            if d.get("cod") != 200:
-                r = await client.get(
-                    "https://api.openweathermap.org/data/2.5/weather",
-                    params={"q": qyteti, "appid": WEATHER_API_KEY,
-                            "units": "metric", "lang": "sq"}
-                )
-                d = r.json()
-            temp      = round(d["main"]["temp"])
-            ndjesia   = round(d["main"]["feels_like"])
-            pershkrim = d["weather"][0]["description"]
-            lageshti  = d["main"]["humidity"]
-            era       = d["wind"]["speed"]
-            min_t     = round(d["main"]["temp_min"])
-            max_t     = round(d["main"]["temp_max"])
-            return (
-                f"Moti në {qyteti}: {temp}°C, ndihet si {ndjesia}°C. "
-                f"{pershkrim.capitalize()}. "
-                f"Min {min_t}°C, max {max_t}°C, lagështi {lageshti}%, erë {era:.1f} m/s."
-            )
+        return await asyncio.shield(_fresko_motin(qyteti))
     except Exception as e:
         print(f"Gabim mot: {e}")
         return f"Nuk mund të marr motin për {qyteti} tani."
 
+async def rifresko_motin_ne_sfond():
+    """Mban të freskët motin e qyteteve të njohura që pyetjet të dalin nga memoria"""
+    qytetet = sorted(set(QYTETET_MAP.values()))
+    while True:
+        for qyteti in qytetet:
+            try:
+                await _fresko_motin(qyteti)
+            except Exception as e:
+                print(f"Gabim rifreskim moti për {qyteti}: {e}")
+        await asyncio.sleep(MOT_REFRESH_S)
+
 # ════════════════════════════════════════════════════════════
 #  RRUGA
 # ════════════════════════════════════════════════════════════
-async def normalo_qytetin(emri: str) -> str:
-    return QYTETET_MAP.get(emri.lower().strip(), emri.capitalize())
+kufizuesi_nominatim = KovaTokenash(NOMINATIM_RITMI)
+_cache_gjeokodimi = CacheLRU(RRUGET_CACHE_MAX)
+_cache_rrugeve = CacheLRU(RRUGET_CACHE_MAX)
 
-async def merre_rrugën(origjina: str, destinacioni: str) -> str:
+def _lexo_matricen() -> Dict[str, List[float]]:
+    if not RRUGET_SKEDAR or not os.path.exists(RRUGET_SKEDAR):
+        return {}
     try:
-        orig_norm = await normalo_qytetin(origjina)
-        dest_norm = await normalo_qytetin(destinacioni)
+        with open(RRUGET_SKEDAR, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Gabim leximi matrica e rrugëve: {e}")
+        return {}
 
-        async with httpx.AsyncClient(timeout=15) as client:
-            headers = {"User-Agent": "LunaAI/4.0"}
+def _ruaj_matricen(matrica: Dict[str, List[float]]):
+    # Emër i veçantë për çdo shkrim - dy rrugë të reja njëkohësisht s'prekin skedarin e njëra-tjetrës
+    tmp = f"{RRUGET_SKEDAR}.{uuid.uuid4().hex[:8]}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(matrica, f, ensure_ascii=False)
+    os.replace(tmp, RRUGET_SKEDAR)
 
-            r1 = await client.get(
-                "https://nominatim.openstreetmap.org/search",
-                params={"q": f"{orig_norm}, Albania", "format": "json", "limit": 1},
-                headers=headers
-            )
-            await asyncio.sleep(1)
-            r2 = await client.get(
-                "https://nominatim.openstreetmap.org/search",
-                params={"q": f"{dest_norm}, Albania", "format": "json", "limit": 1},
-                headers=headers
-            )
+# Distanca (m) dhe kohëzgjatja (s) mes çifteve të qyteteve të njohura, plotësohet dhe ruhet gradualisht
+_matrica_rrugeve: Dict[str, List[float]] = _lexo_matricen()
+_ruajtja_matrices = asyncio.Lock()
+
+async def normalo_qytetin(emri: str) -> str:
+    return QYTETET_MAP.get(emri.lower().strip(), emri.capitalize())
 
-            loc1 = r1.json()
-            loc2 = r2.json()
+async def gjeokodo(vendi: str) -> Optional[Tuple[float, float]]:
+    if vendi in KOORDINATAT:
+        return KOORDINATAT[vendi]
+    if vendi in _cache_gjeokodimi:
+        m_cache.shto(1, "gjeokodim", "hit")
+        return _cache_gjeokodimi.get(vendi)
+    m_cache.shto(1, "gjeokodim", "miss")
+    await kufizuesi_nominatim.merr()
+    r = await thirr("web", lambda: klienti("nominatim").get(
+        "/search",
+        params={"q": f"{vendi}, Albania", "format": "json", "limit": 1}
+    ))
+    loc = r.json()
+    koordinatat = (float(loc[0]["lat"]), float(loc[0]["lon"])) if loc else None
+    _cache_gjeokodimi.vendos(vendi, koordinatat)
+    return koordinatat
 
-            if not loc1: return f"Nuk gjeta {orig_norm} në hartë."
-            if not loc2: return f"Nuk gjeta {dest_norm} në hartë."
+async def _merr_rrugen_osrm(nga: Tuple[float, float], te: Tuple[float, float]) -> Optional[Tuple[float, float]]:
+    (lat1, lon1), (lat2, lon2) = nga, te
+    route = await thirr("web", lambda: klienti("osrm").get(
+        f"/route/v1/driving/{lon1},{lat1};{lon2},{lat2}",
+        params={"overview": "false"}
+    ))
+    rd = route.json()
+    if rd.get("code") != "Ok":
+        return None
+    return rd["routes"][0]["distance"], rd["routes"][0]["duration"]
 
-            lat1, lon1 = loc1[0]["lat"], loc1[0]["lon"]
-            lat2, lon2 = loc2[0]["lat"], loc2[0]["lon"]
+def _formato_rrugen(orig_norm: str, dest_norm: str, distanca_m: float, kohezgjatja_s: float) -> str:
+    distanca_km = distanca_m / 1000
+    koha_min    = kohezgjatja_s / 60
 
-            route = await client.get(
-                f"https://router.project-osrm.org/route/v1/driving/{lon1},{lat1};{lon2},{lat2}",
-                params={"overview": "false"}
-            )
-            rd = route.json()
+    if koha_min < 60:
+        koha_str = f"{round(koha_min)} minuta"
+    else:
+        ore  = int(koha_min // 60)
+        mins = int(koha_min % 60)
+        koha_str = f"{ore} orë" + (f" e {mins} minuta" if mins > 0 else "")
+
+    return (
+        f"Nga {orig_norm} te {dest_norm}: "
+        f"{distanca_km:.0f} km, afërsisht {koha_str} me makinë."
+    )
 
-            if rd.get("code") != "Ok":
-                return f"Nuk gjeta rrugën nga {orig_norm} te {dest_norm}."
+async def merre_rrugën(origjina: str, destinacioni: str) -> str:
+    try:
+        orig_norm = await normalo_qytetin(origjina)
+        dest_norm = await normalo_qytetin(destinacioni)
+        celesi = f"{orig_norm}|{dest_norm}"
+        ne_matrice = orig_norm in KOORDINATAT and dest_norm in KOORDINATAT
 
-            distanca_km = rd["routes"][0]["distance"] / 1000
-            koha_min    = rd["routes"][0]["duration"] / 60
+        rruga = _matrica_rrugeve.get(celesi) if ne_matrice else _cache_rrugeve.get(celesi)
+        if rruga:
+            m_cache.shto(1, "rruge", "hit")
+            return _formato_rrugen(orig_norm, dest_norm, *rruga)
+        m_cache.shto(1, "rruge", "miss")
 
-            if koha_min < 60:
-                koha_str = f"{round(koha_min)} minuta"
-            else:
-                ore  = int(koha_min // 60)
-                mins = int(koha_min % 60)
-                koha_str = f"{ore} orë" + (f" e {mins} minuta" if mins > 0 else "")
+        loc1, loc2 = await asyncio.gather(gjeokodo(orig_norm), gjeokodo(dest_norm))
+        if not loc1: return f"Nuk gjeta {orig_norm} në hartë."
+        if not loc2: return f"Nuk gjeta {dest_norm} në hartë."
 
-            return (
-                f"Nga {orig_norm} te {dest_norm}: "
-                f"{distanca_km:.0f} km, afërsisht {koha_str} me makinë."
-            )
+        rruga = await _merr_rrugen_osrm(loc1, loc2)
+        if rruga is None:
+            return f"Nuk gjeta rrugën nga {orig_norm} te {dest_norm}."
+
+        if ne_matrice:
+            _matrica_rrugeve[celesi] = list(rruga)
+            if RRUGET_SKEDAR:
+                try:
+                    # Një shkrim në herë, me gjendjen më të fundit të matricës
+                    async with _ruajtja_matrices:
+                        await asyncio.to_thread(_ruaj_matricen, dict(_matrica_rrugeve))
+                except OSError as e:
+                    # Rruga u gjet - ruajtja në disk provohet sërish me rrugën e ardhshme
+                    print(f"Gabim ruajtje matrica e rrugëve: {e}")
+        else:
+            _cache_rrugeve.vendos(celesi, rruga)
+        return _formato_rrugen(orig_norm, dest_norm, *rruga)
     except Exception as e:
         print(f"Gabim rrugë: {e}")
-        return "Nuk mund të gjej rrugën tani."
+        return FRAZA_GABIM_RRUGE
 
 # ════════════════════════════════════════════════════════════
-#  TTS
+#  AUDIO STORE
 # ════════════════════════════════════════════════════════════
-async def tts_edge(text: str) -> bool:
-    global current_audio_data
-    try:
-        import edge_tts
-        text_clean = re.sub(r'[\U00010000-\U0010ffff]', '', text)
-        text_clean = re.sub(r'[*#_~`]', '', text_clean).strip()
-        if not text_clean:
-            return False
-        communicate = edge_tts.Communicate(text_clean, "sq-AL-AlbaNeural", rate="+5%", volume="+10%")
-        data = b""
-        async for chunk in communicate.stream():
-            if chunk["type"] == "audio":
-                data += chunk["data"]
-        if data:
-            current_audio_data = data
-            return True
-        return False
-    except Exception as e:
-        print(f"Gabim edge TTS: {e}")
-        return False
+class RegjistrimAudio:
+    """Audio e një përgjigjeje - mbushet copë pas cope ndërsa sintetizohet"""
 
-# ════════════════════════════════════════════════════════════
-#  INTENT DETECTION
-# ════════════════════════════════════════════════════════════
-def detekto_intent(text: str) -> dict:
-    t = text.lower().strip()
+    def __init__(self, depo: Optional["DepoAudio"]):
+        self.copat: List[bytes] = []
+        self.madhesia = 0
+        self.perfunduar = False
+        self.ok = False
+        self.perdorur = time.monotonic()
+        self._depo = depo
+        self._ndryshim = asyncio.Event()
 
-    if any(w in t for w in ["mot", "temperatur", "shi", "diell", "ftoht", "nxeht", "lagësht", "erë", "bore", "kthjell"]):
-        qyteti = "Tirana"
-        for k, v in QYTETET_MAP.items():
-            if k in t:
-                qyteti = v
-                break
-        return {"lloj": "mot", "qyteti": qyteti}
+    def _njofto(self):
+        ngjarja, self._ndryshim = self._ndryshim, asyncio.Event()
+        ngjarja.set()
 
-    if any(w in t for w in ["rrugë", "rruge", "trafik", "distanc", "sa kohë", "sa kohe", "km", "makine", "makinë", "udhëtim"]):
-        return {"lloj": "rruge", "text": text}
-    if re.search(r"nga\s+\w+\s+(te|deri|tek|drejt)\s+\w+", t):
-        return {"lloj": "rruge", "text": text}
+    def shto(self, copa: bytes):
+        if not copa:
+            return
+        self.copat.append(copa)
+        self.madhesia += len(copa)
+        if self._depo is not None:
+            self._depo._rrit(len(copa))
+        self._njofto()
 
-    if any(w in t for w in ["sa është ora", "sa eshte ora", "çfarë ore", "cfar ore", "ora tani", "sa orë", "sa ore"]):
-        return {"lloj": "ora"}
+    def mbyll(self, ok: bool):
+        self.ok = ok and self.madhesia > 0
+        self.perfunduar = True
+        self._njofto()
 
-    if any(w in t for w in ["çfarë date", "cfar date", "sa date", "cila ditë", "sot është", "sot eshte", "çfarë dite"]):
-        return {"lloj": "data"}
+    def bytes(self) -> bytes:
+        return b"".join(self.copat)
 
-    if any(w in t for w in ["alarm", "më zgjo", "me zgjo", "zgjom", "vendos alarm"]):
-        return {"lloj": "alarm", "text": text}
+    async def te_gjitha(self) -> bytes:
+        return self.bytes()
 
-    if any(w in t for w in ["timer", "kujto pas", "pas 5", "pas 10", "pas 15", "pas 20", "pas 30", "pas një", "pas nje"]):
-        return {"lloj": "timer", "text": text}
+    async def rrjedha(self) -> AsyncIterator[bytes]:
+        """Jep copat që ka dhe pret të rejat derisa sinteza të mbarojë"""
+        i = 0
+        while True:
+            while i < len(self.copat):
+                yield self.copat[i]
+                i += 1
+            if self.perfunduar:
+                return
+            await self._ndryshim.wait()
 
-    if any(w in t for w in ["vetvrasje", "vras veten", "dua te vdes", "jetesa nuk", "s'dua te jetoj", "nuk dua te jetoj"]):
-        return {"lloj": "ndihme_mendore"}
+class DepoAudio:
+    """Audio sipas (device_id, request_id) me buxhet total bajtësh dhe dëbim LRU/TTL"""
 
-    return {"lloj": "ai"}
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.bytes_total = 0
+        self.debuar = 0
+        self._regjistrimet: "OrderedDict[Tuple[str, str], RegjistrimAudio]" = OrderedDict()
+        self._te_fundit: Dict[str, str] = {}
+        self._i_fundit: Optional[Tuple[str, str]] = None   # për pajisjet që s'dërgojnë device_id
 
-# ════════════════════════════════════════════════════════════
-#  SYSTEM PROMPT
-# ════════════════════════════════════════════════════════════
-def krijo_system_prompt(device_id: str) -> str:
-    user   = perdoruesit.get(device_id, {})
-    emri   = user.get("emri", "")
-    qyteti = user.get("qyteti", "Tirana")
-    koha   = koha_tani()
-    data   = data_sot()
-    alarmet_aktiv = len([a for a in alarmet if a.get("aktiv")])
-    emri_str = f"Personi që flet me ty quhet {emri}. Thirre me emër kur është natyrale." if emri else ""
+    def _rrit(self, n: int):
+        self.bytes_total += n
+        if self.bytes_total > self.max_bytes:
+            self._pastro()
 
-    return (
-        f"Ti je Luna - asistentja më e zgjuar dhe më e plotë shqiptare. "
-        f"Ke inteligjencë si një njeri që di gjithçka - historian, mjek, jurist, inxhinier, këshilltar. "
-        f"Ora tani është {koha}. Sot është {data}. Qyteti bazë: {qyteti}. "
-        f"{emri_str} Alarme aktive: {alarmet_aktiv}.\n\n"
-        f"RREGULLAT E HEKURTA:\n"
-        f"1. Gjithmonë përgjigju në SHQIP - kurrë në gjuhë tjetër.\n"
-        f"2. Arsyeto si njeri i mençur - mos thuaj kurrë 'nuk e di' pa u përpjekur.\n"
-        f"3. Nëse nuk je e sigurt për diçka - thuaj çfarë di dhe shto 'por mund të kem nevojë ta verifikoj'.\n"
-        f"4. Mos përdor fjalë banale si: 'Kurve', 'Kar', 'Qij', 'bythqire', 'Varikars'.\n"
-        f"5. Mos përdor emoji - flet me zë, jo me shkrim.\n"
-        f"6. Për çështje të rënda si shëndetin, ligjin, financat - jep informacion real dhe praktik.\n"
-        f"7. Për çështje emocionale - ji e ngrohtë, dëgjo dhe këshillo si mik i vërtetë.\n"
-        f"8. Kur dikush ka nevojë për ndihmë urgjente - drejtoji te shërbime profesionale.\n"
-        f"9. Përgjigju me gjatësinë e duhur - shkurt për pyetje të thjeshta, gjatë për pyetje komplekse.\n"
-        f"10. Kujto gjithmonë bisedën e mëparshme dhe bëj lidhje me të.\n"
-        f"11. Ti je e ndërtuar nga një shqiptar i talentuar - ke krenari kombëtare.\n"
-        f"12. Emri yt është Luna - asistentja e parë dhe më e mira inteligjente shqiptare."
-    )
+    def _hiq(self, celesi: Tuple[str, str]):
+        reg = self._regjistrimet.pop(celesi, None)
+        if reg is None:
+            return
+        reg._depo = None
+        self.bytes_total -= reg.madhesia
+        if self._te_fundit.get(celesi[0]) == celesi[1]:
+            del self._te_fundit[celesi[0]]
+        if self._i_fundit == celesi:
+            self._i_fundit = None
 
-# ════════════════════════════════════════════════════════════
-#  AI KRYESOR
-# ════════════════════════════════════════════════════════════
-async def pyete_ai(mesazhet: list) -> str:
-    try:
-        async with httpx.AsyncClient(timeout=30) as client:
-            r = await client.post(
-                "https://api.groq.com/openai/v1/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {GROQ_API_KEY}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "model": "llama-3.3-70b-versatile",
-                    "messages": mesazhet,
-                    "temperature": 0.75,
-                    "max_tokens": 400
-                }
-            )
-            data = r.json()
-            return data["choices"][0]["message"]["content"].strip()
-    except Exception as e:
-        print(f"Gabim AI: {e}")
-        return "Pata një problem të vogël teknik. Provo përsëri!"
+    def _pastro(self):
+        tani = time.monotonic()
+        for celesi, reg in list(self._regjistrimet.items()):
+            if tani - reg.perdorur > self.ttl:
+                self._hiq(celesi)
+                self.debuar += 1
+        # Mbi buxhet - hiq më të vjetrat, fillimisht ato që kanë mbaruar
+        for vetem_te_mbaruara in (True, False):
+            for celesi, reg in list(self._regjistrimet.items()):
+                if self.bytes_total <= self.max_bytes:
+                    return
+                if vetem_te_mbaruara and not reg.perfunduar:
+                    continue
+                self._hiq(celesi)
+                self.debuar += 1
 
-async def pergjigja_me_kerkime(device_id: str, teksti_user: str) -> str:
-    """AI me web search automatik nëse nuk di përgjigjen"""
+    async def krijo(self, device_id: str, request_id: str) -> RegjistrimAudio:
+        self._pastro()
+        reg = RegjistrimAudio(self)
+        self._regjistrimet[(device_id, request_id)] = reg
+        self._te_fundit[device_id] = request_id
+        self._i_fundit = (device_id, request_id)
+        return reg
 
-    # Pyetja e parë te AI
-    bisedat[device_id].append({"role": "user", "content": teksti_user})
-    pergjigja1 = await pyete_ai(bisedat[device_id])
+    def _celesi(self, device_id: Optional[str], request_id: Optional[str]) -> Optional[Tuple[str, str]]:
+        """Pa device_id (firmware i vjetër): regjistrimi më i fundit i cilësdo pajisjeje, si dikur"""
+        if device_id is None:
+            if request_id is None:
+                return self._i_fundit
+            return next((c for c in self._regjistrimet if c[1] == request_id), None)
+        request_id = request_id or self._te_fundit.get(device_id)
+        return None if request_id is None else (device_id, request_id)
 
-    # Kontrollo nëse AI ka nevojë për informacion
-    if await duhet_kerkuar(teksti_user, pergjigja1):
-        print(f"Kërkoj në web për: {teksti_user}")
+    async def merr(self, device_id: Optional[str], request_id: Optional[str] = None) -> Optional[RegjistrimAudio]:
+        celesi = self._celesi(device_id, request_id)
+        reg = self._regjistrimet.get(celesi) if celesi else None
+        if reg is None:
+            return None
+        if time.monotonic() - reg.perdorur > self.ttl:
+            self._hiq(celesi)
+            self.debuar += 1
+            return None
+        reg.perdorur = time.monotonic()
+        self._regjistrimet.move_to_end(celesi)
+        return reg
 
-        # Kërko në web
-        info_web = await kerko_web(teksti_user)
+    async def fshi(self, device_id: Optional[str], request_id: Optional[str] = None):
+        celesi = self._celesi(device_id, request_id)
+        if celesi is not None:
+            self._hiq(celesi)
 
-        if info_web:
-            # Rishpjego me informacionin e gjetur
-            mesazhet_te_reja = bisedat[device_id].copy()
-            mesazhet_te_reja.append({
-                "role": "system",
-                "content": (
-                    f"Informacion i gjetur nga interneti për pyetjen '{teksti_user}':\n{info_web}\n\n"
-                    f"Përdor këtë informacion për të dhënë një përgjigje të plotë dhe të saktë në shqip. "
-                    f"Mos thuaj 'sipas internetit' ose 'sipas kërkimit' - thjesht përgjigju natyrshëm."
-                )
-            })
-            pergjigja_finale = await pyete_ai(mesazhet_te_reja)
-            bisedat[device_id].append({"role": "assistant", "content": pergjigja_finale})
-            return pergjigja_finale
+    def statistika(self) -> dict:
+        return {
+            "regjistrime": len(self._regjistrimet),
+            "bytes": self.bytes_total,
+            "max_bytes": self.max_bytes,
+            "debuar": self.debuar,
+        }
 
-    bisedat[device_id].append({"role": "assistant", "content": pergjigja1})
-    return pergjigja1
+class RegjistrimAudioSQLite(RegjistrimAudio):
+    """Regjistrim që shkruan copat edhe në SQLite, që t'i lexojnë edhe workers të tjerë.
 
-# ════════════════════════════════════════════════════════════
-#  ENDPOINTS
-# ════════════════════════════════════════════════════════════
+    Copat grumbullohen ndërsa shkrimi i mëparshëm është në thread-in e bazës dhe
+    shkruhen bashkë, me një transaksion; mbyllja shkruhet pas copës së fundit."""
 
-@app.get("/")
-async def root():
-    return {"status": "Luna AI është aktive!", "version": "4.0"}
+    def __init__(self, depo: "DepoAudioSQLite", device_id: str, request_id: str):
+        super().__init__(None)
+        self._depo_sql = depo
+        self._celesi = (device_id, request_id)
+        self._pa_shkruar: List[Tuple[int, bytes]] = []
+        self._ne_shkrim = False
 
-@app.post("/regjistro")
-async def regjistro(body: RegjistroBody):
-    perdoruesit[body.device_id] = {"emri": body.emri, "qyteti": body.qyteti or "Tirana"}
-    pergjigja = f"Mirë se vjen {body.emri}! Jam Luna, asistentja jote shqiptare. Si mund të të ndihmoj?"
-    await tts_edge(pergjigja)
-    return {"answer": pergjigja, "ok": True}
+    def shto(self, copa: bytes):
+        if not copa:
+            return
+        super().shto(copa)
+        self._pa_shkruar.append((len(self.copat) - 1, copa))
+        if not self._ne_shkrim:
+            self._shkruaj()
 
-@app.post("/transcribe")
-async def transcribe(audio: UploadFile = File(...)):
-    try:
-        audio_bytes = await audio.read()
-        async with httpx.AsyncClient(timeout=30) as client:
-            r = await client.post(
-                "https://api.groq.com/openai/v1/audio/transcriptions",
-                headers={"Authorization": f"Bearer {GROQ_API_KEY}"},
-                files={"file": (audio.filename or "audio.wav", audio_bytes, "audio/wav")},
-                data={"model": "whisper-large-v3", "language": "sq", "response_format": "json"}
-            )
-            teksti = r.json().get("text", "").strip()
-            return {"text": teksti}
-    except Exception as e:
-        return {"text": "", "error": str(e)}
+    def _shkruaj(self):
+        copat, self._pa_shkruar = self._pa_shkruar, []
+        self._ne_shkrim = True
+        loop = asyncio.get_running_loop()
+        f = ne_db_sfond(self._depo_sql._shto_copat, *self._celesi, copat)
+        f.add_done_callback(lambda _: loop.call_soon_threadsafe(self._u_shkrua))
 
-@app.post("/ask")
-async def ask(body: AskBody):
-    global audio_ready, current_audio_data
+    def _u_shkrua(self):
+        self._ne_shkrim = False
+        if self._pa_shkruar and not self.perfunduar:
+            self._shkruaj()
 
-    if body.emri:
-        if body.device_id not in perdoruesit:
-            perdoruesit[body.device_id] = {}
-        perdoruesit[body.device_id]["emri"] = body.emri
+    def mbyll(self, ok: bool):
+        super().mbyll(ok)
+        copat, self._pa_shkruar = self._pa_shkruar, []
+        f = ne_db_sfond(self._depo_sql._shto_copat, *self._celesi, copat, self.ok)
+        loop = asyncio.get_running_loop()
+        f.add_done_callback(lambda _: loop.call_soon_threadsafe(self._depo_sql._lokale.pop, self._celesi, None))
 
-    user   = perdoruesit.get(body.device_id, {})
-    emri   = user.get("emri", "")
+class LexuesAudioSQLite:
+    """Lexon një regjistrim nga SQLite - copat e reja merren me polling të shkurtër"""
 
-    if body.device_id not in bisedat:
-        bisedat[body.device_id] = [
-            {"role": "system", "content": krijo_system_prompt(body.device_id)}
-        ]
-    else:
-        bisedat[body.device_id][0]["content"] = krijo_system_prompt(body.device_id)
+    def __init__(self, depo: "DepoAudioSQLite", device_id: str, request_id: str,
+                 madhesia: int, perfunduar: bool, ok: bool):
+        self._depo = depo
+        self._celesi = (device_id, request_id)
+        self.madhesia = madhesia
+        self.perfunduar = perfunduar
+        self.ok = ok
 
-    intent = detekto_intent(body.text)
-    pergjigja = ""
+    async def te_gjitha(self) -> bytes:
+        _, copat = await ne_db(self._depo._copat, *self._celesi, 0)
+        return b"".join(copat)
 
-    if intent["lloj"] == "mot":
-        pergjigja = await merre_motin(intent["qyteti"])
+    async def rrjedha(self) -> AsyncIterator[bytes]:
+        nr = 0
+        while True:
+            perfunduar, copat = await ne_db(self._depo._copat, *self._celesi, nr)
+            for copa in copat:
+                nr += 1
+                yield copa
+            if perfunduar:
+                return
+            await asyncio.sleep(self._depo.interval_leximi)
 
-    elif intent["lloj"] == "rruge":
-        t = body.text.lower()
-        match = re.search(
-            r"nga\s+([a-zëçë\s]+?)\s+(?:te|deri|tek|drejt)\s+([a-zëçë\s]+?)(?:\s+me makine|\s+me makinë|\s+me auto|$)", t
-        )
-        if match:
-            pergjigja = await merre_rrugën(match.group(1).strip(), match.group(2).strip())
-        else:
-            pergjigja = await pergjigja_me_kerkime(body.device_id, body.text)
+class DepoAudioSQLite:
+    """Si DepoAudio, por e përbashkët mes proceseve përmes SQLite.
 
-    elif intent["lloj"] == "ora":
-        ora = koha_tani()
-        pergjigja = f"Ora tani është {ora}." if not emri else f"{emri}, ora tani është {ora}."
+    Regjistrimet që po sintetizohen në këtë worker lexohen nga memoria (`_lokale`);
+    SQLite u shërben workers të tjerë dhe kërkesave pasi sinteza ka mbaruar."""
 
-    elif intent["lloj"] == "data":
-        pergjigja = f"Sot është {data_sot()}."
+    def __init__(self, shteg: str, max_bytes: int, ttl: float, interval_leximi: float = 0.05):
+        self.shteg = shteg
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.interval_leximi = interval_leximi
+        self.debuar = 0
+        self._pastruar = 0.0
+        self._lokale: Dict[Tuple[str, str], RegjistrimAudioSQLite] = {}
+        self._statistika = StatistikaSQLite(self._llogarit_statistikat, {"regjistrime": 0, "bytes": 0})
+        ne_db_tani(self._krijo_tabelat)
 
-    elif intent["lloj"] == "alarm":
-        match = re.search(r"(\d{1,2})[:\.](\d{2})", body.text)
-        if match:
-            ora_alarm = f"{match.group(1).zfill(2)}:{match.group(2)}"
-            alarmet.append({"ora": ora_alarm, "etiketa": "Alarm", "aktiv": True, "device_id": body.device_id})
-            pergjigja = f"Alarmi u vendos për orën {ora_alarm}."
-            if emri:
-                pergjigja = f"{emri}, alarmi u vendos për orën {ora_alarm}. Do të të zgjoj unë!"
-        else:
-            pergjigja = "Më thuaj orën e saktë, për shembull: vendos alarm në 07:30."
+    def _krijo_tabelat(self):
+        db = self._db
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS audio (device_id TEXT, request_id TEXT, krijuar REAL, perdorur REAL, "
+            "perfunduar INTEGER DEFAULT 0, ok INTEGER DEFAULT 0, madhesia INTEGER DEFAULT 0, "
+            "PRIMARY KEY (device_id, request_id))"
+        )
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS audio_copat (device_id TEXT, request_id TEXT, nr INTEGER, data BLOB, "
+            "PRIMARY KEY (device_id, request_id, nr))"
+        )
+        db.execute("CREATE INDEX IF NOT EXISTS audio_krijuar ON audio (krijuar)")
 
-    elif intent["lloj"] == "timer":
-        match = re.search(r"(\d+)\s*(minut|sekond|orë|ore|min)", body.text.lower())
-        if match:
-            sasia  = int(match.group(1))
-            njesia = match.group(2)
-            sekonda = sasia * (1 if "sekond" in njesia else 3600 if "orë" in njesia or "ore" in njesia else 60)
-            njesia_str = "sekonda" if "sekond" in njesia else "orë" if "orë" in njesia or "ore" in njesia else "minuta"
-            fund = datetime.now(TZ) + timedelta(seconds=sekonda)
-            timerat.append({"fund": fund.isoformat(), "sekonda": sekonda, "device_id": body.device_id})
-            pergjigja = f"Timer vendosur për {sasia} {njesia_str}."
-        else:
-            pergjigja = "Sa minuta të vendos timerin?"
+    # Metodat me _ ekzekutohen në thread-in e bazës
+    @property
+    def _db(self) -> sqlite3.Connection:
+        return lidhja_sqlite(self.shteg)
 
-    elif intent["lloj"] == "ndihme_mendore":
-        pergjigja = (
-            "Kuptoj që po kalon momente shumë të vështira dhe jam këtu me ty. "
-            "Çfarë po ndjen tani? Dëshiroj të dëgjoj. "
-            "Nëse ke nevojë urgjente për ndihmë, linja e krizës në Shqipëri është 0800 1212 - falas, 24 orë."
-        )
+    def _shto_copat(self, device_id: str, request_id: str, copat: List[Tuple[int, bytes]],
+                    mbyllur: Optional[bool] = None):
+        """Copat e grumbulluara në një transaksion; me `mbyllur` shënohet edhe fundi i sintezës"""
+        with self._db:
+            self._db.execute("BEGIN IMMEDIATE")
+            if copat:
+                self._db.executemany("INSERT OR REPLACE INTO audio_copat VALUES (?, ?, ?, ?)",
+                                     [(device_id, request_id, nr, copa) for nr, copa in copat])
+                self._db.execute("UPDATE audio SET madhesia = madhesia + ? WHERE device_id = ? AND request_id = ?",
+                                 (sum(len(c) for _, c in copat), device_id, request_id))
+            if mbyllur is not None:
+                self._db.execute("UPDATE audio SET perfunduar = 1, ok = ? WHERE device_id = ? AND request_id = ?",
+                                 (int(mbyllur), device_id, request_id))
 
-    else:
-        pergjigja = await pergjigja_me_kerkime(body.device_id, body.text)
+    def _copat(self, device_id: str, request_id: str, nga_nr: int) -> Tuple[bool, List[bytes]]:
+        """Gjendja lexohet para copave: kur del e përfunduar, copat e kthyera janë të gjitha"""
+        rreshti = self._db.execute("SELECT perfunduar FROM audio WHERE device_id = ? AND request_id = ?",
+                                   (device_id, request_id)).fetchone()
+        copat = [r[0] for r in self._db.execute(
+            "SELECT data FROM audio_copat WHERE device_id = ? AND request_id = ? AND nr >= ? ORDER BY nr",
+            (device_id, request_id, nga_nr))]
+        return rreshti is None or bool(rreshti[0]), copat
 
-    # Mbaj 20 mesazhet e fundit
-    if len(bisedat.get(body.device_id, [])) > 21:
-        bisedat[body.device_id] = [bisedat[body.device_id][0]] + bisedat[body.device_id][-20:]
+    def _hiq(self, device_id: str, request_id: str):
+        self._db.execute("DELETE FROM audio WHERE device_id = ? AND request_id = ?", (device_id, request_id))
+        self._db.execute("DELETE FROM audio_copat WHERE device_id = ? AND request_id = ?", (device_id, request_id))
 
-    # Gjenero zërin
-    audio_ready = False
-    current_audio_data = b""
-    ok = await tts_edge(pergjigja)
-    if ok:
-        audio_ready = True
+    def _pastro(self):
+        te_vjetra = self._db.execute("SELECT device_id, request_id FROM audio WHERE perdorur < ?",
+                                     (time.time() - self.ttl,)).fetchall()
+        for celesi in te_vjetra:
+            self._hiq(*celesi)
+            self.debuar += 1
+        total = self._db.execute("SELECT COALESCE(SUM(madhesia), 0) FROM audio").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # Mbi buxhet - hiq më të vjetrat, fillimisht ato që kanë mbaruar
+        for device_id, request_id, madhesia in self._db.execute(
+                "SELECT device_id, request_id, madhesia FROM audio ORDER BY perfunduar DESC, perdorur").fetchall():
+            if total <= self.max_bytes:
+                break
+            self._hiq(device_id, request_id)
+            self.debuar += 1
+            total -= madhesia
 
-    return {"answer": pergjigja, "intent": intent["lloj"]}
+    def _krijo(self, device_id: str, request_id: str, tani: float):
+        self._db.execute("INSERT OR REPLACE INTO audio (device_id, request_id, krijuar, perdorur) VALUES (?, ?, ?, ?)",
+                         (device_id, request_id, tani, tani))
+
+    def _merr(self, device_id: Optional[str], request_id: Optional[str]) -> Optional[Tuple]:
+        # Pa device_id (firmware i vjetër): regjistrimi më i fundit i cilësdo pajisjeje
+        kushtet, parametrat = [], []
+        if device_id is not None:
+            kushtet.append("device_id = ?")
+            parametrat.append(device_id)
+        if request_id is not None:
+            kushtet.append("request_id = ?")
+            parametrat.append(request_id)
+        ku = f"WHERE {' AND '.join(kushtet)} " if kushtet else ""
+        rreshti = self._db.execute(
+            f"SELECT device_id, request_id, madhesia, perfunduar, ok, perdorur FROM audio {ku}"
+            "ORDER BY krijuar DESC LIMIT 1", parametrat).fetchone()
+        if rreshti is None:
+            return None
+        if time.time() - rreshti[5] > self.ttl:
+            self._hiq(rreshti[0], rreshti[1])
+            self.debuar += 1
+            return None
+        self._db.execute("UPDATE audio SET perdorur = ? WHERE device_id = ? AND request_id = ?",
+                         (time.time(), rreshti[0], rreshti[1]))
+        return rreshti
+
+    def _llogarit_statistikat(self) -> dict:
+        regjistrime, total = self._db.execute("SELECT COUNT(*), COALESCE(SUM(madhesia), 0) FROM audio").fetchone()
+        return {"regjistrime": regjistrime, "bytes": total}
+
+    async def krijo(self, device_id: str, request_id: str) -> RegjistrimAudio:
+        # Rreshti duhet të jetë në skedar para se request_id t'i shkojë pajisjes -
+        # /status ose /get_audio mund të vijnë te një worker tjetër
+        tani = time.time()
+        await ne_db(self._krijo, device_id, request_id, tani)
+        reg = self._lokale[(device_id, request_id)] = RegjistrimAudioSQLite(self, device_id, request_id)
+        # Pastrimi (skanim i tabelës) bëhet rrallë, më vete, pa mbajtur bllokimin e shkrimit të INSERT-it
+        if tani - self._pastruar >= SQLITE_PASTRIMI_S:
+            self._pastruar = tani
+            ne_db_sfond(self._pastro)
+        return reg
+
+    async def merr(self, device_id: Optional[str], request_id: Optional[str] = None):
+        rreshti = await ne_db(self._merr, device_id, request_id)
+        if rreshti is None:
+            return None
+        device_id, request_id, madhesia, perfunduar, ok, _ = rreshti
+        lokal = self._lokale.get((device_id, request_id))
+        if lokal is not None:
+            return lokal
+        return LexuesAudioSQLite(self, device_id, request_id, madhesia, bool(perfunduar), bool(ok))
+
+    async def fshi(self, device_id: Optional[str], request_id: Optional[str] = None):
+        rreshti = await ne_db(self._merr, device_id, request_id)
+        if rreshti is not None:
+            await ne_db(self._hiq, rreshti[0], rreshti[1])
+
+    def statistika(self) -> dict:
+        return {**self._statistika.merr(), "max_bytes": self.max_bytes, "debuar": self.debuar}
+
+_detyrat: set = set()
+
+def nis_detyre(coro) -> asyncio.Task:
+    """Nis një detyrë në sfond dhe mban referencë derisa të mbarojë"""
+    detyre = asyncio.create_task(coro)
+    _detyrat.add(detyre)
+    detyre.add_done_callback(_detyrat.discard)
+    return detyre
+
+# ════════════════════════════════════════════════════════════
+#  TTS CACHE
+# ════════════════════════════════════════════════════════════
+class CacheTTS:
+    """Cache sipas përmbajtjes: LRU në memorie + nivel opsional në disk që mbijeton restart-in"""
+
+    def __init__(self, max_bytes: int, dir_disk: str = "", disk_max_bytes: int = 0):
+        self.max_bytes = max_bytes
+        self.bytes_total = 0
+        self.dir_disk = dir_disk
+        self.disk_max_bytes = disk_max_bytes
+        self.disk_bytes = 0
+        self.hits_memorie = 0
+        self.hits_disk = 0
+        self.misses = 0
+        self._memorie: "OrderedDict[str, bytes]" = OrderedDict()
+        self._disk: "OrderedDict[str, int]" = OrderedDict()
+        if dir_disk:
+            os.makedirs(dir_disk, exist_ok=True)
+            skedaret = [e for e in os.scandir(dir_disk) if e.is_file() and e.name.endswith(".mp3")]
+            for e in sorted(skedaret, key=lambda e: e.stat().st_mtime):
+                self._disk[e.name[:-4]] = e.stat().st_size
+                self.disk_bytes += e.stat().st_size
+
+    @staticmethod
+    def celesi(text: str, zeri: str, shpejtesia: str, volumi: str) -> str:
+        return hashlib.sha256("\x1f".join((text, zeri, shpejtesia, volumi)).encode()).hexdigest()
+
+    def _shteg(self, celesi: str) -> str:
+        return os.path.join(self.dir_disk, celesi + ".mp3")
+
+    def _ne_memorie(self, celesi: str, audio: bytes):
+        if len(audio) > self.max_bytes:
+            return
+        vjeter = self._memorie.pop(celesi, None)
+        if vjeter is not None:
+            self.bytes_total -= len(vjeter)
+        self._memorie[celesi] = audio
+        self.bytes_total += len(audio)
+        while self.bytes_total > self.max_bytes:
+            _, hequr = self._memorie.popitem(last=False)
+            self.bytes_total -= len(hequr)
+
+    def _lexo_disk(self, celesi: str) -> Optional[bytes]:
+        try:
+            with open(self._shteg(celesi), "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    # Në thread vetëm skedarët - indeksi _disk dhe disk_bytes ndryshojnë vetëm në event loop
+    def _shkruaj_disk(self, celesi: str, audio: bytes):
+        shteg = self._shteg(celesi)
+        tmp = f"{shteg}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(audio)
+        os.replace(tmp, shteg)
+
+    def _fshi_disk(self, celesat: List[str]):
+        for celesi in celesat:
+            try:
+                os.remove(self._shteg(celesi))
+            except OSError:
+                pass
+
+    async def merr(self, celesi: str, numero: bool = True) -> Optional[bytes]:
+        """`numero=False` për ngrohjen - që hits/misses të tregojnë vetëm kërkesat e vërteta"""
+        audio = self._memorie.get(celesi)
+        if audio is not None:
+            self._memorie.move_to_end(celesi)
+            self.hits_memorie += numero
+            return audio
+        if self.dir_disk:
+            # Provo skedarin edhe kur s'është në indeks - mund ta ketë shkruar një worker tjetër
+            audio = await asyncio.to_thread(self._lexo_disk, celesi)
+            if audio:
+                if celesi not in self._disk:
+                    self.disk_bytes += len(audio)
+                self._disk[celesi] = len(audio)
+                self._disk.move_to_end(celesi)
+                self._ne_memorie(celesi, audio)
+                self.hits_disk += numero
+                return audio
+            self.disk_bytes -= self._disk.pop(celesi, 0)
+        self.misses += numero
+        return None
+
+    async def vendos(self, celesi: str, audio: bytes):
+        self._ne_memorie(celesi, audio)
+        if not self.dir_disk:
+            return
+        try:
+            await asyncio.to_thread(self._shkruaj_disk, celesi, audio)
+        except OSError as e:
+            print(f"Gabim cache TTS në disk: {e}")
+            return
+        self.disk_bytes += len(audio) - self._disk.pop(celesi, 0)
+        self._disk[celesi] = len(audio)
+        te_vjetra = []
+        while self.disk_bytes > self.disk_max_bytes and self._disk:
+            vjeter, madhesia = self._disk.popitem(last=False)
+            self.disk_bytes -= madhesia
+            te_vjetra.append(vjeter)
+        if te_vjetra:
+            await asyncio.to_thread(self._fshi_disk, te_vjetra)
+
+    def statistika(self) -> dict:
+        kerkesa = self.hits_memorie + self.hits_disk + self.misses
+        return {
+            "hits_memorie": self.hits_memorie,
+            "hits_disk": self.hits_disk,
+            "misses": self.misses,
+            "hit_ratio": round((self.hits_memorie + self.hits_disk) / kerkesa, 3) if kerkesa else 0.0,
+            "hyrje": len(self._memorie),
+            "bytes": self.bytes_total,
+            "disk_hyrje": len(self._disk),
+            "disk_bytes": self.disk_bytes,
+        }
+
+cache_tts = CacheTTS(TTS_CACHE_MAX_BYTES, TTS_CACHE_DIR, TTS_CACHE_DISK_MAX_BYTES)
+
+Metrika("luna_cache_tts_total", "Kërkesat në cache-in e zërit sipas rezultatit", "counter", ("rezultati",),
+        lexo=lambda: {("hit_memorie",): cache_tts.hits_memorie, ("hit_disk",): cache_tts.hits_disk,
+                      ("miss",): cache_tts.misses})
+Metrika("luna_cache_tts_bytes", "Bytes në cache-in e zërit", "gauge", ("niveli",),
+        lexo=lambda: {("memorie",): cache_tts.bytes_total, ("disk",): cache_tts.disk_bytes})
+
+# ════════════════════════════════════════════════════════════
+#  TTS
+# ════════════════════════════════════════════════════════════
+def pastro_tekstin_tts(text: str) -> str:
+    text_clean = re.sub(r'[\U00010000-\U0010ffff]', '', text)
+    return re.sub(r'[*#_~`]', '', text_clean).strip()
+
+async def tts_edge(text: str, regjistrim: RegjistrimAudio, ngrohje: bool = False) -> bool:
+    """Sinteza ka afatin e vet: teksti i përgjigjes ka dalë tashmë, zëri nuk duhet ta humbasë
+    për shkak të afatit të tekstit - por as të rrijë pa fund. Pas afatit: tekst pa audio."""
+    with mat("tts"), me_afat(AFATI_TTS_S, zevendeso=True):
+        try:
+            return await brenda_afatit(_tts_edge(text, regjistrim, ngrohje))
+        except asyncio.TimeoutError:
+            m_afati_kaloi.shto(1, "tts")
+            print(f"TTS kaloi afatin ({AFATI_TTS_S:.0f}s): {text[:40]!r}")
+            return False
+
+async def _copat_edge(text_clean: str) -> AsyncIterator[bytes]:
+    import edge_tts
+    communicate = edge_tts.Communicate(text_clean, TTS_ZERI, rate=TTS_SHPEJTESIA, volume=TTS_VOLUMI)
+    async for chunk in communicate.stream():
+        if chunk["type"] == "audio":
+            yield chunk["data"]
+
+async def _copat_http(text_clean: str) -> AsyncIterator[bytes]:
+    """TTS përmes HTTP: POST /tts me tekstin, kthen MP3 me chunked transfer"""
+    async with klienti("tts").stream(
+        "POST",
+        "/tts",
+        json={"text": text_clean, "voice": TTS_ZERI, "rate": TTS_SHPEJTESIA, "volume": TTS_VOLUMI}
+    ) as r:
+        r.raise_for_status()
+        async for copa in r.aiter_bytes():
+            yield copa
+
+async def _tts_edge(text: str, regjistrim: RegjistrimAudio, ngrohje: bool = False) -> bool:
+    ok = False
+    try:
+        text_clean = pastro_tekstin_tts(text)
+        if not text_clean:
+            return False
+        celesi = CacheTTS.celesi(text_clean, TTS_ZERI, TTS_SHPEJTESIA, TTS_VOLUMI)
+        audio = await cache_tts.merr(celesi, numero=not ngrohje)
+        if audio:
+            regjistrim.shto(audio)
+            ok = True
+            return ok
+        copat = _copat_http if TTS_BACKEND == "http" else _copat_edge
+        async with radhet["tts"].vend():
+            async for copa in copat(text_clean):
+                regjistrim.shto(copa)
+        ok = regjistrim.madhesia > 0
+        if ok:
+            await cache_tts.vendos(celesi, regjistrim.bytes())
+        return ok
+    except Exception as e:
+        print(f"Gabim TTS ({TTS_BACKEND}): {e}")
+        return False
+    finally:
+        regjistrim.mbyll(ok)
+
+def frazat_per_ngrohje() -> List[str]:
+    """Frazat që Luna i thotë fjalë për fjalë - përfshi të 1440 oraret e ditës"""
+    frazat = [FRAZA_NDIHME_MENDORE, FRAZA_ALARM_SHEMBULL, FRAZA_TIMER_PYETJE,
+              FRAZA_GABIM_AI, FRAZA_GABIM_RRUGE, FRAZA_VONESE]
+    frazat += [f"Ora tani është {h:02d}:{m:02d}." for h in range(24) for m in range(60)]
+    return frazat
+
+def _merr_ngrohjen(dir_disk: str) -> Optional[str]:
+    """Vetëm një worker ngroh cache-in në disk; të tjerët i lexojnë frazat prej andej.
+
+    Kthen shtegun e bllokimit, ose None kur e mban një worker tjetër (bllokimi më i vjetër
+    se një orë konsiderohet i mbetur nga një proces që ka rënë)."""
+    shteg = os.path.join(dir_disk, ".ngrohje")
+    try:
+        os.close(os.open(shteg, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        return shteg
+    except FileExistsError:
+        try:
+            if time.time() - os.path.getmtime(shteg) < 3600:
+                return None
+            os.utime(shteg)
+            return shteg
+        except OSError:
+            return None
+
+async def ngrohe_cache_tts():
+    """Sintetizon frazat fikse në sfond që përgjigjet e tyre të dalin nga cache-i në disk"""
+    bllokimi = _merr_ngrohjen(cache_tts.dir_disk)
+    if bllokimi is None:
+        print("Cache TTS po ngrohet nga një worker tjetër")
+        return
+    frazat = iter(frazat_per_ngrohje())
+    gjendja = {"ok": 0, "deshtuar": 0}
+
+    async def punetor():
+        for fraza in frazat:
+            # Nëse shërbimi i zërit nuk arrihet fare, mos e provo 1440 herë
+            if gjendja["deshtuar"] >= 10 and not gjendja["ok"]:
+                return
+            # Kërkesat e vërteta kanë përparësi në radhën e zërit
+            while radhet["tts"].ne_pritje > 0:
+                await asyncio.sleep(0.5)
+            if await tts_edge(fraza, RegjistrimAudio(None), ngrohje=True):
+                gjendja["ok"] += 1
+            else:
+                gjendja["deshtuar"] += 1
+
+    try:
+        await asyncio.gather(*(punetor() for _ in range(TTS_PREWARM_PARALEL)))
+    finally:
+        try:
+            os.remove(bllokimi)
+        except OSError:
+            pass
+    print(f"Cache TTS i ngrohur: {gjendja['ok']} fraza, {gjendja['deshtuar']} dështime")
+
+async def _zeri_me_njoftim(text: str, regjistrim: RegjistrimAudio, device_id: str, request_id: str):
+    sinteza = asyncio.ensure_future(tts_edge(text, regjistrim))
+    # Njofto pajisjen sapo të ketë copën e parë, jo kur të mbarojë e gjithë sinteza
+    while regjistrim.madhesia == 0 and not regjistrim.perfunduar:
+        await regjistrim._ndryshim.wait()
+    kanalet.publiko(device_id, "audio", {
+        "request_id": request_id,
+        "ok": regjistrim.madhesia > 0,
+        "url": f"/get_audio?device_id={quote(device_id)}&request_id={request_id}",
+    })
+    await sinteza
+
+async def nis_zerin(text: str, device_id: str, intent: Optional[str] = None) -> str:
+    """Nis sintezën në sfond dhe kthen request_id që pajisja e përdor te /get_audio"""
+    request_id = uuid.uuid4().hex[:12]
+    regjistrim = await depo_audio.krijo(device_id, request_id)
+    kanalet.publiko(device_id, "pergjigje", {"request_id": request_id, "answer": text, "intent": intent})
+    nis_detyre(_zeri_me_njoftim(text, regjistrim, device_id, request_id))
+    return request_id
+
+# ════════════════════════════════════════════════════════════
+#  TRANSKRIPTIMI
+# ════════════════════════════════════════════════════════════
+class GabimAudio(Exception):
+    """Audio e ngarkuar nuk pranohet - mban statusin HTTP që i kthehet pajisjes"""
+
+    def __init__(self, statusi: int, mesazhi: str):
+        super().__init__(mesazhi)
+        self.statusi = statusi
+
+def _audioop():
+    """audioop është në stdlib deri në Python 3.12 (më pas paketa audioop-lts) - pa të audio dërgohet siç është"""
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", DeprecationWarning)
+            import audioop
+        return audioop
+    except ImportError:
+        return None
+
+def njih_formatin(koka: bytes) -> Optional[Tuple[str, str]]:
+    """Formati i vërtetë nga bytes-at e parë: (mime, prapashtesa) - pa i besuar emrit apo Content-Type"""
+    if koka[:4] == b"RIFF" and koka[8:12] == b"WAVE":
+        return "audio/wav", "wav"
+    if koka[:4] == b"OggS":
+        return "audio/ogg", "ogg"
+    if koka[:4] == b"fLaC":
+        return "audio/flac", "flac"
+    if koka[:4] == b"\x1aE\xdf\xa3":
+        return "audio/webm", "webm"
+    if koka[4:8] == b"ftyp":
+        return "audio/mp4", "m4a"
+    if koka[:3] == b"ID3" or (len(koka) > 1 and koka[0] == 0xFF and koka[1] & 0xE0 == 0xE0):
+        return "audio/mpeg", "mp3"
+    return None
+
+def _bytes_per_sekonde_wav(koka: bytes) -> Optional[int]:
+    """byte_rate nga chunk-u 'fmt ' i WAV, nëse gjendet te bytes-at e parë"""
+    poz = 12
+    while poz + 8 <= len(koka):
+        emri, gjatesia = koka[poz:poz + 4], int.from_bytes(koka[poz + 4:poz + 8], "little")
+        if emri == b"fmt " and poz + 16 <= len(koka):
+            return int.from_bytes(koka[poz + 16:poz + 20], "little") or None
+        poz += 8 + gjatesia + (gjatesia & 1)
+    return None
+
+def kufiri_audios(koka: bytes, mime: str) -> int:
+    """Sa bytes lejohen: TRANSKRIPTIM_MAX_BYTES, ose më pak kur kohëzgjatja del nga header-i"""
+    kufiri = TRANSKRIPTIM_MAX_BYTES
+    if mime == "audio/wav":
+        bps = _bytes_per_sekonde_wav(koka)
+        if bps:
+            kufiri = min(kufiri, 44 + int(bps * TRANSKRIPTIM_MAX_S))
+    return kufiri
+
+def kompakto_wav(wav: bytes) -> Optional[bytes]:
+    """PCM WAV -> 16 kHz mono 16-bit pa heshtjen në fillim e në fund.
+
+    Kthen None kur regjistrimi është vetëm heshtje, dhe audion e pandryshuar
+    kur formati nuk mund të përpunohet këtu."""
+    audioop = _audioop()
+    if audioop is None:
+        return wav
+    try:
+        with wave.open(io.BytesIO(wav)) as w:
+            kanale, gjeresia, shpejtesia = w.getnchannels(), w.getsampwidth(), w.getframerate()
+            pcm = w.readframes(w.getnframes())
+        if not pcm or kanale > 2:
+            return wav
+        if gjeresia == 1:
+            pcm = audioop.bias(pcm, 1, -128)    # WAV 8-bit është pa shenjë
+        if gjeresia != 2:
+            pcm = audioop.lin2lin(pcm, gjeresia, 2)
+        if kanale == 2:
+            pcm = audioop.tomono(pcm, 2, 0.5, 0.5)
+        if shpejtesia != TRANSKRIPTIM_SHPEJTESIA:
+            pcm, _ = audioop.ratecv(pcm, 2, 1, shpejtesia, TRANSKRIPTIM_SHPEJTESIA, None)
+    except (wave.Error, audioop.error, EOFError) as e:
+        print(f"Gabim kompaktimi audio: {e}")
+        return wav
+
+    korniza = TRANSKRIPTIM_SHPEJTESIA * 2 // 50     # 20 ms
+    me_ze = [i for i in range(0, len(pcm), korniza)
+             if audioop.rms(pcm[i:i + korniza], 2) >= TRANSKRIPTIM_HESHTJA_RMS]
+    if not me_ze:
+        return None
+    mbushje = TRANSKRIPTIM_SHPEJTESIA * 2 * TRANSKRIPTIM_MBUSHJE_MS // 1000
+    pcm = pcm[max(0, me_ze[0] - mbushje):me_ze[-1] + korniza + mbushje]
+
+    dalja = io.BytesIO()
+    with wave.open(dalja, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(TRANSKRIPTIM_SHPEJTESIA)
+        w.writeframes(pcm)
+    return dalja.getvalue()
+
+async def _trupi_multipart(kufiri: str, fushat: Dict[str, str], emri_skedarit: str, mime: str,
+                           copat: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """multipart/form-data i ndërtuar gjatë rrugës, që audio të mos mblidhet e gjitha në memorie"""
+    for emri, vlera in fushat.items():
+        yield f'--{kufiri}\r\nContent-Disposition: form-data; name="{emri}"\r\n\r\n{vlera}\r\n'.encode()
+    yield (f'--{kufiri}\r\nContent-Disposition: form-data; name="file"; filename="{emri_skedarit}"\r\n'
+           f"Content-Type: {mime}\r\n\r\n").encode()
+    async for copa in copat:
+        yield copa
+    yield f"\r\n--{kufiri}--\r\n".encode()
+
+async def transkripto(copat: AsyncIterator[bytes], kompakto: bool = TRANSKRIPTIM_KOMPAKTO) -> str:
+    """Dërgon audion te Whisper ndërsa vjen nga pajisja.
+
+    WAV-i PCM kompaktohet (kërkon gjithë skedarin, por brenda kufirit) dhe
+    thirrja riprovohet pas 429; formatet e tjera kalojnë copë pas cope pa
+    riprovim, sepse trupi i rrjedhës nuk mund të dërgohet dy herë."""
+    iteratori = copat.__aiter__()
+    koka = b""
+    while len(koka) < 64:
+        try:
+            koka += await iteratori.__anext__()
+        except StopAsyncIteration:
+            break
+    if not koka:
+        raise GabimAudio(400, "Audio bosh")
+    formati = njih_formatin(koka)
+    if formati is None:
+        raise GabimAudio(415, "Format audio i panjohur")
+    mime, prapashtesa = formati
+    kufiri = kufiri_audios(koka, mime)
+
+    async def brenda_kufirit() -> AsyncIterator[bytes]:
+        madhesia = len(koka)
+        if madhesia > kufiri:
+            raise GabimAudio(413, "Audio shumë e gjatë")
+        yield koka
+        async for copa in iteratori:
+            madhesia += len(copa)
+            if madhesia > kufiri:
+                raise GabimAudio(413, "Audio shumë e gjatë")
+            yield copa
+
+    fushat = {"model": WHISPER_MODELI, "language": "sq", "response_format": "json"}
+    with mat("transkriptim"):
+        return await _dergo_te_whisper(brenda_kufirit(), fushat, mime, prapashtesa, kompakto)
+
+async def _dergo_te_whisper(copat: AsyncIterator[bytes], fushat: Dict[str, str], mime: str,
+                            prapashtesa: str, kompakto: bool) -> str:
+    if kompakto and mime == "audio/wav":
+        wav = b"".join([copa async for copa in copat])
+        wav = await asyncio.to_thread(kompakto_wav, wav)
+        if wav is None:
+            return ""
+        r = await thirr("whisper", lambda: klienti("groq").post(
+            "/audio/transcriptions",
+            files={"file": (f"audio.{prapashtesa}", wav, mime)},
+            data=fushat
+        ))
+    else:
+        kufiri_mp = uuid.uuid4().hex
+        async with radhet["whisper"].vend():
+            r = await klienti("groq").post(
+                "/audio/transcriptions",
+                content=_trupi_multipart(kufiri_mp, fushat, f"audio.{prapashtesa}", mime, copat),
+                headers={"Content-Type": f"multipart/form-data; boundary={kufiri_mp}"}
+            )
+    r.raise_for_status()
+    return r.json().get("text", "").strip()
+
+async def _me_kufi(copat: AsyncIterator[bytes], kufiri: int) -> AsyncIterator[bytes]:
+    """Ndalon me 413 sapo trupi kalon kufirin - edhe kur s'ka Content-Length (chunked)"""
+    madhesia = 0
+    async for copa in copat:
+        madhesia += len(copa)
+        if madhesia > kufiri:
+            raise GabimAudio(413, "Audio shumë e gjatë")
+        yield copa
+
+async def _fusha_multipart(copat: AsyncIterator[bytes], kufiri: bytes, emri: str) -> AsyncIterator[bytes]:
+    """Përmbajtja e një fushe multipart/form-data ndërsa vjen - pa e mbledhur formën në memorie/disk"""
+    ndaresi = b"\r\n--" + kufiri
+    emri_fushes = f'name="{emri}"'.encode()
+    mbetja = b"\r\n"      # që edhe kufiri i parë të ketë "\r\n" para vetes
+    ne_fushe = None         # None = kërkojmë pjesën, True = brenda fushës, False = pjesë tjetër
+    async for copa in copat:
+        mbetja += copa
+        while True:
+            if ne_fushe is None:
+                fillimi = mbetja.find(ndaresi)
+                koka_fund = mbetja.find(b"\r\n\r\n", fillimi + len(ndaresi)) if fillimi >= 0 else -1
+                if koka_fund < 0:
+                    mbetja = mbetja[max(0, fillimi):] if fillimi >= 0 else mbetja[-len(ndaresi):]
+                    break
+                koka = mbetja[fillimi + len(ndaresi):koka_fund]
+                if koka.startswith(b"--"):
+                    raise GabimAudio(400, f"Mungon fusha '{emri}'")
+                ne_fushe = emri_fushes in koka
+                mbetja = mbetja[koka_fund + 4:]
+            fundi = mbetja.find(ndaresi)
+            if fundi < 0:
+                # Mbaj bishtin që mund të jetë fillimi i ndarësit
+                i = max(0, len(mbetja) - len(ndaresi) + 1)
+                if ne_fushe and i:
+                    yield mbetja[:i]
+                mbetja = mbetja[i:]
+                break
+            if ne_fushe:
+                if fundi:
+                    yield mbetja[:fundi]
+                return
+            mbetja = mbetja[fundi:]
+            ne_fushe = None
+    raise GabimAudio(400, f"Mungon fusha '{emri}'")
+
+async def audio_e_kerkeses(request: Request) -> AsyncIterator[bytes]:
+    """Audio si multipart (fusha 'audio') ose si trup i papërpunuar (p.sh. Content-Type: audio/wav).
+
+    Të dyja lexohen si rrjedhë me kufi bajtësh - forma nuk mblidhet e gjitha para kontrollit."""
+    kufiri = TRANSKRIPTIM_MAX_BYTES + 64 * 1024
+    gjatesia = request.headers.get("content-length")
+    if gjatesia and gjatesia.isdigit() and int(gjatesia) > kufiri:
+        raise GabimAudio(413, "Audio shumë e gjatë")
+    trupi = _me_kufi(request.stream(), kufiri)
+    lloji = request.headers.get("content-type", "")
+    if lloji.startswith("multipart/form-data"):
+        m = re.search(r'boundary="?([^";]+)"?', lloji)
+        if m is None:
+            raise GabimAudio(400, "Mungon boundary i multipart")
+        return _fusha_multipart(trupi, m.group(1).encode("latin-1"), "audio")
+    return trupi
+
+# ════════════════════════════════════════════════════════════
+#  BISEDAT DHE PËRDORUESIT
+# ════════════════════════════════════════════════════════════
+ROLET = ("user", "assistant")
+ROLI_KOD = {r: i for i, r in enumerate(ROLET)}
+
+def numero_tokenat(teksti: str) -> int:
+    """Përafrim i tokenave të Llama për tekst shqip (~3 shkronja për token) - pa tokenizer"""
+    return len(teksti) // 3 + 4
+
+def mesazhi_permbledhjes(permbledhje: str) -> Dict:
+    return {"role": "system", "content": f"Përmbledhje e bisedës së mëparshme me këtë përdorues:\n{permbledhje}"}
+
+class Biseda:
+    """Kthesat e një pajisjeje si tuple (kodi i rolit, teksti) - pa fjalor për çdo mesazh.
+
+    `kthesat` janë ato që i dërgohen modelit (brenda buxhetit të tokenave);
+    `jashte` janë kthesat më të vjetra që presin të futen te `permbledhje`.
+    `jashte_fillimi` është numri rendor i `jashte[0]` - nuk ndryshon kur hiqen kthesa nga fundi."""
+    __slots__ = ("system", "kthesat", "tokenat", "jashte", "jashte_fillimi", "permbledhje", "madhesia", "perdorur")
+
+    def __init__(self, kthesat: Optional[List[Tuple[int, str]]] = None,
+                 jashte: Optional[List[Tuple[int, str]]] = None, permbledhje: str = "", jashte_fillimi: int = 0):
+        self.system = ""
+        self.kthesat: List[Tuple[int, str]] = kthesat or []
+        self.jashte: List[Tuple[int, str]] = jashte or []
+        self.jashte_fillimi = jashte_fillimi
+        self.permbledhje = permbledhje
+        self.tokenat = sum(numero_tokenat(t) for _, t in self.kthesat)
+        self.madhesia = sum(len(t) for _, t in self.kthesat + self.jashte) + len(permbledhje)
+        self.perdorur = time.monotonic()
+
+class DepoBisedash:
+    """Bisedat me buxhet global, dëbim LRU/TTL të pajisjeve joaktive dhe derdhje opsionale në SQLite"""
+
+    def __init__(self, max_pajisje: int, max_bytes: int, ttl: float, max_mesazhe: int,
+                 shteg_sqlite: str = "", ttl_sqlite: float = 0,
+                 buxheti_tokena: int = BISEDA_BUXHETI_TOKENA, me_permbledhje: bool = BISEDA_PERMBLEDHJE):
+        self.max_pajisje = max_pajisje
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.max_mesazhe = max_mesazhe
+        self.buxheti_tokena = buxheti_tokena
+        self.me_permbledhje = me_permbledhje
+        self.shteg_sqlite = shteg_sqlite
+        self.ttl_sqlite = ttl_sqlite
+        self.bytes_total = 0
+        self.debuar_lru = 0
+        self.debuar_ttl = 0
+        self.derdhur = 0
+        self.ringarkuar = 0
+        self._bisedat: "OrderedDict[str, Biseda]" = OrderedDict()
+        if shteg_sqlite:
+            ne_db_tani(self._krijo_tabelen)
+
+    def _krijo_tabelen(self):
+        lidhja_sqlite(self.shteg_sqlite).execute(
+            "CREATE TABLE IF NOT EXISTS bisedat (device_id TEXT PRIMARY KEY, kthesat TEXT, koha REAL)"
+        )
+
+    def __contains__(self, device_id: str) -> bool:
+        return device_id in self._bisedat
+
+    def __len__(self) -> int:
+        return len(self._bisedat)
+
+    def _derdh(self, device_id: str, biseda: Biseda):
+        if not self.shteg_sqlite or not (biseda.kthesat or biseda.permbledhje):
+            return
+        te_dhenat = {"kthesat": biseda.kthesat, "jashte": biseda.jashte, "jashte_fillimi": biseda.jashte_fillimi,
+                     "permbledhje": biseda.permbledhje}
+        ne_db_sfond(self._shkruaj_derdhjen, device_id, json.dumps(te_dhenat, ensure_ascii=False), time.time())
+        self.derdhur += 1
+
+    def _shkruaj_derdhjen(self, device_id: str, te_dhenat: str, koha: float):
+        lidhja_sqlite(self.shteg_sqlite).execute("INSERT OR REPLACE INTO bisedat VALUES (?, ?, ?)",
+                                                 (device_id, te_dhenat, koha))
+
+    def _lexo_derdhjen(self, device_id: str) -> Optional[Tuple[str, float]]:
+        lidhja = lidhja_sqlite(self.shteg_sqlite)
+        rreshti = lidhja.execute(
+            "SELECT kthesat, koha FROM bisedat WHERE device_id = ?", (device_id,)
+        ).fetchone()
+        if rreshti is not None:
+            lidhja.execute("DELETE FROM bisedat WHERE device_id = ?", (device_id,))
+        return rreshti
+
+    async def _ringarko(self, device_id: str) -> Optional[Biseda]:
+        if not self.shteg_sqlite:
+            return None
+        # Derdhja e kësaj pajisjeje, nëse është nisur, është në radhë para këtij leximi
+        rreshti = await ne_db(self._lexo_derdhjen, device_id)
+        if rreshti is None or time.time() - rreshti[1] > self.ttl_sqlite:
+            return None
+        self.ringarkuar += 1
+        te_dhenat = json.loads(rreshti[0])
+        return Biseda([(r, t) for r, t in te_dhenat["kthesat"]], [(r, t) for r, t in te_dhenat["jashte"]],
+                      te_dhenat["permbledhje"], te_dhenat["jashte_fillimi"])
+
+    def _hiq(self, device_id: str):
+        biseda = self._bisedat.pop(device_id)
+        self.bytes_total -= biseda.madhesia
+        self._derdh(device_id, biseda)
+
+    def _pastro(self):
+        tani = time.monotonic()
+        # Pajisja e fundit është ajo që po përdoret tani - nuk dëbohet
+        while len(self._bisedat) > 1:
+            device_id, biseda = next(iter(self._bisedat.items()))
+            if tani - biseda.perdorur > self.ttl:
+                self._hiq(device_id)
+                self.debuar_ttl += 1
+            elif len(self._bisedat) > self.max_pajisje or self.bytes_total > self.max_bytes:
+                self._hiq(device_id)
+                self.debuar_lru += 1
+            else:
+                break
+
+    async def merr(self, device_id: str) -> Biseda:
+        biseda = self._bisedat.get(device_id)
+        if biseda is None:
+            biseda = await self._ringarko(device_id) or Biseda()
+            # Një kërkesë tjetër mund ta ketë krijuar ndërkohë
+            biseda = self._bisedat.get(device_id) or biseda
+            if device_id not in self._bisedat:
+                self._bisedat[device_id] = biseda
+                self.bytes_total += biseda.madhesia
+        self._bisedat.move_to_end(device_id)
+        biseda.perdorur = time.monotonic()
+        self._pastro()
+        return biseda
+
+    async def vendos_system(self, device_id: str, teksti: str):
+        (await self.merr(device_id)).system = teksti
+
+    def _ndrysho_madhesine(self, biseda: Biseda, delta: int):
+        biseda.madhesia += delta
+        self.bytes_total += delta
+
+    async def shto(self, device_id: str, roli: str, teksti: str):
+        biseda = await self.merr(device_id)
+        biseda.kthesat.append((ROLI_KOD[roli], teksti))
+        biseda.tokenat += numero_tokenat(teksti)
+        self._ndrysho_madhesine(biseda, len(teksti))
+        # Mbaj kthesat e fundit brenda buxhetit; më të vjetrat shkojnë për përmbledhje
+        while len(biseda.kthesat) > 1 and (len(biseda.kthesat) > self.max_mesazhe
+                                           or biseda.tokenat > self.buxheti_tokena):
+            kthesa = biseda.kthesat.pop(0)
+            biseda.tokenat -= numero_tokenat(kthesa[1])
+            if self.me_permbledhje:
+                biseda.jashte.append(kthesa)
+            else:
+                self._ndrysho_madhesine(biseda, -len(kthesa[1]))
+        while len(biseda.jashte) > PERMBLEDHJE_MAX_KTHESA:
+            _, hequr = biseda.jashte.pop(0)
+            biseda.jashte_fillimi += 1
+            self._ndrysho_madhesine(biseda, -len(hequr))
+        self._pastro()
+
+    async def hiq_kthesen(self, device_id: str, roli: str, teksti: str):
+        """Heq kthesën e fundit me këtë tekst - kur pyetja nuk mori përgjigje"""
+        biseda = self._bisedat.get(device_id)
+        if biseda is None:
+            return
+        kthesa = (ROLI_KOD[roli], teksti)
+        for i in range(len(biseda.kthesat) - 1, -1, -1):
+            if biseda.kthesat[i] == kthesa:
+                del biseda.kthesat[i]
+                biseda.tokenat -= numero_tokenat(teksti)
+                self._ndrysho_madhesine(biseda, -len(teksti))
+                return
+
+    async def mesazhet(self, device_id: str) -> List[Dict]:
+        """Mesazhet në formatin e Groq: system prompt-i, përmbledhja (nëse ka) dhe kthesat"""
+        biseda = await self.merr(device_id)
+        mesazhet = [{"role": "system", "content": biseda.system}]
+        if biseda.permbledhje:
+            mesazhet.append(mesazhi_permbledhjes(biseda.permbledhje))
+        return mesazhet + [{"role": ROLET[r], "content": t} for r, t in biseda.kthesat]
+
+    async def per_permbledhje(self, device_id: str) -> Tuple[str, List[Tuple[int, str]], int]:
+        """Përmbledhja aktuale, kthesat që presin dhe shenja që i jepet vendos_permbledhjen -
+        numri rendor pas kthesës së fundit të përmbledhur"""
+        biseda = self._bisedat.get(device_id)
+        if biseda is None:
+            return "", [], 0
+        return biseda.permbledhje, list(biseda.jashte), biseda.jashte_fillimi + len(biseda.jashte)
+
+    async def vendos_permbledhjen(self, device_id: str, permbledhje: str, shenja: int):
+        biseda = self._bisedat.get(device_id)
+        if biseda is None:
+            return
+        # Kthesat e hequra gjatë përmbledhjes e kanë zhvendosur fillimin - hiq vetëm ato që mbeten
+        sa = max(0, min(len(biseda.jashte), shenja - biseda.jashte_fillimi))
+        te_permbledhura = biseda.jashte[:sa]
+        del biseda.jashte[:sa]
+        biseda.jashte_fillimi += sa
+        self._ndrysho_madhesine(biseda, len(permbledhje) - len(biseda.permbledhje)
+                                - sum(len(t) for _, t in te_permbledhura))
+        biseda.permbledhje = permbledhje
+
+    def statistika(self) -> dict:
+        return {
+            "pajisje": len(self._bisedat),
+            "bytes": self.bytes_total,
+            "max_pajisje": self.max_pajisje,
+            "max_bytes": self.max_bytes,
+            "debuar_lru": self.debuar_lru,
+            "debuar_ttl": self.debuar_ttl,
+            "derdhur_sqlite": self.derdhur,
+            "ringarkuar_sqlite": self.ringarkuar,
+        }
+
+class DepoPerdoruesish:
+    """Profilet e përdoruesve me kufi LRU; të dëbuarit ruhen në SQLite nëse është aktiv"""
+
+    def __init__(self, max_hyrje: int, shteg_sqlite: str = ""):
+        self.max_hyrje = max_hyrje
+        self.shteg_sqlite = shteg_sqlite
+        self.debuar = 0
+        self.humbur = 0
+        self._perdoruesit: "OrderedDict[str, Dict]" = OrderedDict()
+        if shteg_sqlite:
+            ne_db_tani(self._krijo_tabelen)
+
+    def _krijo_tabelen(self):
+        lidhja_sqlite(self.shteg_sqlite).execute(
+            "CREATE TABLE IF NOT EXISTS perdoruesit (device_id TEXT PRIMARY KEY, profili TEXT)"
+        )
+
+    def __len__(self) -> int:
+        return len(self._perdoruesit)
+
+    def _shkruaj(self, device_id: str, profili: str):
+        lidhja_sqlite(self.shteg_sqlite).execute("INSERT OR REPLACE INTO perdoruesit VALUES (?, ?)",
+                                                 (device_id, profili))
+
+    def _lexo(self, device_id: str) -> Optional[str]:
+        rreshti = lidhja_sqlite(self.shteg_sqlite).execute(
+            "SELECT profili FROM perdoruesit WHERE device_id = ?", (device_id,)
+        ).fetchone()
+        return rreshti[0] if rreshti else None
+
+    async def vendos(self, device_id: str, profili: Dict):
+        self._perdoruesit[device_id] = profili
+        self._perdoruesit.move_to_end(device_id)
+        while len(self._perdoruesit) > self.max_hyrje:
+            vjeter, p = self._perdoruesit.popitem(last=False)
+            self.debuar += 1
+            if self.shteg_sqlite:
+                ne_db_sfond(self._shkruaj, vjeter, json.dumps(p, ensure_ascii=False))
+            else:
+                self.humbur += 1
+                print(f"Kujdes: profili i {vjeter} u hoq (mbi {self.max_hyrje} përdorues, pa LUNA_BISEDA_SQLITE)")
+
+    def statistika(self) -> dict:
+        return {"perdorues": len(self._perdoruesit), "max_perdorues": self.max_hyrje,
+                "debuar": self.debuar, "humbur": self.humbur}
+
+    async def merr(self, device_id: str, default=None):
+        profili = self._perdoruesit.get(device_id)
+        if profili is not None:
+            self._perdoruesit.move_to_end(device_id)
+            return profili
+        if self.shteg_sqlite:
+            rreshti = await ne_db(self._lexo, device_id)
+            if rreshti is not None:
+                profili = self._perdoruesit.get(device_id) or json.loads(rreshti)
+                await self.vendos(device_id, profili)
+                return profili
+        return default
+
+class DepoBisedashSQLite:
+    """Bisedat drejtpërdrejt në SQLite - të njëjtat për të gjithë workers"""
+
+    def __init__(self, shteg: str, ttl: float, max_mesazhe: int,
+                 buxheti_tokena: int = BISEDA_BUXHETI_TOKENA, me_permbledhje: bool = BISEDA_PERMBLEDHJE):
+        self.shteg = shteg
+        self.ttl = ttl
+        self.max_mesazhe = max_mesazhe
+        self.buxheti_tokena = buxheti_tokena
+        self.me_permbledhje = me_permbledhje
+        self.debuar_ttl = 0
+        self._pastruar = 0.0
+        self._statistika = StatistikaSQLite(self._llogarit_statistikat, {"pajisje": 0, "mesazhe": 0, "bytes": 0})
+        ne_db_tani(self._krijo_tabelat)
+
+    def _krijo_tabelat(self):
+        db = self._db
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS bisedat_meta (device_id TEXT PRIMARY KEY, system TEXT, "
+            "permbledhje TEXT DEFAULT '', perdorur REAL)"
+        )
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS bisedat_kthesat (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "device_id TEXT, roli INTEGER, teksti TEXT, tokena INTEGER DEFAULT 0, jashte INTEGER DEFAULT 0)"
+        )
+        db.execute("CREATE INDEX IF NOT EXISTS bisedat_kthesat_device ON bisedat_kthesat (device_id, id)")
+
+    # Metodat me _ ekzekutohen në thread-in e bazës
+    @property
+    def _db(self) -> sqlite3.Connection:
+        return lidhja_sqlite(self.shteg)
+
+    def _pastro(self):
+        # Pajisjet joaktive hiqen rrallë, jo në çdo kërkesë
+        tani = time.time()
+        if tani - self._pastruar < 60:
+            return
+        self._pastruar = tani
+        te_vjetra = [r[0] for r in self._db.execute(
+            "SELECT device_id FROM bisedat_meta WHERE perdorur < ?", (tani - self.ttl,))]
+        with self._db:
+            self._db.execute("BEGIN IMMEDIATE")
+            for device_id in te_vjetra:
+                self._db.execute("DELETE FROM bisedat_meta WHERE device_id = ?", (device_id,))
+                self._db.execute("DELETE FROM bisedat_kthesat WHERE device_id = ?", (device_id,))
+        self.debuar_ttl += len(te_vjetra)
+
+    def _vendos_system(self, device_id: str, teksti: str):
+        self._pastro()
+        self._db.execute(
+            "INSERT INTO bisedat_meta (device_id, system, perdorur) VALUES (?, ?, ?) "
+            "ON CONFLICT(device_id) DO UPDATE SET system = excluded.system, perdorur = excluded.perdorur",
+            (device_id, teksti, time.time())
+        )
+
+    def _shto(self, device_id: str, roli: str, teksti: str):
+        with self._db:
+            self._db.execute("BEGIN IMMEDIATE")
+            self._shto_kthesen(device_id, roli, teksti)
+
+    def _shto_kthesen(self, device_id: str, roli: str, teksti: str):
+        self._db.execute("INSERT INTO bisedat_kthesat (device_id, roli, teksti, tokena) VALUES (?, ?, ?, ?)",
+                         (device_id, ROLI_KOD[roli], teksti, numero_tokenat(teksti)))
+        # Mbaj kthesat e fundit brenda buxhetit; më të vjetrat shkojnë për përmbledhje
+        rreshtat = self._db.execute(
+            "SELECT id, tokena FROM bisedat_kthesat WHERE device_id = ? AND jashte = 0 ORDER BY id DESC",
+            (device_id,)).fetchall()
+        tokenat = 0
+        kufiri = None
+        for i, (id_, tokena) in enumerate(rreshtat):
+            tokenat += tokena
+            if i > 0 and (i >= self.max_mesazhe or tokenat > self.buxheti_tokena):
+                kufiri = id_
+                break
+        if kufiri is None:
+            return
+        if self.me_permbledhje:
+            self._db.execute("UPDATE bisedat_kthesat SET jashte = 1 WHERE device_id = ? AND id <= ? AND jashte = 0",
+                             (device_id, kufiri))
+            self._db.execute(
+                "DELETE FROM bisedat_kthesat WHERE device_id = ? AND jashte = 1 AND id NOT IN "
+                "(SELECT id FROM bisedat_kthesat WHERE device_id = ? AND jashte = 1 ORDER BY id DESC LIMIT ?)",
+                (device_id, device_id, PERMBLEDHJE_MAX_KTHESA))
+        else:
+            self._db.execute("DELETE FROM bisedat_kthesat WHERE device_id = ? AND id <= ?", (device_id, kufiri))
+
+    def _hiq_kthesen(self, device_id: str, roli: str, teksti: str):
+        self._db.execute(
+            "DELETE FROM bisedat_kthesat WHERE id = (SELECT MAX(id) FROM bisedat_kthesat "
+            "WHERE device_id = ? AND roli = ? AND teksti = ? AND jashte = 0)",
+            (device_id, ROLI_KOD[roli], teksti))
+
+    def _mesazhet(self, device_id: str) -> List[Dict]:
+        rreshti = self._db.execute("SELECT system, permbledhje FROM bisedat_meta WHERE device_id = ?",
+                                   (device_id,)).fetchone()
+        kthesat = self._db.execute(
+            "SELECT roli, teksti FROM bisedat_kthesat WHERE device_id = ? AND jashte = 0 ORDER BY id",
+            (device_id,)).fetchall()
+        mesazhet = [{"role": "system", "content": rreshti[0] if rreshti else ""}]
+        if rreshti and rreshti[1]:
+            mesazhet.append(mesazhi_permbledhjes(rreshti[1]))
+        return mesazhet + [{"role": ROLET[r], "content": t} for r, t in kthesat]
+
+    def _per_permbledhje(self, device_id: str) -> Tuple[str, List[Tuple[int, str]], int]:
+        rreshti = self._db.execute("SELECT permbledhje FROM bisedat_meta WHERE device_id = ?",
+                                   (device_id,)).fetchone()
+        rreshtat = self._db.execute(
+            "SELECT id, roli, teksti FROM bisedat_kthesat WHERE device_id = ? AND jashte = 1 ORDER BY id",
+            (device_id,)).fetchall()
+        shenja = rreshtat[-1][0] if rreshtat else 0
+        return (rreshti[0] or "") if rreshti else "", [(r, t) for _, r, t in rreshtat], shenja
+
+    def _vendos_permbledhjen(self, device_id: str, permbledhje: str, shenja: int):
+        with self._db:
+            self._db.execute("BEGIN IMMEDIATE")
+            self._db.execute("UPDATE bisedat_meta SET permbledhje = ? WHERE device_id = ?", (permbledhje, device_id))
+            self._db.execute("DELETE FROM bisedat_kthesat WHERE device_id = ? AND jashte = 1 AND id <= ?",
+                             (device_id, shenja))
+
+    def _llogarit_statistikat(self) -> dict:
+        pajisje = self._db.execute("SELECT COUNT(*) FROM bisedat_meta").fetchone()[0]
+        kthesa, total = self._db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(teksti)), 0) FROM bisedat_kthesat").fetchone()
+        return {"pajisje": pajisje, "mesazhe": kthesa, "bytes": total}
+
+    async def vendos_system(self, device_id: str, teksti: str):
+        await ne_db(self._vendos_system, device_id, teksti)
+
+    async def shto(self, device_id: str, roli: str, teksti: str):
+        await ne_db(self._shto, device_id, roli, teksti)
+
+    async def hiq_kthesen(self, device_id: str, roli: str, teksti: str):
+        await ne_db(self._hiq_kthesen, device_id, roli, teksti)
+
+    async def mesazhet(self, device_id: str) -> List[Dict]:
+        return await ne_db(self._mesazhet, device_id)
+
+    async def per_permbledhje(self, device_id: str) -> Tuple[str, List[Tuple[int, str]], int]:
+        return await ne_db(self._per_permbledhje, device_id)
+
+    async def vendos_permbledhjen(self, device_id: str, permbledhje: str, shenja: int):
+        await ne_db(self._vendos_permbledhjen, device_id, permbledhje, shenja)
+
+    def statistika(self) -> dict:
+        return {**self._statistika.merr(), "debuar_ttl": self.debuar_ttl}
+
+class DepoPerdoruesishSQLite:
+    """Profilet e përdoruesve në SQLite - të njëjtat për të gjithë workers"""
+
+    def __init__(self, shteg: str):
+        self.shteg = shteg
+        self._statistika = StatistikaSQLite(self._numero, {"perdorues": 0})
+        ne_db_tani(self._krijo_tabelen)
+
+    def _krijo_tabelen(self):
+        lidhja_sqlite(self.shteg).execute(
+            "CREATE TABLE IF NOT EXISTS perdoruesit (device_id TEXT PRIMARY KEY, profili TEXT)"
+        )
+
+    def _numero(self) -> dict:
+        return {"perdorues": lidhja_sqlite(self.shteg).execute("SELECT COUNT(*) FROM perdoruesit").fetchone()[0]}
+
+    def __len__(self) -> int:
+        return self._statistika.merr()["perdorues"]
+
+    def statistika(self) -> dict:
+        return {**self._statistika.merr(), "debuar": 0, "humbur": 0}
+
+    def _shkruaj(self, device_id: str, profili: str):
+        lidhja_sqlite(self.shteg).execute("INSERT OR REPLACE INTO perdoruesit VALUES (?, ?)", (device_id, profili))
+
+    def _lexo(self, device_id: str) -> Optional[str]:
+        rreshti = lidhja_sqlite(self.shteg).execute(
+            "SELECT profili FROM perdoruesit WHERE device_id = ?", (device_id,)
+        ).fetchone()
+        return rreshti[0] if rreshti else None
+
+    async def vendos(self, device_id: str, profili: Dict):
+        await ne_db(self._shkruaj, device_id, json.dumps(profili, ensure_ascii=False))
+
+    async def merr(self, device_id: str, default=None):
+        rreshti = await ne_db(self._lexo, device_id)
+        return json.loads(rreshti) if rreshti else default
+
+# ════════════════════════════════════════════════════════════
+#  ALARMET DHE TIMERAT
+# ════════════════════════════════════════════════════════════
+def koha_e_alarmit(ora: str) -> Optional[datetime]:
+    """Hera tjetër që ora HH:MM vjen në Shqipëri - None nëse ora nuk është e vlefshme"""
+    try:
+        h, m = map(int, ora.split(":"))
+        tani = datetime.now(TZ)
+        dita = tani.date()
+        kur = TZ.localize(datetime(dita.year, dita.month, dita.day, h, m))
+        if kur <= tani:
+            dita += timedelta(days=1)
+            kur = TZ.localize(datetime(dita.year, dita.month, dita.day, h, m))
+    except ValueError:
+        return None
+    return kur
+
+async def njofto_alarmin(hyrja: Dict):
+    print(f"Ra {hyrja['lloji']} {hyrja['id']} për {hyrja['device_id']}")
+    kanalet.publiko(hyrja["device_id"], hyrja["lloji"], hyrja)
+
+BIE, HIQ = 0, 1
+
+class Planifikuesi:
+    """Alarmet dhe timerat në një min-heap sipas kohës, me indeks për pajisje dhe ID të qëndrueshme"""
+
+    def __init__(self, mbaj_s: float):
+        self.mbaj_s = mbaj_s
+        self.rene = 0
+        self._heap: List[Tuple[float, int, int]] = []
+        self._sipas_id: Dict[int, Dict] = {}
+        self._sipas_pajisjes: Dict[str, Dict[int, Dict]] = {}
+        self._aktive: Dict[str, int] = {}
+        self._aktive_total = 0
+        self._id_tjeter = 1
+        self._zgjo = asyncio.Event()
+
+    def _shto(self, hyrja: Dict) -> Dict:
+        hyrja["id"] = self._id_tjeter
+        self._id_tjeter += 1
+        self._sipas_id[hyrja["id"]] = hyrja
+        self._sipas_pajisjes.setdefault(hyrja["device_id"], {})[hyrja["id"]] = hyrja
+        self._aktive[hyrja["device_id"]] = self._aktive.get(hyrja["device_id"], 0) + 1
+        self._aktive_total += 1
+        if not self._heap or hyrja["kur"] < self._heap[0][0]:
+            self._zgjo.set()
+        heapq.heappush(self._heap, (hyrja["kur"], hyrja["id"], BIE))
+        return hyrja
+
+    def _caktivizo(self, hyrja: Dict):
+        if hyrja["aktiv"]:
+            hyrja["aktiv"] = False
+            self._aktive[hyrja["device_id"]] -= 1
+            if not self._aktive[hyrja["device_id"]]:
+                del self._aktive[hyrja["device_id"]]
+            self._aktive_total -= 1
+
+    async def shto_alarm(self, device_id: str, ora: str, kur: datetime, etiketa: str = "Alarm") -> Dict:
+        return self._shto({"lloji": "alarm", "device_id": device_id, "ora": ora, "etiketa": etiketa,
+                           "aktiv": True, "kur": kur.timestamp()})
+
+    async def shto_timer(self, device_id: str, sekonda: int) -> Dict:
+        fund = datetime.now(TZ) + timedelta(seconds=sekonda)
+        return self._shto({"lloji": "timer", "device_id": device_id, "fund": fund.isoformat(),
+                           "sekonda": sekonda, "aktiv": True, "kur": fund.timestamp()})
+
+    def _te_pajisjes(self, device_id: str, lloji: str) -> List[Dict]:
+        return sorted((dict(h) for h in self._sipas_pajisjes.get(device_id, {}).values() if h["lloji"] == lloji),
+                      key=lambda h: h["kur"])
+
+    async def alarmet(self, device_id: str) -> List[Dict]:
+        return self._te_pajisjes(device_id, "alarm")
+
+    async def timerat(self, device_id: str) -> List[Dict]:
+        return self._te_pajisjes(device_id, "timer")
+
+    async def fshi(self, device_id: str, id: int) -> bool:
+        hyrja = self._sipas_pajisjes.get(device_id, {}).get(id)
+        if hyrja is None:
+            return False
+        # Hyrja në heap hiqet dembelisht kur të dalë në krye
+        self._caktivizo(hyrja)
+        self._hiq(hyrja)
+        return True
+
+    def _hiq(self, hyrja: Dict):
+        self._sipas_id.pop(hyrja["id"], None)
+        te_pajisjes = self._sipas_pajisjes.get(hyrja["device_id"], {})
+        te_pajisjes.pop(hyrja["id"], None)
+        if not te_pajisjes:
+            self._sipas_pajisjes.pop(hyrja["device_id"], None)
+
+    async def aktive(self, device_id: Optional[str] = None) -> int:
+        if device_id is None:
+            return self._aktive_total
+        return self._aktive.get(device_id, 0)
+
+    def statistika(self) -> dict:
+        alarme = sum(1 for h in self._sipas_id.values() if h["lloji"] == "alarm")
+        return {"aktive": self._aktive_total, "gjithsej": len(self._sipas_id), "rene": self.rene,
+                "alarme": alarme, "timera": len(self._sipas_id) - alarme}
+
+    async def puno(self):
+        """Bie alarmet dhe timerat kur u vjen koha dhe pastron ato që kanë skaduar"""
+        while True:
+            self._zgjo.clear()
+            vonesa = self._heap[0][0] - time.time() if self._heap else None
+            if vonesa is None or vonesa > 0:
+                try:
+                    await asyncio.wait_for(self._zgjo.wait(), timeout=vonesa)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _, id, veprimi = heapq.heappop(self._heap)
+            hyrja = self._sipas_id.get(id)
+            if hyrja is None:
+                continue
+            if veprimi == BIE and hyrja["aktiv"]:
+                self._caktivizo(hyrja)
+                hyrja["ra"] = time.time()
+                self.rene += 1
+                heapq.heappush(self._heap, (hyrja["ra"] + self.mbaj_s, id, HIQ))
+                try:
+                    await njofto_alarmin(dict(hyrja))
+                except Exception as e:
+                    print(f"Gabim njoftim alarmi: {e}")
+            elif veprimi == HIQ:
+                self._hiq(hyrja)
+
+class PlanifikuesiSQLite:
+    """Si Planifikuesi, por në SQLite: indeksi (aktiv, kur) bën punën e heap-it dhe
+    UPDATE ... WHERE aktiv = 1 siguron që çdo alarm bie vetëm në një worker"""
+
+    def __init__(self, shteg: str, mbaj_s: float, interval_s: float = 1.0):
+        self.shteg = shteg
+        self.mbaj_s = mbaj_s
+        self.interval_s = interval_s
+        self.rene = 0
+        self._zgjo = asyncio.Event()
+        self._statistika = StatistikaSQLite(self._llogarit_statistikat,
+                                            {"aktive": 0, "gjithsej": 0, "alarme": 0, "timera": 0})
+        ne_db_tani(self._krijo_tabelen)
+
+    def _krijo_tabelen(self):
+        db = self._db
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS planifikimi (id INTEGER PRIMARY KEY AUTOINCREMENT, device_id TEXT, "
+            "lloji TEXT, kur REAL, aktiv INTEGER, ra REAL, te_dhenat TEXT)"
+        )
+        db.execute("CREATE INDEX IF NOT EXISTS planifikimi_kur ON planifikimi (aktiv, kur)")
+        db.execute("CREATE INDEX IF NOT EXISTS planifikimi_device ON planifikimi (device_id, aktiv)")
+
+    # Metodat me _ ekzekutohen në thread-in e bazës
+    @property
+    def _db(self) -> sqlite3.Connection:
+        return lidhja_sqlite(self.shteg)
+
+    def _fut(self, device_id: str, lloji: str, kur: float, te_dhenat: str) -> int:
+        return self._db.execute(
+            "INSERT INTO planifikimi (device_id, lloji, kur, aktiv, te_dhenat) VALUES (?, ?, ?, 1, ?)",
+            (device_id, lloji, kur, te_dhenat)
+        ).lastrowid
+
+    async def _shto(self, device_id: str, lloji: str, kur: float, te_dhenat: Dict) -> Dict:
+        id = await ne_db(self._fut, device_id, lloji, kur, json.dumps(te_dhenat, ensure_ascii=False))
+        self._zgjo.set()
+        return {"id": id, "lloji": lloji, "device_id": device_id, "aktiv": True, "kur": kur, **te_dhenat}
+
+    async def shto_alarm(self, device_id: str, ora: str, kur: datetime, etiketa: str = "Alarm") -> Dict:
+        return await self._shto(device_id, "alarm", kur.timestamp(), {"ora": ora, "etiketa": etiketa})
+
+    async def shto_timer(self, device_id: str, sekonda: int) -> Dict:
+        fund = datetime.now(TZ) + timedelta(seconds=sekonda)
+        return await self._shto(device_id, "timer", fund.timestamp(), {"fund": fund.isoformat(), "sekonda": sekonda})
+
+    @staticmethod
+    def _hyrja(rreshti) -> Dict:
+        id, device_id, lloji, kur, aktiv, ra, te_dhenat = rreshti
+        hyrja = {"id": id, "lloji": lloji, "device_id": device_id, "aktiv": bool(aktiv), "kur": kur,
+                 **json.loads(te_dhenat)}
+        if ra is not None:
+            hyrja["ra"] = ra
+        return hyrja
+
+    def _te_pajisjes(self, device_id: str, lloji: str) -> List[Dict]:
+        return [self._hyrja(r) for r in self._db.execute(
+            "SELECT id, device_id, lloji, kur, aktiv, ra, te_dhenat FROM planifikimi "
+            "WHERE device_id = ? AND lloji = ? ORDER BY kur", (device_id, lloji))]
+
+    async def alarmet(self, device_id: str) -> List[Dict]:
+        return await ne_db(self._te_pajisjes, device_id, "alarm")
+
+    async def timerat(self, device_id: str) -> List[Dict]:
+        return await ne_db(self._te_pajisjes, device_id, "timer")
+
+    def _fshi(self, device_id: str, id: int) -> bool:
+        c = self._db.execute("DELETE FROM planifikimi WHERE id = ? AND device_id = ?", (id, device_id))
+        return c.rowcount > 0
+
+    async def fshi(self, device_id: str, id: int) -> bool:
+        return await ne_db(self._fshi, device_id, id)
+
+    def _aktive(self, device_id: str) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM planifikimi WHERE device_id = ? AND aktiv = 1",
+                                (device_id,)).fetchone()[0]
+
+    async def aktive(self, device_id: Optional[str] = None) -> int:
+        if device_id is None:
+            return self._statistika.merr()["aktive"]
+        return await ne_db(self._aktive, device_id)
+
+    def _llogarit_statistikat(self) -> dict:
+        sipas_llojit = dict(self._db.execute("SELECT lloji, COUNT(*) FROM planifikimi GROUP BY lloji").fetchall())
+        aktive = self._db.execute("SELECT COUNT(*) FROM planifikimi WHERE aktiv = 1").fetchone()[0]
+        return {"aktive": aktive, "gjithsej": sum(sipas_llojit.values()),
+                "alarme": sipas_llojit.get("alarm", 0), "timera": sipas_llojit.get("timer", 0)}
+
+    def statistika(self) -> dict:
+        return {**self._statistika.merr(), "rene": self.rene}
+
+    def _merr_te_renat(self, tani: float) -> Tuple[List[Dict], Optional[float]]:
+        """Shënon si të rëna hyrjet që u ka ardhur koha dhe kthen ato që i mori ky worker"""
+        te_rena = []
+        with self._db:
+            self._db.execute("BEGIN IMMEDIATE")
+            self._db.execute("DELETE FROM planifikimi WHERE aktiv = 0 AND ra < ?", (tani - self.mbaj_s,))
+            for rreshti in self._db.execute(
+                    "SELECT id, device_id, lloji, kur, aktiv, ra, te_dhenat FROM planifikimi "
+                    "WHERE aktiv = 1 AND kur <= ? ORDER BY kur", (tani,)).fetchall():
+                # Vetëm worker-i që e ndryshon rreshtin e njofton
+                c = self._db.execute("UPDATE planifikimi SET aktiv = 0, ra = ? WHERE id = ? AND aktiv = 1",
+                                     (tani, rreshti[0]))
+                if c.rowcount:
+                    te_rena.append(self._hyrja(rreshti))
+            tjetri = self._db.execute("SELECT MIN(kur) FROM planifikimi WHERE aktiv = 1").fetchone()[0]
+        return te_rena, tjetri
+
+    async def puno(self):
+        while True:
+            try:
+                te_rena, tjetri = await ne_db(self._merr_te_renat, time.time())
+            except sqlite3.Error as e:
+                print(f"Gabim SQLite planifikuesi: {e}")
+                te_rena, tjetri = [], None
+            for hyrja in te_rena:
+                self.rene += 1
+                try:
+                    await njofto_alarmin(hyrja)
+                except Exception as e:
+                    print(f"Gabim njoftim alarmi: {e}")
+            # Workers të tjerë mund të shtojnë alarme - kontrollo të paktën çdo interval_s
+            vonesa = self.interval_s if tjetri is None else min(self.interval_s, max(0.0, tjetri - time.time()))
+            self._zgjo.clear()
+            try:
+                await asyncio.wait_for(self._zgjo.wait(), timeout=vonesa)
+            except asyncio.TimeoutError:
+                pass
+
+# ════════════════════════════════════════════════════════════
+#  KANALI PUSH
+# ════════════════════════════════════════════════════════════
+class KanaletPush:
+    """Ngjarjet për çdo pajisje (përgjigje, audio, alarme) për WebSocket dhe long-poll.
+
+    Ruhen vetëm për pajisjet që kanë dëgjuar kanalin brenda `ttl` (long-poll ose WebSocket),
+    me kufi global pajisjesh - pajisjet që s'e përdorin push-in nuk mbajnë gjë në memorie."""
+
+    def __init__(self, max_ngjarje: int, ttl: float, max_pajisje: int = PUSH_MAX_PAJISJE):
+        self.max_ngjarje = max_ngjarje
+        self.ttl = ttl
+        self.max_pajisje = max_pajisje
+        self.publikuar = 0
+        self.pa_degjues = 0
+        self._id = 0
+        self._pastruar = 0.0
+        self._ngjarjet: "OrderedDict[str, deque[Dict]]" = OrderedDict()
+        self._degjuar: "OrderedDict[str, float]" = OrderedDict()
+        self._ndryshim: Dict[str, asyncio.Event] = {}
+        self._ne_pritje: Dict[str, int] = {}
+
+    def _degjon(self, device_id: str):
+        self._degjuar[device_id] = time.monotonic()
+        self._degjuar.move_to_end(device_id)
+        kufiri = time.monotonic() - self.ttl
+        while self._degjuar and (len(self._degjuar) > self.max_pajisje
+                                 or next(iter(self._degjuar.values())) < kufiri):
+            self._degjuar.popitem(last=False)
+
+    def _ka_degjues(self, device_id: str) -> bool:
+        koha = self._degjuar.get(device_id)
+        return koha is not None and time.monotonic() - koha < self.ttl
+
+    def _pastro(self):
+        while len(self._ngjarjet) > self.max_pajisje:
+            self._ngjarjet.popitem(last=False)
+        tani = time.time()
+        if tani - self._pastruar < min(60.0, self.ttl):
+            return
+        self._pastruar = tani
+        for device_id, radha in list(self._ngjarjet.items()):
+            if radha[-1]["koha"] < tani - self.ttl or not self._ka_degjues(device_id):
+                del self._ngjarjet[device_id]
+
+    def publiko(self, device_id: str, lloji: str, te_dhenat: Dict) -> int:
+        self._id += 1
+        self.publikuar += 1
+        ngjarja = self._ndryshim.pop(device_id, None)
+        if ngjarja is not None:
+            ngjarja.set()
+        if not self._ka_degjues(device_id):
+            self.pa_degjues += 1
+            return self._id
+        radha = self._ngjarjet.get(device_id)
+        if radha is None:
+            radha = self._ngjarjet[device_id] = deque(maxlen=self.max_ngjarje)
+        self._ngjarjet.move_to_end(device_id)
+        radha.append({"id": self._id, "lloji": lloji, "koha": time.time(), "te_dhenat": te_dhenat})
+        self._pastro()
+        return self._id
+
+    async def kursori(self, device_id: str) -> int:
+        self._degjon(device_id)
+        radha = self._ngjarjet.get(device_id)
+        return radha[-1]["id"] if radha else 0
+
+    def _pas(self, device_id: str, pas: int) -> List[Dict]:
+        radha = self._ngjarjet.get(device_id)
+        if not radha:
+            return []
+        kufiri = time.time() - self.ttl
+        while radha and radha[0]["koha"] < kufiri:
+            radha.popleft()
+        if not radha:
+            del self._ngjarjet[device_id]
+            return []
+        return [n for n in radha if n["id"] > pas]
+
+    async def prit(self, device_id: str, pas: int, timeout: float) -> List[Dict]:
+        """Kthen ngjarjet pas kursorit `pas`; nëse s'ka, pret deri në `timeout` sekonda"""
+        self._degjon(device_id)
+        ngjarjet = self._pas(device_id, pas)
+        if ngjarjet or timeout <= 0:
+            return ngjarjet
+        ngjarja = self._ndryshim.setdefault(device_id, asyncio.Event())
+        self._ne_pritje[device_id] = self._ne_pritje.get(device_id, 0) + 1
+        try:
+            await asyncio.wait_for(ngjarja.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return []
+        finally:
+            # I fundit që pret (edhe pas timeout-i apo shkëputjes) heq Event-in e pajisjes
+            self._ne_pritje[device_id] -= 1
+            if not self._ne_pritje[device_id]:
+                del self._ne_pritje[device_id]
+                if self._ndryshim.get(device_id) is ngjarja:
+                    del self._ndryshim[device_id]
+            self._degjon(device_id)
+        return self._pas(device_id, pas)
+
+    def statistika(self) -> dict:
+        return {"pajisje": len(self._ngjarjet), "degjues": len(self._degjuar),
+                "ne_pritje": sum(self._ne_pritje.values()), "publikuar": self.publikuar,
+                "pa_degjues": self.pa_degjues}
+
+class KanaletPushSQLite:
+    """Si KanaletPush, por ngjarjet kalojnë nga SQLite që t'i shohin të gjithë workers"""
+
+    def __init__(self, shteg: str, max_ngjarje: int, ttl: float, interval_s: float = 0.1):
+        self.shteg = shteg
+        self.max_ngjarje = max_ngjarje
+        self.ttl = ttl
+        self.interval_s = interval_s
+        self.publikuar = 0
+        self._pastruar = 0.0
+        ne_db_tani(self._krijo_tabelen)
+
+    def _krijo_tabelen(self):
+        db = self._db
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS ngjarjet (id INTEGER PRIMARY KEY AUTOINCREMENT, device_id TEXT, "
+            "lloji TEXT, koha REAL, te_dhenat TEXT)"
+        )
+        db.execute("CREATE INDEX IF NOT EXISTS ngjarjet_device ON ngjarjet (device_id, id)")
+
+    # Metodat me _ ekzekutohen në thread-in e bazës
+    @property
+    def _db(self) -> sqlite3.Connection:
+        return lidhja_sqlite(self.shteg)
+
+    def _fut(self, device_id: str, lloji: str, koha: float, te_dhenat: str, pastro: bool):
+        self._db.execute("INSERT INTO ngjarjet (device_id, lloji, koha, te_dhenat) VALUES (?, ?, ?, ?)",
+                         (device_id, lloji, koha, te_dhenat))
+        if pastro:
+            self._db.execute("DELETE FROM ngjarjet WHERE koha < ?", (koha - self.ttl,))
+
+    def publiko(self, device_id: str, lloji: str, te_dhenat: Dict):
+        # Shkrimi shkon në radhë; ID-ja e ngjarjes u vjen dëgjuesve nga _pas
+        tani = time.time()
+        pastro = tani - self._pastruar > 60
+        if pastro:
+            self._pastruar = tani
+        ne_db_sfond(self._fut, device_id, lloji, tani, json.dumps(te_dhenat, ensure_ascii=False), pastro)
+        self.publikuar += 1
+
+    def _kursori(self, device_id: str) -> int:
+        return self._db.execute("SELECT COALESCE(MAX(id), 0) FROM ngjarjet WHERE device_id = ?",
+                                (device_id,)).fetchone()[0]
+
+    async def kursori(self, device_id: str) -> int:
+        return await ne_db(self._kursori, device_id)
+
+    def _pas(self, device_id: str, pas: int) -> List[Dict]:
+        rreshtat = self._db.execute(
+            "SELECT id, lloji, koha, te_dhenat FROM ngjarjet WHERE device_id = ? AND id > ? AND koha >= ? "
+            "ORDER BY id DESC LIMIT ?", (device_id, pas, time.time() - self.ttl, self.max_ngjarje)).fetchall()
+        return [{"id": i, "lloji": l, "koha": k, "te_dhenat": json.loads(t)} for i, l, k, t in reversed(rreshtat)]
+
+    async def prit(self, device_id: str, pas: int, timeout: float) -> List[Dict]:
+        afati = time.monotonic() + timeout
+        while True:
+            ngjarjet = await ne_db(self._pas, device_id, pas)
+            if ngjarjet or time.monotonic() >= afati:
+                return ngjarjet
+            await asyncio.sleep(min(self.interval_s, max(0.0, afati - time.monotonic())))
+
+    def statistika(self) -> dict:
+        return {"publikuar": self.publikuar}
+
+# ════════════════════════════════════════════════════════════
+#  GJENDJA
+# ════════════════════════════════════════════════════════════
+if GJENDJA == "sqlite":
+    depo_audio  = DepoAudioSQLite(GJENDJA_DB, AUDIO_MAX_BYTES, AUDIO_TTL_S)
+    bisedat     = DepoBisedashSQLite(GJENDJA_DB, BISEDA_TTL_S, BISEDA_MAX_MESAZHE)
+    perdoruesit = DepoPerdoruesishSQLite(GJENDJA_DB)
+    planifikuesi = PlanifikuesiSQLite(GJENDJA_DB, ALARM_MBAJ_S)
+    kanalet     = KanaletPushSQLite(GJENDJA_DB, PUSH_MAX_NGJARJE, PUSH_TTL_S)
+elif GJENDJA == "memory":
+    depo_audio  = DepoAudio(AUDIO_MAX_BYTES, AUDIO_TTL_S)
+    bisedat     = DepoBisedash(BISEDA_MAX_PAJISJE, BISEDA_MAX_BYTES, BISEDA_TTL_S, BISEDA_MAX_MESAZHE,
+                               BISEDA_SQLITE, BISEDA_SQLITE_TTL_S)
+    perdoruesit = DepoPerdoruesish(PERDORUES_MAX, BISEDA_SQLITE)
+    planifikuesi = Planifikuesi(ALARM_MBAJ_S)
+    kanalet     = KanaletPush(PUSH_MAX_NGJARJE, PUSH_TTL_S)
+else:
+    raise RuntimeError(f"LUNA_STATE i panjohur: {GJENDJA!r} (prit 'memory' ose 'sqlite')")
+
+Metrika("luna_audio_bytes", "Bytes audio të mbajtura për pajisjet", "gauge",
+        lexo=lambda: {(): depo_audio.statistika()["bytes"]})
+Metrika("luna_bisedat_pajisje", "Pajisjet me bisedë në memorie/SQLite", "gauge",
+        lexo=lambda: {(): bisedat.statistika()["pajisje"]})
+Metrika("luna_alarmet_aktive", "Alarmet dhe timerat që s'kanë rënë ende", "gauge",
+        lexo=lambda: {(): planifikuesi.statistika()["aktive"]})
+
+def _perdoruesit_debuar() -> dict:
+    s = perdoruesit.statistika()
+    return {("sqlite",): s["debuar"] - s["humbur"], ("humbur",): s["humbur"]}
+
+Metrika("luna_perdoruesit_debuar_total", "Profilet e hequra nga memoria, sipas nëse u ruajtën në SQLite",
+        "counter", ("fati",), lexo=_perdoruesit_debuar)
+
+
+# ════════════════════════════════════════════════════════════
+#  INTENT DETECTION
+# ════════════════════════════════════════════════════════════
+# Fjalët kyçe sipas intentit, në rendin e përparësisë - intenti i parë që gjendet fiton
+INTENTET: List[Tuple[str, List[str]]] = [
+    ("mot",   ["mot", "temperatur", "shi", "diell", "ftoht", "nxeht", "lagësht", "erë", "bore", "kthjell"]),
+    ("rruge", ["rrugë", "rruge", "trafik", "distanc", "sa kohë", "sa kohe", "km", "makine", "makinë", "udhëtim"]),
+    ("ora",   ["sa është ora", "sa eshte ora", "çfarë ore", "cfar ore", "ora tani", "sa orë", "sa ore"]),
+    ("data",  ["çfarë date", "cfar date", "sa date", "cila ditë", "sot është", "sot eshte", "çfarë dite"]),
+    ("alarm", ["alarm", "më zgjo", "me zgjo", "zgjom", "vendos alarm"]),
+    ("timer", ["timer", "kujto pas", "pas 5", "pas 10", "pas 15", "pas 20", "pas 30", "pas një", "pas nje"]),
+    ("ndihme_mendore", ["vetvrasje", "vras veten", "dua te vdes", "jetesa nuk", "s'dua te jetoj", "nuk dua te jetoj"]),
+]
+
+_RE_RRUGE_FORMA = re.compile(r"nga\s+\w+\s+(te|deri|tek|drejt)\s+\w+")
+_RE_RRUGE = re.compile(
+    r"nga\s+([a-zëçë\s]+?)\s+(?:te|deri|tek|drejt)\s+([a-zëçë\s]+?)(?:\s+me makine|\s+me makinë|\s+me auto|$)"
+)
+_RE_ORA_ALARM = re.compile(r"(\d{1,2})[:\.](\d{2})")
+_RE_KOHEZGJATJA = re.compile(r"(\d+)\s*(minut|sekond|orë|ore|min)")
+
+def _regex_trie(fjalet) -> str:
+    """Regex i faktorizuar si trie - në çdo pozicion përputhet fjala më e gjatë"""
+    trie: dict = {}
+    for fjala in fjalet:
+        nyja = trie
+        for c in fjala:
+            nyja = nyja.setdefault(c, {})
+        nyja[""] = {}
+
+    def _nyja(nyja: dict) -> str:
+        deget = [re.escape(c) + _nyja(nen) for c, nen in sorted(nyja.items()) if c]
+        if not deget:
+            return ""
+        regex = deget[0] if len(deget) == 1 else f"(?:{'|'.join(deget)})"
+        return f"(?:{regex})?" if "" in nyja else regex
+
+    return _nyja(trie)
+
+def _kompilo_intentet(intentet: List[Tuple[str, List[str]]], qytetet: Dict[str, str]):
+    """Të gjitha fjalët kyçe dhe emrat e qyteteve në një automat të vetëm.
+
+    Lookahead-i lejon përputhje që mbivendosen, si `w in t`. Në çdo pozicion
+    trie-ja jep fjalën më të gjatë; tabela `info` mban për secilën intentin më
+    të përparë dhe qytetin e parë mes fjalëve që janë prefiks i saj."""
+    fjalet_kyce = [(i, f) for i, (_, fjalet) in enumerate(intentet) for f in fjalet]
+    rendi_qyteteve = list(qytetet)
+    te_gjitha = {f for _, f in fjalet_kyce} | set(rendi_qyteteve)
+
+    info: Dict[str, Tuple[int, Optional[str]]] = {}
+    for fjala in te_gjitha:
+        intenti = min((i for i, f in fjalet_kyce if fjala.startswith(f)), default=len(intentet))
+        qyteti = next((k for k in rendi_qyteteve if fjala.startswith(k)), None)
+        info[fjala] = (intenti, qyteti)
+
+    # Klasa e shkronjave fillestare lejon motorin të kapërcejë shpejt pozicionet pa shpresë
+    klasa = "".join(re.escape(c) for c in sorted({f[0] for f in te_gjitha}))
+    return re.compile(f"(?=[{klasa}])(?=({_regex_trie(te_gjitha)}))"), info
+
+_MOTORI_INTENTEVE, _INFO_FJALEVE = _kompilo_intentet(INTENTET, QYTETET_MAP)
+_RENDI_QYTETEVE = {k: i for i, k in enumerate(QYTETET_MAP)}
+_INTENTI_RRUGE = [lloji for lloji, _ in INTENTET].index("rruge")
+
+def detekto_intent(text: str) -> dict:
+    """Gjen intentin dhe slot-et (qytet, origjinë/destinacion, orë, kohëzgjatje) me një kalim"""
+    t = text.lower().strip()
+
+    me_i_miri = len(INTENTET)
+    qyteti_i_pare = None
+    for m in _MOTORI_INTENTEVE.finditer(t):
+        intenti, qyteti = _INFO_FJALEVE[m.group(1)]
+        if intenti < me_i_miri:
+            me_i_miri = intenti
+        if qyteti and (qyteti_i_pare is None or _RENDI_QYTETEVE[qyteti] < _RENDI_QYTETEVE[qyteti_i_pare]):
+            qyteti_i_pare = qyteti
+
+    if me_i_miri > _INTENTI_RRUGE and _RE_RRUGE_FORMA.search(t):
+        me_i_miri = _INTENTI_RRUGE
+    if me_i_miri == len(INTENTET):
+        return {"lloj": "ai"}
+
+    lloji = INTENTET[me_i_miri][0]
+    intent = {"lloj": lloji}
+    if lloji == "mot":
+        intent["qyteti"] = QYTETET_MAP[qyteti_i_pare] if qyteti_i_pare else "Tirana"
+    elif lloji == "rruge":
+        intent["text"] = text
+        m = _RE_RRUGE.search(t)
+        if m:
+            intent["origjina"], intent["destinacioni"] = m.group(1).strip(), m.group(2).strip()
+    elif lloji == "alarm":
+        intent["text"] = text
+        m = _RE_ORA_ALARM.search(text)
+        if m:
+            intent["ora"] = f"{m.group(1).zfill(2)}:{m.group(2)}"
+    elif lloji == "timer":
+        intent["text"] = text
+        m = _RE_KOHEZGJATJA.search(t)
+        if m:
+            intent["sasia"], intent["njesia"] = int(m.group(1)), m.group(2)
+    return intent
+
+# ════════════════════════════════════════════════════════════
+#  SYSTEM PROMPT
+# ════════════════════════════════════════════════════════════
+@lru_cache(maxsize=4096)
+def prefiksi_i_promptit(emri: str, qyteti: str) -> str:
+    """Pjesa e qëndrueshme e system prompt-it - i njëjti string nga kërkesa në kërkesë,
+    që Groq të ripërdorë prefiksin. Ora, data dhe alarmet shkojnë te mesazhi_kontekstit."""
+    emri_str = f"Personi që flet me ty quhet {emri}. Thirre me emër kur është natyrale." if emri else ""
+
+    return (
+        f"Ti je Luna - asistentja më e zgjuar dhe më e plotë shqiptare. "
+        f"Ke inteligjencë si një njeri që di gjithçka - historian, mjek, jurist, inxhinier, këshilltar. "
+        f"Qyteti bazë: {qyteti}. {emri_str}\n\n"
+        f"RREGULLAT E HEKURTA:\n"
+        f"1. Gjithmonë përgjigju në SHQIP - kurrë në gjuhë tjetër.\n"
+        f"2. Arsyeto si njeri i mençur - mos thuaj kurrë 'nuk e di' pa u përpjekur.\n"
+        f"3. Nëse nuk je e sigurt për diçka - thuaj çfarë di dhe shto 'por mund të kem nevojë ta verifikoj'.\n"
+        f"4. Mos përdor fjalë banale si: 'Kurve', 'Kar', 'Qij', 'bythqire', 'Varikars'.\n"
+        f"5. Mos përdor emoji - flet me zë, jo me shkrim.\n"
+        f"6. Për çështje të rënda si shëndetin, ligjin, financat - jep informacion real dhe praktik.\n"
+        f"7. Për çështje emocionale - ji e ngrohtë, dëgjo dhe këshillo si mik i vërtetë.\n"
+        f"8. Kur dikush ka nevojë për ndihmë urgjente - drejtoji te shërbime profesionale.\n"
+        f"9. Përgjigju me gjatësinë e duhur - shkurt për pyetje të thjeshta, gjatë për pyetje komplekse.\n"
+        f"10. Kujto gjithmonë bisedën e mëparshme dhe bëj lidhje me të.\n"
+        f"11. Ti je e ndërtuar nga një shqiptar i talentuar - ke krenari kombëtare.\n"
+        f"12. Emri yt është Luna - asistentja e parë dhe më e mira inteligjente shqiptare."
+    )
+
+async def krijo_system_prompt(device_id: str) -> str:
+    user = await perdoruesit.merr(device_id, {})
+    return prefiksi_i_promptit(user.get("emri", ""), user.get("qyteti", "Tirana"))
+
+async def mesazhi_kontekstit(device_id: str) -> Dict:
+    """Konteksti që ndryshon çdo minutë - i vogël dhe jashtë prefiksit"""
+    return {
+        "role": "system",
+        "content": (f"Ora tani është {koha_tani()}. Sot është {data_sot()}. "
+                    f"Alarme aktive: {await planifikuesi.aktive(device_id)}."),
+    }
+
+async def mesazhet_per_ai(device_id: str) -> List[Dict]:
+    """System prompt-i, përmbledhja dhe historia (të qëndrueshme), pastaj konteksti para pyetjes së fundit"""
+    mesazhet = await bisedat.mesazhet(device_id)
+    if mesazhet[-1]["role"] == "user":
+        mesazhet.insert(len(mesazhet) - 1, await mesazhi_kontekstit(device_id))
+    else:
+        mesazhet.append(await mesazhi_kontekstit(device_id))
+    return mesazhet
+
+# ════════════════════════════════════════════════════════════
+#  AI KRYESOR
+# ════════════════════════════════════════════════════════════
+tokenat_ai = {"thirrje": 0, "prompt": 0, "prompt_cache": 0, "pergjigje": 0}
+Metrika("luna_ai_tokena_total", "Tokenat e raportuar nga Groq sipas llojit", "counter", ("lloji",),
+        lexo=lambda: {(k,): v for k, v in tokenat_ai.items() if k != "thirrje"})
+
+def _regjistro_perdorimin(perdorimi: Optional[Dict]):
+    if not perdorimi:
+        return
+    tokenat_ai["thirrje"] += 1
+    tokenat_ai["prompt"] += perdorimi.get("prompt_tokens", 0)
+    tokenat_ai["pergjigje"] += perdorimi.get("completion_tokens", 0)
+    tokenat_ai["prompt_cache"] += (perdorimi.get("prompt_tokens_details") or {}).get("cached_tokens", 0)
+
+class Siguresa:
+    """Circuit breaker: pas N gabimesh radhazi modeli pushohet, pastaj provohet me një kërkesë të vetme"""
+
+    def __init__(self, gabime_max: int, pauza_s: float):
+        self.gabime_max = gabime_max
+        self.pauza_s = pauza_s
+        self.gabime_radhazi = 0
+        self.hapur_deri = 0.0
+        self.prove_ne_rruge = False
+        self.hapje = 0
+
+    @property
+    def gjendja(self) -> str:
+        if self.gabime_radhazi < self.gabime_max:
+            return "mbyllur"
+        return "hapur" if time.monotonic() < self.hapur_deri else "gjysme"
+
+    def lejon(self) -> bool:
+        gjendja = self.gjendja
+        return gjendja == "mbyllur" or (gjendja == "gjysme" and not self.prove_ne_rruge)
+
+    def fillo(self):
+        if self.gjendja == "gjysme":
+            self.prove_ne_rruge = True
+
+    def sukses(self):
+        self.gabime_radhazi = 0
+        self.prove_ne_rruge = False
+
+    def deshtim(self):
+        self.gabime_radhazi += 1
+        self.prove_ne_rruge = False
+        if self.gabime_radhazi >= self.gabime_max:
+            self.hapje += 1
+            self.hapur_deri = time.monotonic() + self.pauza_s
+
+    def anulo(self):
+        """Thirrja u anulua (p.sh. humbi hedge-in) - nuk tregon asgjë për modelin"""
+        self.prove_ne_rruge = False
+
+class Modeli:
+    """Një model i Groq me vonesat e fundit dhe siguresën e vet"""
+
+    def __init__(self, emri: str):
+        self.emri = emri
+        self.siguresa = Siguresa(SIGURESA_GABIME, SIGURESA_PAUZE_S)
+        self.vonesat: deque = deque(maxlen=200)
+        self.thirrje = 0
+        self.gabime = 0
+        self.fitore_si_rezerve = 0
+
+    def perqindja(self, q: float) -> Optional[float]:
+        if len(self.vonesat) < 20:
+            return None
+        vonesat = sorted(self.vonesat)
+        return vonesat[min(len(vonesat) - 1, int(q * len(vonesat)))]
+
+    def afati_hedge(self) -> float:
+        """Sa pritet primari para se të niset rezerva"""
+        p = self.perqindja(HEDGE_PERQINDJA)
+        return HEDGE_FILLESTAR_S if p is None else max(HEDGE_MIN_S, p)
+
+    def statistika(self) -> Dict:
+        p50, p95 = self.perqindja(0.5), self.perqindja(0.95)
+        return {
+            "thirrje": self.thirrje,
+            "gabime": self.gabime,
+            "fitore_si_rezerve": self.fitore_si_rezerve,
+            "siguresa": self.siguresa.gjendja,
+            "siguresa_hapje": self.siguresa.hapje,
+            "p50_ms": None if p50 is None else round(1000 * p50),
+            "p95_ms": None if p95 is None else round(1000 * p95),
+        }
+
+modelet: Dict[str, Modeli] = {emri: Modeli(emri) for emri in
+                              dict.fromkeys([MODELI_I_MADH, MODELI_I_SHPEJTE, *MODELET_REZERVE])}
+
+m_modeli_zgjedhje = Metrika("luna_modeli_zgjedhje_total", "Modeli parësor i zgjedhur sipas arsyes",
+                            "counter", ("modeli", "arsyeja"))
+m_modeli_sekonda  = Metrika("luna_modeli_sekonda", "Kohëzgjatja e thirrjeve sipas modelit dhe rezultatit",
+                            "histogram", ("modeli", "rezultati"))
+m_modeli_hedge    = Metrika("luna_modeli_hedge_total", "Thirrjet rezervë të nisura nga vonesa e primarit",
+                            "counter", ("modeli",))
+Metrika("luna_modeli_siguresa_hapur", "1 kur siguresa e modelit është hapur", "gauge", ("modeli",),
+        lexo=lambda: {(m.emri,): int(m.siguresa.gjendja == "hapur") for m in modelet.values()})
+
+_FJALE_KOMPLEKSE = (
+    "shpjego", "pse", "përse", "perse", "krahaso", "analizo", "si funksionon", "përkthe", "perkthe",
+    "shkruaj", "llogarit", "hap pas hapi", "detaje", "ndihmo", "këshill", "keshill", "plan",
+)
+
+def eshte_kthese_e_thjeshte(teksti: str) -> bool:
+    """Bisedë e shkurtër (përshëndetje, falënderim, pyetje e vogël) që e përballon modeli i shpejtë"""
+    t = teksti.lower()
+    return 0 < len(t.split()) <= KTHESE_E_SHKURTER_FJALE and not any(f in t for f in _FJALE_KOMPLEKSE)
+
+def zgjidh_modelet(teksti_user: str, me_web: bool = False) -> List[Modeli]:
+    """Modelet sipas radhës së provës: i pari është primari, i dyti rezerva për hedging"""
+    if not ROUTER_AKTIV:
+        rendi, arsyeja = [MODELI_I_MADH, MODELI_I_SHPEJTE], "fiks"
+    elif me_web:
+        rendi, arsyeja = [MODELI_I_MADH, MODELI_I_SHPEJTE], "web"
+    elif eshte_kthese_e_thjeshte(teksti_user):
+        rendi, arsyeja = [MODELI_I_SHPEJTE, MODELI_I_MADH], "e_thjeshte"
+    else:
+        rendi, arsyeja = [MODELI_I_MADH, MODELI_I_SHPEJTE], "komplekse"
+    kandidatet = [modelet[emri] for emri in dict.fromkeys(rendi + MODELET_REZERVE)]
+    te_lira = [m for m in kandidatet if m.siguresa.lejon()]
+    if not te_lira:
+        # Të gjitha të pushuara - provo gjithsesi primarin, më mirë se fraza e gabimit
+        te_lira, arsyeja = kandidatet[:1], "siguresa"
+    elif te_lira[0] is not kandidatet[0]:
+        arsyeja = "siguresa"
+    m_modeli_zgjedhje.shto(1, te_lira[0].emri, arsyeja)
+    return te_lira
+
+async def _thirr_modelin(modeli: Modeli, mesazhet: list) -> str:
+    modeli.siguresa.fillo()
+    modeli.thirrje += 1
+    fillimi = time.perf_counter()
+    try:
+        # Faza mban emrin e modelit, që Server-Timing të tregojë cili u përgjigj dhe sa zgjati
+        with mat(f"llm.{modeli.emri}"):
+            r = await thirr("llm", lambda: klienti("groq").post(
+                "/chat/completions",
+                json={
+                    "model": modeli.emri,
+                    "messages": mesazhet,
+                    "temperature": 0.75,
+                    "max_tokens": 400
+                }
+            ))
+            r.raise_for_status()
+            data = r.json()
+            teksti = data["choices"][0]["message"]["content"].strip()
+    except (RadhaEPlote, asyncio.CancelledError):
+        modeli.siguresa.anulo()
+        raise
+    except Exception:
+        modeli.gabime += 1
+        modeli.siguresa.deshtim()
+        m_modeli_sekonda.vezhgo(time.perf_counter() - fillimi, modeli.emri, "gabim")
+        raise
+    kohezgjatja = time.perf_counter() - fillimi
+    modeli.vonesat.append(kohezgjatja)
+    modeli.siguresa.sukses()
+    m_modeli_sekonda.vezhgo(kohezgjatja, modeli.emri, "ok")
+    _regjistro_perdorimin(data.get("usage"))
+    return teksti
+
+async def _me_hedging(kandidatet: List[Modeli], mesazhet: list) -> str:
+    """Primari; nëse vonohet përtej përqindjes së vet, niset edhe rezerva dhe fiton përgjigjja e parë.
+
+    Kur një thirrje dështon dhe s'ka tjetër në rrugë, kalohet te kandidati i radhës."""
+    loop = asyncio.get_running_loop()
+    ne_radhe = list(kandidatet)
+    detyrat: Dict[asyncio.Future, Modeli] = {}
+    gabimi: Optional[BaseException] = None
+    hedge_afati = None
+
+    def nis_tjeterin():
+        modeli = ne_radhe.pop(0)
+        detyrat[asyncio.ensure_future(_thirr_modelin(modeli, mesazhet))] = modeli
+
+    nis_tjeterin()
+    if HEDGE_PERQINDJA > 0 and ne_radhe:
+        pritja = kandidatet[0].afati_hedge()
+        mbetur = koha_e_mbetur()
+        if mbetur is not None:
+            # Me afat të ngushtë rezerva niset më herët, që të ketë kohë të përgjigjet
+            pritja = min(pritja, max(0.0, mbetur / 2))
+        hedge_afati = loop.time() + pritja
+    try:
+        while detyrat:
+            timeout = None if hedge_afati is None else max(0.0, hedge_afati - loop.time())
+            kryer, _ = await asyncio.wait(detyrat, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not kryer:
+                hedge_afati = None
+                # Nën ngarkesë hedge-i vetëm do ta zgjaste radhën
+                if ne_radhe and radhet["llm"].ne_pritje == 0:
+                    m_modeli_hedge.shto(1, ne_radhe[0].emri)
+                    nis_tjeterin()
+                continue
+            for detyre in kryer:
+                modeli = detyrat.pop(detyre)
+                try:
+                    teksti = detyre.result()
+                except RadhaEPlote as e:
+                    # Rezerva s'gjeti vend - pret primarin; primari s'gjeti vend - 503
+                    if not detyrat:
+                        raise
+                    gabimi = gabimi or e
+                    continue
+                except Exception as e:
+                    print(f"Gabim AI ({modeli.emri}): {e}")
+                    gabimi = e
+                    if not detyrat and ne_radhe:
+                        hedge_afati = None
+                        nis_tjeterin()
+                    continue
+                if modeli is not kandidatet[0]:
+                    modeli.fitore_si_rezerve += 1
+                return teksti
+        raise gabimi or RuntimeError("asnjë model nuk u përgjigj")
+    finally:
+        for detyre in detyrat:
+            detyre.cancel()
+        if detyrat:
+            await asyncio.gather(*detyrat, return_exceptions=True)
+
+async def pyete_ai(mesazhet: list, teksti_user: str = "", me_web: bool = False) -> str:
+    """Pyet Groq me modelin e zgjedhur nga router-i; RadhaEPlote kalon lart që endpoint-i të kthejë 503"""
+    try:
+        return await brenda_afatit(_me_hedging(zgjidh_modelet(teksti_user, me_web), mesazhet))
+    except RadhaEPlote:
+        raise
+    except asyncio.TimeoutError:
+        m_afati_kaloi.shto(1, "ai_me_web" if me_web else "ai")
+        return FRAZA_VONESE
+    except Exception as e:
+        print(f"Gabim AI: {e}")
+        return FRAZA_GABIM_AI
+
+async def _stream_i_modelit(modeli: Modeli, mesazhet: list) -> AsyncIterator[str]:
+    kerkesa = klienti("groq").build_request(
+        "POST",
+        "/chat/completions",
+        json={
+            "model": modeli.emri,
+            "messages": mesazhet,
+            "temperature": 0.75,
+            "max_tokens": 400,
+            "stream": True
+        }
+    )
+    # Vendi në radhë mbahet deri në tokenin e fundit, jo vetëm deri te headers
+    async with radhet["llm"].vend():
+        r = await me_riprovim(radhet["llm"], lambda: klienti("groq").send(kerkesa, stream=True))
+        try:
+            r.raise_for_status()
+            async for rreshti in r.aiter_lines():
+                if not rreshti.startswith("data:"):
+                    continue
+                te_dhenat = rreshti[5:].strip()
+                if te_dhenat == "[DONE]":
+                    break
+                delta = json.loads(te_dhenat)["choices"][0].get("delta", {}).get("content")
+                if delta:
+                    yield delta
+        finally:
+            await r.aclose()
+
+async def pyete_ai_stream(mesazhet: list, teksti_user: str = "", me_web: bool = False) -> AsyncIterator[str]:
+    """Si pyete_ai, por jep tokenat sapo i dërgon Groq.
+
+    Pa hedging (dy stream-e do të mbanin dy vende në radhë deri në fund); nëse modeli
+    dështon para tokenit të parë, kalohet te kandidati i radhës."""
+    kandidatet = zgjidh_modelet(teksti_user, me_web)
+    for i, modeli in enumerate(kandidatet):
+        dha = False
+        modeli.siguresa.fillo()
+        modeli.thirrje += 1
+        fillimi = time.perf_counter()
+        try:
+            with mat(f"llm.{modeli.emri}"):
+                async for delta in _stream_i_modelit(modeli, mesazhet):
+                    dha = True
+                    yield delta
+        except (RadhaEPlote, asyncio.CancelledError, GeneratorExit):
+            modeli.siguresa.anulo()
+            raise
+        except Exception as e:
+            modeli.gabime += 1
+            modeli.siguresa.deshtim()
+            m_modeli_sekonda.vezhgo(time.perf_counter() - fillimi, modeli.emri, "gabim")
+            if dha or i == len(kandidatet) - 1:
+                raise
+            print(f"Gabim AI stream ({modeli.emri}): {e}")
+            continue
+        kohezgjatja = time.perf_counter() - fillimi
+        modeli.vonesat.append(kohezgjatja)
+        modeli.siguresa.sukses()
+        m_modeli_sekonda.vezhgo(kohezgjatja, modeli.emri, "ok")
+        if i > 0:
+            modeli.fitore_si_rezerve += 1
+        return
+
+_FUND_FJALIE = re.compile(r'[.!?…]+["\'»)]*\s+|\n+')
+
+def ndaj_fjalite(teksti: str) -> Tuple[List[str], str]:
+    """Ndan fjalitë e plota nga teksti i ardhur deri tani; kthen edhe mbetjen"""
+    fjalite = []
+    fillimi = 0
+    for m in _FUND_FJALIE.finditer(teksti):
+        fjalia = teksti[fillimi:m.end()].strip()
+        # Fjalitë shumë të shkurtra bashkohen me të ardhshmen
+        if len(fjalia) >= FJALI_MIN_GJATESI:
+            fjalite.append(fjalia)
+            fillimi = m.end()
+    return fjalite, teksti[fillimi:]
+
+async def fjalite_nga_ai(mesazhet: list, teksti_user: str = "", me_web: bool = False) -> AsyncIterator[str]:
+    dha = False
+    mbetja = ""
+    rrjedha = pyete_ai_stream(mesazhet, teksti_user, me_web)
+    try:
+        while True:
+            # Afati vlen deri te fjalia e parë; pasi pajisja po flet, përgjigja mbaron natyrshëm
+            try:
+                copa = await (rrjedha.__anext__() if dha else brenda_afatit(rrjedha.__anext__()))
+            except StopAsyncIteration:
+                break
+            fjalite, mbetja = ndaj_fjalite(mbetja + copa)
+            for fjalia in fjalite:
+                dha = True
+                yield fjalia
+        if mbetja.strip():
+            yield mbetja.strip()
+    except asyncio.TimeoutError:
+        m_afati_kaloi.shto(1, "ai_me_web" if me_web else "ai")
+        if not dha:
+            yield FRAZA_VONESE
+    except Exception as e:
+        print(f"Gabim AI stream: {e}")
+        if not dha:
+            yield FRAZA_GABIM_AI
+    finally:
+        await rrjedha.aclose()
+
+def mesazhi_info_web(teksti_user: str, info_web: str) -> dict:
+    return {
+        "role": "system",
+        "content": (
+            f"Informacion i gjetur nga interneti për pyetjen '{teksti_user}':\n{info_web}\n\n"
+            f"Përdor këtë informacion për të dhënë një përgjigje të plotë dhe të saktë në shqip. "
+            f"Mos thuaj 'sipas internetit' ose 'sipas kërkimit' - thjesht përgjigju natyrshëm."
+        )
+    }
+
+_cache_pergjigjeve = CacheLRU(PERGJIGJE_CACHE_MAX)
+statistika_cache_pergjigjeve = {"hit": 0, "miss": 0, "jashte": 0, "me_kontekst": 0, "ruajtur": 0}
+
+# Pyetjet e pranueshme nisin me fjalë pyetëse (pa diakritikë, si i kthen normalo_pyetjen).
+# Fjalët personale, ato që i referohen bisedës ("ai", "kjo") ose kohës ("sot", "tani") e
+# nxjerrin pyetjen nga cache-i; këto krahasohen para heqjes së diakritikëve, që "më"
+# (personale) të mos ngatërrohet me "me" dhe "në" me "ne".
+_FJALE_PYETESE = frozenset({
+    "kush", "kujt", "kend", "cfare", "cka", "cili", "cila", "cilet", "cilat", "sa", "kur",
+    "ku", "si", "pse", "perse", "a", "c",
+})
+_FJALE_JO_CACHE = frozenset({
+    "unë", "une", "mua", "më", "im", "ime", "imi", "tim", "time", "jam", "jem", "kam",
+    "isha", "kisha", "neve", "na", "jemi", "kemi", "tonë", "tone", "ti", "ty", "je", "ke",
+    "yt", "jot", "jote", "ju", "juve", "jeni", "keni", "juaj", "luna",
+    "ai", "ajo", "ata", "ato", "ky", "kjo", "këta", "keta", "këto", "keto", "atë", "ate",
+    "këtë", "kete", "tij", "saj", "tyre", "atij", "asaj", "këtij", "ketij", "kësaj", "kesaj",
+    "po", "edhe", "tjetër", "tjeter", "tjetra", "atëherë", "atehere",
+    "sot", "nesër", "neser", "pasnesër", "pasneser", "dje", "tani", "aktualisht",
+    "momentalisht", "sivjet", "vjet", "javën", "javen", "javë", "jave", "muajin",
+    "orë", "ore", "ora", "moti", "motin", "lajmet", "lajme",
+})
+# Fjalë që nuk e bëjnë pyetjen të plotë më vete ("sa kushton?", "si quhet?") - pa diakritikë
+_FJALE_JO_PERMBAJTJE = frozenset({
+    "eshte", "ishte", "jane", "ishin", "ka", "kane", "kishte", "do", "u", "te", "e", "i", "se", "me",
+    "ne", "nga", "per", "tek", "mbi", "nen", "pa", "deri", "qe", "nje", "disa", "dhe", "apo", "ose",
+    "por", "nuk", "s", "mos", "ja", "mund", "duhet", "kushton", "kushtojne", "quhet", "quhen", "behet",
+    "bej", "ben", "bejne", "thua", "shume", "pak", "mire", "keq", "aty", "ketu", "atje", "keshtu",
+})
+
+def celesi_pergjigjes(teksti: str) -> Optional[str]:
+    """Çelësi i cache-it për pyetjet pa kontekst dhe jo personale - None për të gjitha të tjerat"""
+    if not PERGJIGJE_CACHE:
+        return None
+    celesi = normalo_pyetjen(teksti)
+    fjalet = celesi.split()
+    fjalet_origjinale = re.sub(r"[^\w\s]", " ", teksti.lower()).split()
+    permbajtja = [f for f in fjalet if f not in _FJALE_PYETESE and f not in _FJALE_JO_PERMBAJTJE]
+    if not 2 <= len(fjalet) <= 16 or fjalet[0] not in _FJALE_PYETESE \
+            or len(permbajtja) < PERGJIGJE_CACHE_MIN_FJALE \
+            or any(f in _FJALE_JO_CACHE or f.isdigit() for f in fjalet_origjinale):
+        statistika_cache_pergjigjeve["jashte"] += 1
+        return None
+    return celesi
+
+async def celesi_pergjigjes_per_pajisjen(device_id: str, teksti: str) -> Optional[str]:
+    """Pas kthesave të tjera edhe pyetja "e përgjithshme" mund t'u referohet atyre -
+    cache-i lexohet dhe shkruhet vetëm kur dritarja e bisedës është bosh"""
+    celesi = celesi_pergjigjes(teksti)
+    # mesazhet[0] është gjithmonë system prompt-i; çdo gjë tjetër (përmbledhje, kthesa) është kontekst
+    if celesi is not None and len(await bisedat.mesazhet(device_id)) > 1:
+        statistika_cache_pergjigjeve["me_kontekst"] += 1
+        return None
+    return celesi
+
+def merr_pergjigjen_e_ruajtur(celesi: Optional[str]) -> Optional[str]:
+    if celesi is None:
+        return None
+    hyrja = _cache_pergjigjeve.get(celesi)
+    if hyrja is not None and time.monotonic() < hyrja[0]:
+        statistika_cache_pergjigjeve["hit"] += 1
+        m_cache.shto(1, "pergjigje", "hit")
+        return hyrja[1]
+    statistika_cache_pergjigjeve["miss"] += 1
+    m_cache.shto(1, "pergjigje", "miss")
+    return None
+
+async def ruaj_pergjigjen(celesi: Optional[str], pergjigja: str, emri: str, nga_web: bool):
+    """Ruan vetëm përgjigje të vërteta - jo gabime, jo "nuk e di", jo ato që përmendin përdoruesin"""
+    if celesi is None or not pergjigja or pergjigja in (FRAZA_GABIM_AI, FRAZA_VONESE):
+        return
+    if emri and f" {normalo_pyetjen(emri)} " in f" {normalo_pyetjen(pergjigja)} ":
+        return
+    if await duhet_kerkuar(celesi, pergjigja):
+        return
+    # Informacioni nga interneti vjetërohet më shpejt
+    ttl = min(PERGJIGJE_CACHE_TTL_S, WEB_TTL_S) if nga_web else PERGJIGJE_CACHE_TTL_S
+    _cache_pergjigjeve.vendos(celesi, (time.monotonic() + ttl, pergjigja))
+    statistika_cache_pergjigjeve["ruajtur"] += 1
+
+def statistika_e_cache_pergjigjeve() -> dict:
+    s = statistika_cache_pergjigjeve
+    kerkesat = s["hit"] + s["miss"]
+    return {**s, "hyrje": len(_cache_pergjigjeve), "aktiv": PERGJIGJE_CACHE,
+            "hit_rate": round(s["hit"] / kerkesat, 3) if kerkesat else 0.0}
+
+async def emri_i_perdoruesit(device_id: str) -> str:
+    return (await perdoruesit.merr(device_id, {})).get("emri", "")
+
+async def kerko_web_brenda_afatit(teksti_user: str) -> str:
+    """Kërkimi në web vetëm nëse mbetet kohë edhe për thirrjen e dytë te AI - përndryshe bosh"""
+    mbetur = koha_e_mbetur()
+    if mbetur is not None and mbetur < AFATI_MIN_WEB_S:
+        m_afati_kaloi.shto(1, "kerko_web")
+        return ""
+    print(f"Kërkoj në web për: {teksti_user}")
+    try:
+        with mat("kerko_web"):
+            return await brenda_afatit(kerko_web(teksti_user), rezerve_s=AFATI_REZERVE_AI_S)
+    except asyncio.TimeoutError:
+        m_afati_kaloi.shto(1, "kerko_web")
+        return ""
+
+# Pa diakritikë, si i kthen normalo_pyetjen
+_KERKIM_I_FRESKET = re.compile(
+    r"\b(sot|tani|aktualisht|momentalisht|kete jave|se fundmi|i fundit|e fundit|lajm\w*|cmim\w*"
+    r"|sa kushton|kurs\w* i|rezultat\w*|ndeshj\w*|fitoi|fiton|zgjedhj\w*|20[2-3]\d)\b"
+)
+_KERKIM_ENTITETI = re.compile(
+    r"\b(kush (eshte|ishte)|kryeministr\w*|president\w*|kryetar\w*|ministr\w*|sa banore"
+    r"|popullsi\w*|themelues\w*|drejtor\w*|ceo)\b"
+)
+_EMER_I_PERVECEM = re.compile(r"(?<=\s)[A-ZÇË][a-zçë]{2,}")
+# Biseda me Lunën ("si je sot?", "më trego një shaka tani") - "sot" e "tani" aty s'kërkojnë web.
+# Krahasohen para heqjes së diakritikëve, si _FJALE_JO_CACHE.
+_FJALE_SOCIALE = frozenset({
+    "unë", "une", "mua", "më", "jam", "kam", "ti", "ty", "je", "ke", "jemi", "kemi", "jeni", "keni",
+    "luna", "hamë", "bëjmë", "bejme", "shaka", "përrallë", "perralle", "këndo", "kendo",
+    "faleminderit", "flm", "përshëndetje", "pershendetje", "tungjatjeta", "çkemi", "ckemi",
+})
+
+_historia_kerkimeve = CacheLRU(PARASHIKIM_HISTORIA_MAX)
+statistika_parashikimit = {
+    "pyetje": 0, "paralel": 0, "anuluar": 0, "injektuar": 0, "kampion": 0,
+    "vp": 0, "fp": 0, "vn": 0, "fn": 0,       # vetëm pyetjet ku AI u pyet pa informacion (etiketa = duhet_kerkuar)
+    "thirrje_llm_kursyer": 0, "kohe_kursyer_ms": 0.0,
+}
+
+Metrika("luna_parashikim_kerkimi_total", "Parashikimet e kërkimit web sipas rezultatit (vp/fp/vn/fn)",
+        "counter", ("rezultati",),
+        lexo=lambda: {(k,): statistika_parashikimit[k] for k in ("vp", "fp", "vn", "fn")})
+Metrika("luna_parashikim_menyra_total", "Pyetjet ku kërkimi nisi paralel ose u injektua para AI-së",
+        "counter", ("menyra",),
+        lexo=lambda: {(k,): statistika_parashikimit[k] for k in ("paralel", "injektuar")})
+Metrika("luna_parashikim_llm_kursyer_total",
+        "Thirrjet te AI të kursyera nga injektimi - vetëm kur refuzimi i së njëjtës pyetje është matur", "counter", (),
+        lexo=lambda: {(): statistika_parashikimit["thirrje_llm_kursyer"]})
+
+def eshte_bisede_sociale(teksti: str) -> bool:
+    return any(f in _FJALE_SOCIALE for f in re.sub(r"[^\w\s]", " ", teksti.lower()).split())
+
+def gjasat_e_kerkimit(teksti: str) -> float:
+    """Sa gjasa ka që pyetja të dojë kërkim në web: klasifikues i lirë + historia e së njëjtës pyetje"""
+    celesi = normalo_pyetjen(teksti)
+    if eshte_bisede_sociale(teksti):
+        gjasat = 0.1
+    elif _KERKIM_I_FRESKET.search(celesi):
+        gjasat = 0.85
+    elif _KERKIM_ENTITETI.search(celesi):
+        gjasat = 0.65
+    elif _EMER_I_PERVECEM.search(teksti):
+        gjasat = 0.55
+    else:
+        gjasat = 0.1
+    historia = _historia_kerkimeve.get(celesi)
+    if historia:
+        # Klasifikuesi vlen si një vëzhgim paraprak - historia e mbizotëron shpejt
+        u_desh, gjithsej = historia
+        gjasat = (u_desh + gjasat) / (gjithsej + 1)
+    return gjasat
+
+def regjistro_rezultatin_e_kerkimit(teksti: str, parashikuar: bool, u_desh: bool):
+    """duhet_kerkuar e përgjigjes pa informacion është e vërteta për parashikimin"""
+    celesi = normalo_pyetjen(teksti)
+    u_desh_para, gjithsej = _historia_kerkimeve.get(celesi) or (0, 0)
+    _historia_kerkimeve.vendos(celesi, (u_desh_para + int(u_desh), gjithsej + 1))
+    fusha = ("vp" if u_desh else "fp") if parashikuar else ("fn" if u_desh else "vn")
+    statistika_parashikimit[fusha] += 1
+
+def regjistro_kursimin(teksti: str):
+    """Një injektim kursen thirrjen e dytë vetëm nëse kjo pyetje është matur pa web dhe AI-ja refuzoi"""
+    u_desh, gjithsej = _historia_kerkimeve.get(normalo_pyetjen(teksti)) or (0, 0)
+    if 2 * u_desh > gjithsej:
+        statistika_parashikimit["thirrje_llm_kursyer"] += 1
+
+def statistika_e_parashikimit() -> dict:
+    s = statistika_parashikimit
+    etiketuar = s["vp"] + s["fp"] + s["vn"] + s["fn"]
+    return {
+        **s,
+        "kohe_kursyer_ms": round(s["kohe_kursyer_ms"]),
+        "saktesia": round((s["vp"] + s["vn"]) / etiketuar, 3) if etiketuar else None,
+        "precision": round(s["vp"] / (s["vp"] + s["fp"]), 3) if s["vp"] + s["fp"] else None,
+        "recall": round(s["vp"] / (s["vp"] + s["fn"]), 3) if s["vp"] + s["fn"] else None,
+        "historia": len(_historia_kerkimeve),
+        "aktiv": PARASHIKIM_AKTIV,
+    }
+
+class KerkimSpekulativ:
+    """Kërkimi web që nis bashkë me thirrjen e parë te AI; mban kohën që të matet fitimi"""
+
+    def __init__(self, teksti_user: str):
+        self.fillimi = time.perf_counter()
+        self.mbaroi: Optional[float] = None
+        self.detyra = nis_detyre(self._kerko(teksti_user))
+
+    async def _kerko(self, teksti_user: str) -> str:
+        try:
+            return await kerko_web_brenda_afatit(teksti_user)
+        finally:
+            self.mbaroi = time.perf_counter()
+
+    async def rezultati(self) -> str:
+        """Pritet vetëm kur AI refuzoi; koha e kursyer = sa nga kërkimi u mbulua nga thirrja e parë"""
+        pritja_fillon = time.perf_counter()
+        info_web = await asyncio.shield(self.detyra)
+        kerkimi = (self.mbaroi or time.perf_counter()) - self.fillimi
+        statistika_parashikimit["kohe_kursyer_ms"] += 1000 * max(0.0, kerkimi - (time.perf_counter() - pritja_fillon))
+        return info_web
+
+    def anulo(self):
+        """AI u përgjigj pa pasur nevojë për web - kërkimi që s'do lexohet ndalet menjëherë"""
+        if not self.detyra.done():
+            self.detyra.cancel()
+            statistika_parashikimit["anuluar"] += 1
+
+def nis_parashikimin(teksti_user: str) -> Tuple[str, Optional[KerkimSpekulativ]]:
+    """"injekto" = kërko para thirrjes së vetme; "paralel" = kërkimi nis bashkë me AI-në; "jo" = si më parë.
+
+    Kthesat e shkurtra nuk injektohen (mbeten te modeli i shpejtë), dhe një kampion i
+    injektimeve kalon nga rruga paralele, që historia të mësojë edhe nga parashikimet e gabuara."""
+    if not PARASHIKIM_AKTIV:
+        return "jo", None
+    statistika_parashikimit["pyetje"] += 1
+    gjasat = gjasat_e_kerkimit(teksti_user)
+    mbetur = koha_e_mbetur()
+    if mbetur is not None and mbetur < AFATI_MIN_WEB_S:
+        return "jo", None
+    if gjasat >= PARASHIKIM_PRAGU_INJEKTIM and not eshte_kthese_e_thjeshte(teksti_user):
+        if random.random() >= PARASHIKIM_KAMPION:
+            statistika_parashikimit["injektuar"] += 1
+            return "injekto", None
+        statistika_parashikimit["kampion"] += 1
+    if gjasat >= PARASHIKIM_PRAGU:
+        statistika_parashikimit["paralel"] += 1
+        return "paralel", KerkimSpekulativ(teksti_user)
+    return "jo", None
+
+async def pergjigja_me_kerkime(device_id: str, teksti_user: str) -> str:
+    """AI me web search automatik nëse nuk di përgjigjen"""
+
+    # Pyetjet e përgjithshme që dikush tjetër i ka bërë së fundi nuk shkojnë te AI
+    celesi = await celesi_pergjigjes_per_pajisjen(device_id, teksti_user)
+    e_ruajtur = merr_pergjigjen_e_ruajtur(celesi)
+    if e_ruajtur is not None:
+        await bisedat.shto(device_id, "user", teksti_user)
+        await bisedat.shto(device_id, "assistant", e_ruajtur)
+        return e_ruajtur
+
+    await bisedat.shto(device_id, "user", teksti_user)
+    try:
+        return await _pergjigja_nga_ai(device_id, teksti_user, celesi)
+    except RadhaEPlote:
+        # Kthehet 503 - pyetja pa përgjigje s'duhet të mbetet në histori
+        await bisedat.hiq_kthesen(device_id, "user", teksti_user)
+        raise
+
+async def _pergjigja_nga_ai(device_id: str, teksti_user: str, celesi: Optional[str]) -> str:
+    menyra, spekulativ = nis_parashikimin(teksti_user)
+
+    if menyra == "injekto":
+        # Pothuajse e sigurt që duhet kërkim - informacioni hyn para thirrjes së vetme
+        info_web = await kerko_web_brenda_afatit(teksti_user)
+        if info_web:
+            with mat("ai_me_web"):
+                pergjigja = await pyete_ai(await mesazhet_per_ai(device_id) + [mesazhi_info_web(teksti_user, info_web)],
+                                           teksti_user, me_web=True)
+            if pergjigja not in (FRAZA_VONESE, FRAZA_GABIM_AI):
+                regjistro_kursimin(teksti_user)
+                await bisedat.shto(device_id, "assistant", pergjigja)
+                nis_permbledhjen(device_id)
+                await ruaj_pergjigjen(celesi, pergjigja, await emri_i_perdoruesit(device_id), nga_web=True)
+                return pergjigja
+        # Kërkimi s'gjeti gjë - vazhdo si zakonisht
+
+    # Pyetja e parë te AI
+    try:
+        with mat("ai"):
+            pergjigja1 = await pyete_ai(await mesazhet_per_ai(device_id), teksti_user)
+
+        # Kontrollo nëse AI ka nevojë për informacion
+        duhet = await duhet_kerkuar(teksti_user, pergjigja1)
+    except BaseException:
+        if spekulativ:
+            spekulativ.anulo()
+        raise
+    if spekulativ and not duhet:
+        spekulativ.anulo()
+    if menyra != "injekto" and PARASHIKIM_AKTIV and pergjigja1 not in (FRAZA_VONESE, FRAZA_GABIM_AI):
+        regjistro_rezultatin_e_kerkimit(teksti_user, spekulativ is not None, duhet)
+    if duhet:
+        info_web = await (spekulativ.rezultati() if spekulativ else kerko_web_brenda_afatit(teksti_user))
+
+        if info_web:
+            # Rishpjego me informacionin e gjetur
+            mesazhet_te_reja = await mesazhet_per_ai(device_id)
+            mesazhet_te_reja.append(mesazhi_info_web(teksti_user, info_web))
+            try:
+                with mat("ai_me_web"):
+                    pergjigja_finale = await pyete_ai(mesazhet_te_reja, teksti_user, me_web=True)
+            except RadhaEPlote:
+                # Kemi tashmë një përgjigje - më mirë ajo se sa 503
+                pergjigja_finale = pergjigja1
+            if pergjigja_finale in (FRAZA_VONESE, FRAZA_GABIM_AI):
+                # Edhe këtu - përgjigja e parë është më e dobishme se falja
+                pergjigja_finale = pergjigja1
+            await bisedat.shto(device_id, "assistant", pergjigja_finale)
+            nis_permbledhjen(device_id)
+            await ruaj_pergjigjen(celesi, pergjigja_finale, await emri_i_perdoruesit(device_id), nga_web=True)
+            return pergjigja_finale
+
+    await bisedat.shto(device_id, "assistant", pergjigja1)
+    nis_permbledhjen(device_id)
+    await ruaj_pergjigjen(celesi, pergjigja1, await emri_i_perdoruesit(device_id), nga_web=False)
+    return pergjigja1
+
+async def pergjigja_me_kerkime_stream(device_id: str, teksti_user: str) -> AsyncIterator[str]:
+    """Si pergjigja_me_kerkime, por jep përgjigjen fjali pas fjalie.
+
+    Çdo fjali kontrollohet me duhet_kerkuar para se të dalë; nëse AI nuk e di,
+    fjalitë e tjera mbahen mënjanë derisa të dihet nëse kërkimi në web gjen diçka."""
+    celesi = await celesi_pergjigjes_per_pajisjen(device_id, teksti_user)
+    e_ruajtur = merr_pergjigjen_e_ruajtur(celesi)
+    await bisedat.shto(device_id, "user", teksti_user)
+    if e_ruajtur is not None:
+        await bisedat.shto(device_id, "assistant", e_ruajtur)
+        # E gjithë përgjigja si një fjali - i njëjti tekst si te /ask, pra edhe zëri del nga cache_tts
+        yield e_ruajtur
+        return
+    try:
+        async for fjalia in _fjalite_nga_ai_me_kerkime(device_id, teksti_user, celesi):
+            yield fjalia
+    except RadhaEPlote:
+        await bisedat.hiq_kthesen(device_id, "user", teksti_user)
+        raise
+
+async def _fjalite_nga_ai_me_kerkime(device_id: str, teksti_user: str, celesi: Optional[str]) -> AsyncIterator[str]:
+    te_thena: List[str] = []
+    nga_web = False
+    menyra, spekulativ = nis_parashikimin(teksti_user)
+
+    if menyra == "injekto":
+        info_web = await kerko_web_brenda_afatit(teksti_user)
+        if info_web:
+            mesazhet_te_reja = await mesazhet_per_ai(device_id) + [mesazhi_info_web(teksti_user, info_web)]
+            async for fjalia in fjalite_nga_ai(mesazhet_te_reja, teksti_user, me_web=True):
+                te_thena.append(fjalia)
+                yield fjalia
+            if te_thena and te_thena[0] not in (FRAZA_VONESE, FRAZA_GABIM_AI):
+                regjistro_kursimin(teksti_user)
+            pergjigja = " ".join(te_thena)
+            await bisedat.shto(device_id, "assistant", pergjigja)
+            nis_permbledhjen(device_id)
+            await ruaj_pergjigjen(celesi, pergjigja, await emri_i_perdoruesit(device_id), nga_web=True)
+            return
+
+    burimi = fjalite_nga_ai(await mesazhet_per_ai(device_id), teksti_user)
+    mbajtura: Optional[List[str]] = None
+
+    try:
+        async for fjalia in burimi:
+            if await duhet_kerkuar(teksti_user, fjalia):
+                mbajtura = [fjalia]
+                break
+            te_thena.append(fjalia)
+            yield fjalia
+    except BaseException:
+        # Edhe kur klienti shkëputet - askush s'do ta lexojë kërkimin
+        if spekulativ:
+            spekulativ.anulo()
+        raise
+    if spekulativ and mbajtura is None:
+        spekulativ.anulo()
+    if menyra != "injekto" and PARASHIKIM_AKTIV and (te_thena or mbajtura) \
+            and (te_thena or mbajtura)[0] not in (FRAZA_VONESE, FRAZA_GABIM_AI):
+        regjistro_rezultatin_e_kerkimit(teksti_user, spekulativ is not None, mbajtura is not None)
+
+    if mbajtura is not None:
+        async def _mblidh():
+            async for f in burimi:
+                mbajtura.append(f)
+
+        mbledhja = asyncio.ensure_future(_mblidh())
+        try:
+            info_web = await (spekulativ.rezultati() if spekulativ else kerko_web_brenda_afatit(teksti_user))
+            if info_web:
+                mbledhja.cancel()
+                nga_web = True
+                mesazhet_te_reja = await mesazhet_per_ai(device_id) + [mesazhi_info_web(teksti_user, info_web)]
+                async for fjalia in fjalite_nga_ai(mesazhet_te_reja, teksti_user, me_web=True):
+                    te_thena.append(fjalia)
+                    yield fjalia
+            else:
+                await mbledhja
+                for fjalia in mbajtura:
+                    te_thena.append(fjalia)
+                    yield fjalia
+        finally:
+            mbledhja.cancel()
+            await asyncio.gather(mbledhja, return_exceptions=True)
+    await burimi.aclose()
+
+    pergjigja = " ".join(te_thena)
+    await bisedat.shto(device_id, "assistant", pergjigja)
+    nis_permbledhjen(device_id)
+    await ruaj_pergjigjen(celesi, pergjigja, await emri_i_perdoruesit(device_id), nga_web)
+
+_ne_permbledhje: set = set()
+statistika_permbledhjes = {"permbledhje": 0, "gabime": 0, "anashkaluar": 0}
+
+async def permbledh_biseden(device_id: str):
+    """Fut kthesat që dolën nga buxheti te përmbledhja e bisedës - me modelin e vogël, jashtë rrugës së përgjigjes"""
+    permbledhja, kthesat, shenja = await bisedat.per_permbledhje(device_id)
+    if len(kthesat) < PERMBLEDHJE_MIN_KTHESA:
+        return
+    _ne_permbledhje.add(device_id)
+    try:
+        biseda = "\n".join(f"{'Përdoruesi' if r == ROLI_KOD['user'] else 'Luna'}: {t}" for r, t in kthesat)
+        r = await thirr("llm", lambda: klienti("groq").post(
+            "/chat/completions",
+            json={
+                "model": PERMBLEDHJE_MODELI,
+                "messages": [
+                    {"role": "system", "content": (
+                        "Përmbledh bisedën në shqip, në më pak se 120 fjalë. Ruaj faktet për përdoruesin "
+                        "(emra, preferenca, plane, pyetje të hapura) dhe temat kryesore. Vetëm përmbledhjen."
+                    )},
+                    {"role": "user", "content": f"Përmbledhja deri tani:\n{permbledhja or '-'}\n\nBiseda e mëtejshme:\n{biseda}"},
+                ],
+                "temperature": 0.2,
+                "max_tokens": 250
+            }
+        ))
+        r.raise_for_status()
+        te_dhenat = r.json()
+        _regjistro_perdorimin(te_dhenat.get("usage"))
+        e_re = te_dhenat["choices"][0]["message"]["content"].strip()
+        if e_re:
+            await bisedat.vendos_permbledhjen(device_id, e_re, shenja)
+            statistika_permbledhjes["permbledhje"] += 1
+    except Exception as e:
+        statistika_permbledhjes["gabime"] += 1
+        print(f"Gabim përmbledhje bisede: {e}")
+    finally:
+        _ne_permbledhje.discard(device_id)
+
+def nis_permbledhjen(device_id: str):
+    if not BISEDA_PERMBLEDHJE or device_id in _ne_permbledhje:
+        return
+    # Përmbledhja pret - kur ka pyetje në radhë për modelin, ato kanë përparësi
+    if radhet["llm"].ne_pritje > 0:
+        statistika_permbledhjes["anashkaluar"] += 1
+        return
+    nis_detyre(permbledh_biseden(device_id))
+
+# ════════════════════════════════════════════════════════════
+#  PËRPUNIMI I PYETJES
+# ════════════════════════════════════════════════════════════
+async def pergatit_biseden(device_id: str, emri: Optional[str] = None) -> str:
+    """Ruan emrin, rifreskon system prompt-in dhe kthen emrin e përdoruesit"""
+    if emri:
+        profili = await perdoruesit.merr(device_id, {})
+        profili["emri"] = emri
+        await perdoruesit.vendos(device_id, profili)
+
+    await bisedat.vendos_system(device_id, await krijo_system_prompt(device_id))
+
+    return await emri_i_perdoruesit(device_id)
+
+async def pergjigju_intentit(device_id: str, teksti: str, intent: dict, emri: str) -> Optional[str]:
+    """Përgjigja për intentet me trajtim të veçantë - None kur duhet AI"""
+    pergjigja: Optional[str] = None
+
+    if intent["lloj"] == "mot":
+        with mat("mot"):
+            pergjigja = await merre_motin(intent["qyteti"])
+
+    elif intent["lloj"] == "rruge":
+        if "origjina" in intent:
+            with mat("rruge"):
+                pergjigja = await merre_rrugën(intent["origjina"], intent["destinacioni"])
+
+    elif intent["lloj"] == "ora":
+        ora = koha_tani()
+        pergjigja = f"Ora tani është {ora}." if not emri else f"{emri}, ora tani është {ora}."
+
+    elif intent["lloj"] == "data":
+        pergjigja = f"Sot është {data_sot()}."
+
+    elif intent["lloj"] == "alarm":
+        kur = koha_e_alarmit(intent["ora"]) if "ora" in intent else None
+        if kur is not None:
+            ora_alarm = intent["ora"]
+            await planifikuesi.shto_alarm(device_id, ora_alarm, kur)
+            pergjigja = f"Alarmi u vendos për orën {ora_alarm}."
+            if emri:
+                pergjigja = f"{emri}, alarmi u vendos për orën {ora_alarm}. Do të të zgjoj unë!"
+        else:
+            pergjigja = FRAZA_ALARM_SHEMBULL
+
+    elif intent["lloj"] == "timer":
+        if "sasia" in intent:
+            sasia  = intent["sasia"]
+            njesia = intent["njesia"]
+            sekonda = sasia * (1 if "sekond" in njesia else 3600 if "orë" in njesia or "ore" in njesia else 60)
+            njesia_str = "sekonda" if "sekond" in njesia else "orë" if "orë" in njesia or "ore" in njesia else "minuta"
+            await planifikuesi.shto_timer(device_id, sekonda)
+            pergjigja = f"Timer vendosur për {sasia} {njesia_str}."
+        else:
+            pergjigja = FRAZA_TIMER_PYETJE
+
+    elif intent["lloj"] == "ndihme_mendore":
+        pergjigja = FRAZA_NDIHME_MENDORE
+
+    return pergjigja
+
+async def pergjigju_intentit_brenda_afatit(device_id: str, teksti: str, intent: dict, emri: str) -> Optional[str]:
+    try:
+        return await brenda_afatit(pergjigju_intentit(device_id, teksti, intent, emri))
+    except asyncio.TimeoutError:
+        m_afati_kaloi.shto(1, intent["lloj"])
+        return FRAZA_VONESE
+
+async def _nen_afat(rrjedha: AsyncIterator[str], afati: Optional[float]) -> AsyncIterator[str]:
+    """Lexon rrjedhën nën afatin e kërkesës që e nisi - edhe kur StreamingResponse e lexon
+    pasi endpoint-i ka dalë nga `with me_afat(...)`"""
+    try:
+        while True:
+            shenja = _afati.set(afati)
+            try:
+                fjalia = await rrjedha.__anext__()
+            except StopAsyncIteration:
+                return
+            finally:
+                _afati.reset(shenja)
+            yield fjalia
+    finally:
+        await rrjedha.aclose()
+
+async def pergjigju(device_id: str, teksti: str, emri: str) -> Tuple[dict, str]:
+    """Intenti dhe përgjigja e plotë për një pyetje - handler-i i intentit ose AI me kërkim"""
+    with mat("intent"):
+        intent = detekto_intent(teksti)
+    pergjigja = await pergjigju_intentit_brenda_afatit(device_id, teksti, intent, emri)
+    if pergjigja is None:
+        pergjigja = await pergjigja_me_kerkime(device_id, teksti)
+    return intent, pergjigja
+
+async def fjalite_e_pergjigjes(device_id: str, teksti: str, intent: dict, emri: str) -> AsyncIterator[str]:
+    """Si pergjigju, por fjali pas fjalie për përgjigjet me stream"""
+    pergjigja = await pergjigju_intentit_brenda_afatit(device_id, teksti, intent, emri)
+    if pergjigja is not None:
+        return _nje_fjali(pergjigja)
+    # Pasi nis stream-i s'mund të kthejmë më 503 - refuzo që tani nëse radha është plot
+    if radhet["llm"].e_plote():
+        radhet["llm"].refuzuar += 1
+        raise RadhaEPlote(radhet["llm"])
+    return _nen_afat(pergjigja_me_kerkime_stream(device_id, teksti), _afati.get())
+
+def _ngjarje_sse(lloji: str, te_dhenat: dict) -> str:
+    return f"event: {lloji}\ndata: {json.dumps(te_dhenat, ensure_ascii=False)}\n\n"
+
+async def rrjedha_sse(device_id: str, request_id: str, intent: str,
+                      fjalite: AsyncIterator[str], me_audio: bool = True) -> AsyncIterator[str]:
+    """Dërgon tekstin dhe audion fjali pas fjalie si Server-Sent Events.
+
+    Çdo fjali niset menjëherë në TTS; audio del me radhë, ndërsa fjalitë e
+    tjera sintetizohen paralelisht. E gjithë audio mblidhet edhe te
+    depo_audio, që /get_audio të funksionojë si më parë."""
+    kryesori = await depo_audio.krijo(device_id, request_id)
+    dalja: asyncio.Queue = asyncio.Queue()
+    segmentet: asyncio.Queue = asyncio.Queue()
+    te_gjitha: List[str] = []
+    sintezat: List[asyncio.Task] = []
+
+    async def prodhuesi():
+        try:
+            i = 0
+            async for fjalia in fjalite:
+                te_gjitha.append(fjalia)
+                reg = RegjistrimAudio(None)
+                sintezat.append(nis_detyre(tts_edge(fjalia, reg)))
+                await segmentet.put(reg)
+                await dalja.put(("tekst", {"i": i, "tekst": fjalia}))
+                i += 1
+        except Exception as e:
+            print(f"Gabim stream: {e}")
+        finally:
+            await segmentet.put(None)
+
+    async def audio_me_radhe():
+        try:
+            i = 0
+            while (reg := await segmentet.get()) is not None:
+                async for copa in reg.rrjedha():
+                    kryesori.shto(copa)
+                    if me_audio:
+                        await dalja.put(("audio", {"i": i, "data": base64.b64encode(copa).decode()}))
+                i += 1
+        finally:
+            kryesori.mbyll(True)
+            await dalja.put(None)
+
+    detyrat = [asyncio.ensure_future(prodhuesi()), asyncio.ensure_future(audio_me_radhe())]
+    try:
+        yield _ngjarje_sse("fillim", {"request_id": request_id, "intent": intent})
+        while (ngjarja := await dalja.get()) is not None:
+            yield _ngjarje_sse(*ngjarja)
+        yield _ngjarje_sse("fund", {"answer": " ".join(te_gjitha), "intent": intent,
+                                    "request_id": request_id})
+    finally:
+        # Klienti u shkëput (ose stream-i mbaroi) - sintezat që s'kanë mbaruar s'i dëgjon më kush
+        for detyre in detyrat + sintezat:
+            detyre.cancel()
+        await asyncio.gather(*detyrat, *sintezat, return_exceptions=True)
+
+async def _nje_fjali(teksti: str) -> AsyncIterator[str]:
+    yield teksti
+
+# ════════════════════════════════════════════════════════════
+#  ENDPOINTS
+# ════════════════════════════════════════════════════════════
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if GJENDJA == "memory" and int(os.getenv("WEB_CONCURRENCY", "1")) > 1:
+        print("Kujdes: LUNA_STATE=memory me disa workers - çdo worker ka gjendjen e vet. Përdor LUNA_STATE=sqlite.")
+    await hap_klientet()
+    detyrat_sfond = []
+    # Pa nivel në disk ngrohja do të humbiste me çdo restart dhe do të përsëritej në çdo worker
+    if TTS_PREWARM and TTS_CACHE_DIR:
+        detyrat_sfond.append(nis_detyre(ngrohe_cache_tts()))
+    detyrat_sfond.append(nis_detyre(planifikuesi.puno()))
+    if MOT_REFRESH_S > 0 and WEATHER_API_KEY:
+        detyrat_sfond.append(nis_detyre(rifresko_motin_ne_sfond()))
+    try:
+        yield
+    finally:
+        for detyre in detyrat_sfond:
+            detyre.cancel()
+        await asyncio.gather(*detyrat_sfond, return_exceptions=True)
+        await mbyll_klientet()
+        # Shkrimet SQLite që janë ende në radhë përfundojnë para daljes
+        await mbyll_thread_db()
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
+
+@app.middleware("http")
+async def mat_kerkesen(request: Request, call_next):
+    """Histogram për rrugë, Server-Timing me fazat dhe log për kërkesat e ngadalta"""
+    gjurma: List[Tuple[str, float]] = []
+    shenja = _gjurma.set(gjurma)
+    fillimi = time.perf_counter()
+    try:
+        pergjigja = await call_next(request)
+    finally:
+        _gjurma.reset(shenja)
+    total = time.perf_counter() - fillimi
+    rruga = getattr(request.scope.get("route"), "path", "pa_rruge")
+    m_http_sekonda.vezhgo(total, request.method, rruga, str(pergjigja.status_code))
+    pergjigja.headers["Server-Timing"] = server_timing(gjurma, total)
+    if KERKESE_NGADALE_MS and total * 1000 >= KERKESE_NGADALE_MS:
+        fazat = " ".join(f"{faza}={1000 * k:.0f}ms" for faza, k in gjurma)
+        print(f"Kërkesë e ngadaltë: {request.method} {rruga} {1000 * total:.0f}ms [{fazat}]")
+    return pergjigja
+
+@app.exception_handler(RadhaEPlote)
+async def radha_e_plote(request, e: RadhaEPlote):
+    return JSONResponse(
+        {"error": "Luna është shumë e zënë tani, provo përsëri pas pak.", "radha": e.radha.emri},
+        status_code=503,
+        headers={"Retry-After": str(e.radha.retry_after())},
+    )
+
+@app.get("/")
+async def root():
+    return {"status": "Luna AI është aktive!", "version": "4.0"}
+
+@app.post("/regjistro")
+async def regjistro(body: RegjistroBody):
+    await perdoruesit.vendos(body.device_id, {"emri": body.emri, "qyteti": body.qyteti or "Tirana"})
+    pergjigja = f"Mirë se vjen {body.emri}! Jam Luna, asistentja jote shqiptare. Si mund të të ndihmoj?"
+    request_id = await nis_zerin(pergjigja, body.device_id, "regjistro")
+    return {"answer": pergjigja, "ok": True, "request_id": request_id}
+
+@app.post("/transcribe")
+async def transcribe(request: Request, kompakto: bool = TRANSKRIPTIM_KOMPAKTO):
+    """Audio si multipart (fusha 'audio') ose si trup i papërpunuar (p.sh. Content-Type: audio/wav).
+
+    Trupi i papërpunuar kalon te Whisper pa u mbledhur i gjithi në memorie."""
+    try:
+        with me_afat(afati_i_kerkeses(request)):
+            return {"text": await brenda_afatit(transkripto(await audio_e_kerkeses(request), kompakto))}
+    except GabimAudio as e:
+        return JSONResponse({"text": "", "error": str(e)}, status_code=e.statusi)
+    except RadhaEPlote:
+        raise
+    except asyncio.TimeoutError:
+        m_afati_kaloi.shto(1, "transkriptim")
+        return JSONResponse({"text": "", "error": "transkriptimi kaloi afatin"}, status_code=504)
+    except Exception as e:
+        return {"text": "", "error": str(e)}
+
+@app.post("/ask")
+async def ask(body: AskBody, request: Request):
+    """Afati: X-Luna-Deadline-Ms (ose LUNA_AFATI_S) - pas tij vjen falja ose përgjigja pa kërkim web"""
+    emri = await pergatit_biseden(body.device_id, body.emri)
+    with me_afat(afati_i_kerkeses(request)):
+        intent, pergjigja = await pergjigju(body.device_id, body.text, emri)
+
+    # Gjenero zërin - pajisja mund ta marrë sapo të dalë copa e parë
+    request_id = await nis_zerin(pergjigja, body.device_id, intent["lloj"])
+
+    return {"answer": pergjigja, "intent": intent["lloj"], "request_id": request_id}
+
+@app.post("/ask/stream")
+async def ask_stream(body: AskBody, request: Request, audio: bool = True):
+    """Si /ask, por teksti dhe audio dalin me SSE sapo gatitet çdo fjali"""
+    emri = await pergatit_biseden(body.device_id, body.emri)
+
+    with mat("intent"):
+        intent = detekto_intent(body.text)
+    with me_afat(afati_i_kerkeses(request)):
+        fjalite = await fjalite_e_pergjigjes(body.device_id, body.text, intent, emri)
+
+    request_id = uuid.uuid4().hex[:12]
+    return StreamingResponse(
+        rrjedha_sse(body.device_id, request_id, intent["lloj"], fjalite, me_audio=audio),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+def teksti_per_header(teksti: str, kufiri: int = VOICE_HEADER_MAX) -> Tuple[str, bool]:
+    """Teksti percent-encoded, i prerë te shkronja e fundit që hyn në `kufiri` bytes; kthen edhe nëse u pre"""
+    i_koduar = quote(teksti)
+    if len(i_koduar) <= kufiri:
+        return i_koduar, False
+    pjeset, gjatesia = [], 0
+    for shkronja in teksti:
+        pjesa = quote(shkronja)
+        if gjatesia + len(pjesa) > kufiri:
+            break
+        pjeset.append(pjesa)
+        gjatesia += len(pjesa)
+    return "".join(pjeset), True
+
+@app.post("/voice")
+async def voice(request: Request, device_id: str = "luna_default", emri: Optional[str] = None,
+                dalja: str = "mp3", kompakto: bool = TRANSKRIPTIM_KOMPAKTO):
+    """Një kthesë e plotë me zë në një kërkesë: audio brenda, transkript + përgjigje + zë jashtë.
+
+    dalja=mp3: trupi është MP3 që rrjedh ndërsa sintetizohet; transkripti dhe përgjigja
+    vijnë te headers X-Luna-Transcript / X-Luna-Answer (percent-encoded UTF-8), të prera
+    në LUNA_VOICE_HEADER_MAX bytes - X-Luna-Truncated tregon cilat u prenë. Teksti i plotë
+    vjen edhe si ngjarja "pergjigje" në kanalin push, ose me dalja=sse.
+    dalja=sse: ngjarja "transkript", pastaj të njëjtat ngjarje si /ask/stream."""
+    # Një afat për gjithë kthesën: transkriptimi, intenti dhe përgjigja me tekst
+    with me_afat(afati_i_kerkeses(request)):
+        try:
+            teksti = await brenda_afatit(transkripto(await audio_e_kerkeses(request), kompakto))
+        except GabimAudio as e:
+            return JSONResponse({"text": "", "error": str(e)}, status_code=e.statusi)
+        except RadhaEPlote:
+            raise
+        except asyncio.TimeoutError:
+            m_afati_kaloi.shto(1, "transkriptim")
+            return JSONResponse({"text": "", "error": "transkriptimi kaloi afatin"}, status_code=504)
+        except Exception as e:
+            print(f"Gabim transkriptimi: {e}")
+            return JSONResponse({"text": "", "error": str(e)}, status_code=502)
+        if not teksti:
+            # Vetëm heshtje - pajisja thjesht rikthehet në dëgjim
+            return Response(status_code=204)
+
+        emri = await pergatit_biseden(device_id, emri)
+
+        if dalja == "sse":
+            with mat("intent"):
+                intent = detekto_intent(teksti)
+            fjalite = await fjalite_e_pergjigjes(device_id, teksti, intent, emri)
+            request_id = uuid.uuid4().hex[:12]
+
+            async def me_transkript() -> AsyncIterator[str]:
+                yield _ngjarje_sse("transkript", {"text": teksti})
+                async for ngjarja in rrjedha_sse(device_id, request_id, intent["lloj"], fjalite):
+                    yield ngjarja
+
+            return StreamingResponse(
+                me_transkript(),
+                media_type="text/event-stream",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+            )
+
+        intent, pergjigja = await pergjigju(device_id, teksti, emri)
+        request_id = await nis_zerin(pergjigja, device_id, intent["lloj"])
+        transkripti, transkripti_i_prere = teksti_per_header(teksti)
+        pergjigja_h, pergjigja_e_prere = teksti_per_header(pergjigja)
+        headers = {
+            "X-Luna-Transcript": transkripti,
+            "X-Luna-Answer": pergjigja_h,
+            "X-Luna-Intent": intent["lloj"],
+            "X-Luna-Request-Id": request_id,
+            "Access-Control-Expose-Headers": "X-Luna-Transcript, X-Luna-Answer, X-Luna-Intent, X-Luna-Request-Id, "
+                                             "X-Luna-Truncated",
+        }
+        te_prera = [emri for emri, e_prere in (("transcript", transkripti_i_prere), ("answer", pergjigja_e_prere))
+                    if e_prere]
+        if te_prera:
+            headers["X-Luna-Truncated"] = ",".join(te_prera)
+        reg = await depo_audio.merr(device_id, request_id)
+        if reg is None:
+            return Response(status_code=204, headers=headers)
+        return StreamingResponse(reg.rrjedha(), media_type="audio/mpeg", headers=headers)
 
 @app.get("/status")
-async def status():
-    return {"audio_ready": audio_ready, "ka_audio": len(current_audio_data) > 0}
+async def status(device_id: Optional[str] = None, request_id: Optional[str] = None):
+    reg = await depo_audio.merr(device_id, request_id)
+    if reg is None:
+        return {"audio_ready": False, "ka_audio": False, "perfunduar": True}
+    return {
+        "audio_ready": reg.madhesia > 0,
+        "ka_audio": reg.madhesia > 0,
+        "perfunduar": reg.perfunduar,
+    }
 
 @app.get("/get_audio")
-async def get_audio():
-    if current_audio_data:
-        return Response(content=current_audio_data, media_type="audio/mpeg")
-    return Response(status_code=204)
+async def get_audio(device_id: Optional[str] = None, request_id: Optional[str] = None):
+    reg = await depo_audio.merr(device_id, request_id)
+    if reg is None or (reg.perfunduar and not reg.ok):
+        return Response(status_code=204)
+    if reg.perfunduar:
+        return Response(content=await reg.te_gjitha(), media_type="audio/mpeg")
+    # Sinteza ende vazhdon - dërgo copat me chunked transfer sapo vijnë
+    return StreamingResponse(reg.rrjedha(), media_type="audio/mpeg")
 
 @app.post("/done")
-async def done():
-    global audio_ready, current_audio_data
-    audio_ready = False
-    current_audio_data = b""
+async def done(device_id: Optional[str] = None, request_id: Optional[str] = None):
+    await depo_audio.fshi(device_id, request_id)
     return {"ok": True}
 
+@app.get("/events")
+async def events(device_id: str = "luna_default", pas: Optional[int] = None, timeout: float = 25):
+    """Long-poll: kthen ngjarjet pas kursorit `pas`, ose pret derisa të vijë një e re.
+
+    Pa `pas` kthehen vetëm ngjarjet që vijnë nga ky moment; përgjigja jep kursorin
+    për thirrjen tjetër."""
+    if pas is None:
+        pas = await kanalet.kursori(device_id)
+    ngjarjet = await kanalet.prit(device_id, pas, min(max(timeout, 0.0), PUSH_PRITJE_MAX_S))
+    return {"ngjarjet": ngjarjet, "pas": ngjarjet[-1]["id"] if ngjarjet else pas}
+
+@app.websocket("/ws/{device_id}")
+async def ws(websocket: WebSocket, device_id: str, pas: Optional[int] = None, audio: bool = False):
+    """Kanal push: çdo ngjarje dërgohet si JSON sapo ndodh.
+
+    Me `audio=true`, pas ngjarjes "audio" dërgohen edhe copat MP3 si korniza
+    binare, të mbyllura nga një ngjarje "audio_fund"."""
+    await websocket.accept()
+    if pas is None:
+        pas = await kanalet.kursori(device_id)
+
+    async def deri_ne_shkeputje():
+        # Mesazhet e klientit nuk përdoren - lexohen vetëm që shkëputja të dihet menjëherë
+        while (await websocket.receive())["type"] != "websocket.disconnect":
+            pass
+
+    leximi = asyncio.ensure_future(deri_ne_shkeputje())
+    pritja: Optional[asyncio.Future] = None
+    try:
+        while True:
+            pritja = asyncio.ensure_future(kanalet.prit(device_id, pas, PUSH_PRITJE_MAX_S))
+            await asyncio.wait((pritja, leximi), return_when=asyncio.FIRST_COMPLETED)
+            if leximi.done():
+                return
+            ngjarjet = pritja.result()
+            if not ngjarjet:
+                await websocket.send_json({"lloji": "ping"})
+                continue
+            for ngjarja in ngjarjet:
+                pas = ngjarja["id"]
+                await websocket.send_json(ngjarja)
+                if audio and ngjarja["lloji"] == "audio" and ngjarja["te_dhenat"]["ok"]:
+                    request_id = ngjarja["te_dhenat"]["request_id"]
+                    reg = await depo_audio.merr(device_id, request_id)
+                    if reg is not None:
+                        async for copa in reg.rrjedha():
+                            await websocket.send_bytes(copa)
+                    await websocket.send_json({"lloji": "audio_fund", "te_dhenat": {"request_id": request_id}})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        # Pritja në kanal (dhe numëruesi i saj te KanaletPush) lirohet sapo klienti ikën
+        for detyre in (pritja, leximi):
+            if detyre is not None:
+                detyre.cancel()
+
 @app.get("/alarmet")
-async def get_alarmet():
-    return {"alarmet": alarmet, "timerat": timerat}
+async def get_alarmet(device_id: str = "luna_default"):
+    return {"alarmet": await planifikuesi.alarmet(device_id), "timerat": await planifikuesi.timerat(device_id)}
 
-@app.delete("/alarm/{index}")
-async def fshi_alarmin(index: int):
-    if 0 <= index < len(alarmet):
-        alarmet.pop(index)
+@app.delete("/alarm/{alarm_id}")
+async def fshi_alarmin(alarm_id: int, device_id: str = "luna_default"):
+    if await planifikuesi.fshi(device_id, alarm_id):
         return {"ok": True}
-    return {"ok": False, "error": "Index i gabuar"}
+    return {"ok": False, "error": "ID e gabuar"}
+
+@app.get("/metrics")
+async def metrics():
+    return Response(content=eksporto_metrikat(), media_type="text/plain; version=0.0.4; charset=utf-8")
 
 @app.get("/health")
 async def health():
+    planifikimi = planifikuesi.statistika()
     return {
         "status": "aktive",
         "version": "4.0",
         "groq": bool(GROQ_API_KEY),
         "weather": bool(WEATHER_API_KEY),
         "perdorues": len(perdoruesit),
-        "alarmet": len(alarmet),
-        "timerat": len(timerat),
+        "perdoruesit": perdoruesit.statistika(),
+        "bisedat": {**bisedat.statistika(), "permbledhjet": statistika_permbledhjes},
+        "tokenat_ai": tokenat_ai,
+        "modelet": {emri: m.statistika() for emri, m in modelet.items()},
+        "cache_pergjigjeve": statistika_e_cache_pergjigjeve(),
+        "parashikimi_kerkimit": statistika_e_parashikimit(),
+        # "alarmet" dhe "timerat" mbeten numra si më parë; hollësitë e planifikuesit janë më vete
+        "alarmet": planifikimi["alarme"],
+        "timerat": planifikimi["timera"],
+        "planifikuesi": planifikimi,
+        "push": kanalet.statistika(),
+        "radhet": {emri: r.statistika() for emri, r in radhet.items()},
+        "gjendja": GJENDJA,
+        "audio": depo_audio.statistika(),
+        "cache_tts": cache_tts.statistika(),
+        "cache_moti": len(_cache_motit),
+        "matrica_rrugeve": len(_matrica_rrugeve),
         "ora_shqiperi": koha_tani(),
         "data": data_sot()
     }